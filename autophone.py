@@ -5,6 +5,7 @@
 import ConfigParser
 import Queue
 import SocketServer
+import collections
 import datetime
 import errno
 import inspect
@@ -15,14 +16,17 @@ import multiprocessing
 import os
 import signal
 import socket
+import sqlite3
 import sys
 import threading
+import time
 import urlparse
 
 from manifestparser import TestManifest
 from mozdevice.devicemanager import NetworkTools
 from pulsebuildmonitor import start_pulse_monitor
 
+import buildpoller
 import builds
 import buildserver
 import jobs
@@ -35,6 +39,13 @@ from worker import Crashes, PhoneWorker
 
 class AutoPhone(object):
 
+    # Number of builds found by pulse or the build poller which are
+    # remembered in order to ignore duplicate notifications.
+    MAX_RECENT_BUILDS = 1000
+    # Number of seconds between the updates of the builds pinned with
+    # the build cache daemon; see pin_builds().
+    PIN_INTERVAL = 60
+
     class CmdTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
 
         allow_reuse_address = True
@@ -86,6 +97,9 @@ class AutoPhone(object):
         self.phone_workers = {}  # indexed by mac address
         self.worker_lock = threading.Lock()
         self.cmd_lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self._recent_builds = collections.OrderedDict()
+        self._pinned = 0
         self._tests = []
         self.logger.info('Starting autophone.')
 
@@ -180,6 +194,8 @@ class AutoPhone(object):
         try:
             while not self._stop:
                 self.check_for_dead_workers()
+                if time.time() - self._pinned >= self.PIN_INTERVAL:
+                    self.pin_builds()
                 try:
                     msg = self.worker_msg_queue.get(timeout=5)
                 except Queue.Empty:
@@ -193,6 +209,7 @@ class AutoPhone(object):
 
     # Start the phones for testing
     def new_job(self, build_url, devices=None):
+        queued = False
         self.worker_lock.acquire()
         try:
             for p in self.phone_workers.values():
@@ -216,11 +233,57 @@ class AutoPhone(object):
                                       (build_url, phoneid, abi))
                     continue
                 self.jobs.new_job(build_url, phoneid)
+                queued = True
                 self.logger.info('Notifying device %s of new job %s.' %
                                  (phoneid, build_url))
                 p.new_job()
         finally:
             self.worker_lock.release()
+        if queued:
+            self.pin_builds()
+            self.prefetch_build(build_url)
+
+    def pin_builds(self):
+        """Tells the build cache daemon, if it is used, the builds of
+        the queued and running jobs so that it does not evict them.
+        The daemon unpins them if they are not pinned again within
+        BuildCacheServer.PIN_EXPIRES seconds, so they are pinned
+        again every PIN_INTERVAL seconds, which also unpins the builds
+        of the completed jobs.
+        """
+        if not self.options[BUILD_CACHE_DAEMON]:
+            return
+        self._pinned = time.time()
+        try:
+            build_urls = self.jobs.pending_build_urls()
+        except sqlite3.OperationalError:
+            # The daemon keeps the previous pins until they expire.
+            self.logger.exception('Unable to get the builds to pin')
+            return
+        try:
+            client = buildserver.BuildCacheClient(
+                port=self.options[BUILD_CACHE_PORT])
+            client.pin('%s:%d' % (self.options[IPADDR], self.options[PORT]),
+                       build_urls)
+            client.close()
+        except socket.error:
+            self.logger.exception('Unable to pin builds')
+
+    def prefetch_build(self, build_url):
+        """Asks the build cache server to fetch the build in the
+        background so that it is ready when the phones run the job.
+        The tests package is fetched too if any test uses it.
+        """
+        enable_unittests = self.options[ENABLE_UNITTESTS]
+        for test_class, config_file, test_unittests, test_devices_repos in self._tests:
+            enable_unittests = enable_unittests or test_unittests
+        try:
+            client = buildserver.BuildCacheClient(
+                port=self.options[BUILD_CACHE_PORT])
+            client.prefetch(build_url, enable_unittests=enable_unittests)
+            client.close()
+        except socket.error:
+            self.logger.exception('Unable to prefetch build %s' % build_url)
 
     def route_cmd(self, data):
         response = ''
@@ -468,7 +531,32 @@ class AutoPhone(object):
         # those, and only run the ones with real URLs
         # We create jobs for all the phones and push them into the queue
         if 'buildurl' in msg:
-            self.new_job(msg['buildurl'])
+            self.new_build(msg['buildurl'])
+
+    def new_build(self, build_url):
+        """Create jobs for a build found by pulse or the build poller
+        unless jobs for it are already queued or it has already been
+        found by either of them.
+        """
+        if self._stop:
+            return
+        with self.build_lock:
+            if build_url in self._recent_builds:
+                self.logger.debug('Ignoring already found build %s' %
+                                  build_url)
+                return
+            self._recent_builds[build_url] = True
+            while len(self._recent_builds) > self.MAX_RECENT_BUILDS:
+                self._recent_builds.popitem(last=False)
+        try:
+            if build_url in self.jobs.pending_build_urls():
+                self.logger.debug('Ignoring already queued build %s' %
+                                  build_url)
+                return
+        except sqlite3.OperationalError:
+            self.logger.exception('Unable to check for queued jobs of %s' %
+                                  build_url)
+        self.new_job(build_url)
 
     def stop(self):
         self._stop = True
@@ -524,6 +612,17 @@ def load_autophone_options(cmd_options):
               builds.BuildCache.MAX_NUM_BUILDS)
     set_value(options, BUILD_CACHE_EXPIRES,
               builds.BuildCache.EXPIRE_AFTER_DAYS)
+    set_value(options, BUILD_CACHE_MAX_BYTES,
+              builds.BuildCache.MAX_NUM_BYTES)
+    set_value(options, BUILD_CACHE_SCRUB_INTERVAL,
+              builds.BuildCache.SCRUB_INTERVAL)
+    set_value(options, BUILD_CACHE_PROCESSES,
+              builds.BuildCache.FETCH_PROCESSES)
+    set_value(options, BUILD_CRAWL_THREADS,
+              builds.BuildLocation.CRAWL_THREADS)
+    set_value(options, BUILD_POLL_INTERVAL, 0)
+    set_value(options, BUILD_POLL_LOCATIONS,
+              ' '.join(buildpoller.BuildPoller.POLL_LOCATIONS))
     set_value(options, DEVICEMANAGER_RETRY_LIMIT,
               PhoneWorker.DEVICEMANAGER_RETRY_LIMIT)
     set_value(options, DEVICEMANAGER_SETTLING_TIME,
@@ -583,11 +682,15 @@ def main(options):
     streamhandler.setFormatter(streamformatter)
     console_logger.addHandler(streamhandler)
 
+    # See BuildCache for why the pool is created first. The daemon
+    # fetches the builds when it is used.
+    build_cache_pool = None
+    if options[BUILD_CACHE_PROCESSES] and not options[BUILD_CACHE_DAEMON]:
+        build_cache_pool = multiprocessing.Pool(options[BUILD_CACHE_PROCESSES])
+
     console_logger.info('Starting server on port %d.' % options[PORT])
     autophone = AutoPhone(loglevel, options)
 
-    console_logger.info('Starting build-cache server on port %d.' %
-                        options[BUILD_CACHE_PORT])
     product = 'fennec'
     build_platforms = ['android', 'android-armv6', 'android-x86']
     buildfile_ext = '.apk'
@@ -602,7 +705,13 @@ def main(options):
             override_build_dir=options[OVERRIDE_BUILD_DIR],
             enable_unittests=options[ENABLE_UNITTESTS],
             build_cache_size=options[BUILD_CACHE_SIZE],
-            build_cache_expires=options[BUILD_CACHE_EXPIRES])
+            build_cache_expires=options[BUILD_CACHE_EXPIRES],
+            build_cache_max_bytes=options[BUILD_CACHE_MAX_BYTES],
+            crawl_threads=options[BUILD_CRAWL_THREADS],
+            pinned_build_urls=autophone.jobs.pending_build_urls,
+            pool=build_cache_pool,
+            # The daemon fetches and evicts the builds.
+            load_index=not options[BUILD_CACHE_DAEMON])
     except builds.BuildCacheException, e:
         print '''%s
 
@@ -616,14 +725,60 @@ unpacked tests package for the build.
         ''' % e
         raise
 
-    build_cache_server = buildserver.BuildCacheServer(
-        ('127.0.0.1', options[BUILD_CACHE_PORT]),
-        buildserver.BuildCacheHandler)
-    build_cache_server.build_cache = build_cache
-    build_cache_server_thread = threading.Thread(
-        target=build_cache_server.serve_forever)
-    build_cache_server_thread.daemon = True
-    build_cache_server_thread.start()
+    build_cache_server = None
+    if options[BUILD_CACHE_DAEMON]:
+        console_logger.info('Using build cache daemon on port %d.' %
+                            options[BUILD_CACHE_PORT])
+    else:
+        console_logger.info('Starting build-cache server on port %d.' %
+                            options[BUILD_CACHE_PORT])
+        build_cache_server = buildserver.BuildCacheServer(
+            ('127.0.0.1', options[BUILD_CACHE_PORT]),
+            buildserver.BuildCacheHandler)
+        build_cache_server.build_cache = build_cache
+        build_cache_server_thread = threading.Thread(
+            target=build_cache_server.serve_forever)
+        build_cache_server_thread.daemon = True
+        build_cache_server_thread.start()
+
+    build_artifact_server = None
+    if build_cache_server and options[BUILD_CACHE_HTTP_PORT]:
+        console_logger.info('Starting build artifact server on %s:%d.' %
+                            (options[BUILD_CACHE_HTTP_ADDRESS],
+                             options[BUILD_CACHE_HTTP_PORT]))
+        build_artifact_server = buildserver.BuildArtifactServer(
+            (options[BUILD_CACHE_HTTP_ADDRESS],
+             options[BUILD_CACHE_HTTP_PORT]), build_cache.cache_dir)
+        build_artifact_server_thread = threading.Thread(
+            target=build_artifact_server.serve_forever)
+        build_artifact_server_thread.daemon = True
+        build_artifact_server_thread.start()
+        build_cache_server.artifacts_url = 'http://%s:%d/' % (
+            buildserver.artifacts_host(options[BUILD_CACHE_HTTP_ADDRESS],
+                                       options[IPADDR]),
+            options[BUILD_CACHE_HTTP_PORT])
+
+    # The daemon evicts and scrubs the builds it caches.
+    build_cache_evictor = None
+    if build_cache_server:
+        build_cache_evictor = builds.BuildCacheEvictor(build_cache)
+        build_cache_evictor.start()
+
+    build_cache_scrubber = None
+    if build_cache_server and options[BUILD_CACHE_SCRUB_INTERVAL] > 0:
+        build_cache_scrubber = builds.BuildCacheScrubber(
+            build_cache, options[BUILD_CACHE_SCRUB_INTERVAL])
+        build_cache_scrubber.start()
+
+    build_poller = None
+    if options[BUILD_POLL_INTERVAL] > 0:
+        console_logger.info('Starting build poller.')
+        build_poller = buildpoller.BuildPoller(
+            build_cache,
+            autophone.new_build,
+            build_locations=options[BUILD_POLL_LOCATIONS].split(),
+            interval=options[BUILD_POLL_INTERVAL])
+        build_poller.start()
 
     signal.signal(signal.SIGTERM, sigterm_handler)
     autophone.run()
@@ -647,9 +802,20 @@ unpacked tests package for the build.
                 break
 
     console_logger.info('AutoPhone terminated.')
-    console_logger.info('Shutting down build-cache server...')
-    build_cache_server.shutdown()
-    build_cache_server_thread.join()
+    if build_poller:
+        console_logger.info('Stopping build poller...')
+        build_poller.stop()
+    if build_cache_server:
+        console_logger.info('Shutting down build-cache server...')
+        build_cache_server.shutdown()
+        build_cache_server_thread.join()
+    if build_artifact_server:
+        build_artifact_server.shutdown()
+    if build_cache_evictor:
+        build_cache_evictor.stop()
+    if build_cache_scrubber:
+        build_cache_scrubber.stop()
+    build_cache.close()
     console_logger.info('Done.')
     return 0
 
@@ -726,8 +892,35 @@ if __name__ == '__main__':
                       default=buildserver.DEFAULT_PORT,
                       help='Port for build-cache server. If you are running '
                       'multiple instances of autophone, this will have to be '
-                      'different in each. Defaults to %d.' %
+                      'different in each unless they share a build cache '
+                      'daemon. Defaults to %d.' %
                       buildserver.DEFAULT_PORT)
+    parser.add_option('--build-cache-daemon',
+                      dest='build_cache_daemon',
+                      action='store_true',
+                      default=False,
+                      help='Use the build cache daemon started with '
+                      'buildcached.py on --build-cache-port instead of '
+                      'starting a build-cache server, so that the instances '
+                      'of autophone on this host download each build once. '
+                      '--cache-dir must be the daemon\'s cache directory.')
+    parser.add_option('--build-cache-http-port',
+                      dest='build_cache_http_port',
+                      action='store',
+                      type='int',
+                      default=0,
+                      help='Port on which the files of the cached builds are '
+                      'served over HTTP to devices, test harnesses and other '
+                      'hosts. Defaults to 0, which does not serve them.')
+    parser.add_option('--build-cache-http-address',
+                      dest='build_cache_http_address',
+                      action='store',
+                      type='string',
+                      default='127.0.0.1',
+                      help='Address on which the files of the cached builds '
+                      'are served with --build-cache-http-port. Defaults to '
+                      '127.0.0.1, which only serves this host. Use 0.0.0.0 '
+                      'to serve devices and other hosts.')
     parser.add_option('--config',
                       dest='autophonecfg',
                       action='store',
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Compare the number of HTTP requests made by the linear and bisect
+search strategies of BuildLocation.find_builds_by_revision.
+
+A local fixture server publishes a synthetic Tinderbox tree of
+--builds mozilla-central android builds, one per hourly push, along
+with the json-pushes pushlog of the repo. Each strategy searches for
+the builds from --first through --last with an empty build cache,
+then repeats the search with the warm cache.
+
+  python benchmarks/find_builds_by_revision.py --builds 200 \\
+      --first 80 --last 90
+"""
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import builds
+import httpclient
+from tinderboxfixture import REPO, PLATFORM, TinderboxFixture
+
+
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        parts = urlparse.urlsplit(self.path)
+        content = self.server.tree.content(parts.path,
+                                           urlparse.parse_qs(parts.query))
+        if content is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves the TinderboxFixture tree, counting the requests."""
+
+    daemon_threads = True
+
+    def __init__(self, tree):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FixtureHandler)
+        self.tree = tree
+        tree.base_url = 'http://127.0.0.1:%d' % self.server_port
+        self.requests = 0
+        self.lock = threading.Lock()
+
+
+def benchmark(server, strategy, first_revision, last_revision, crawl_threads):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        build_cache = builds.BuildCache([REPO], ['opt'], 'fennec', [PLATFORM],
+                                        '.apk', cache_dir=cache_dir,
+                                        crawl_threads=crawl_threads,
+                                        search_strategy=strategy)
+        results = []
+        for run in 'cold', 'warm':
+            server.requests = 0
+            start = time.time()
+            build_urls = build_cache.find_builds_by_revision(
+                first_revision, last_revision, 'tinderbox')
+            results.append((run, build_urls, server.requests,
+                            time.time() - start))
+        for run, build_urls, requests, elapsed in results:
+            print '%-6s %s: %d builds, %d requests, %.2f s' % (
+                strategy, run, len(build_urls), requests, elapsed)
+        return results[0][1]
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--builds', action='store', type='int',
+                      dest='builds', default=200,
+                      help='Number of builds in the fixture tree; '
+                      'defaults to 200.')
+    parser.add_option('--first', action='store', type='int',
+                      dest='first', default=80,
+                      help='Index of the build of the first revision; '
+                      'defaults to 80.')
+    parser.add_option('--last', action='store', type='int',
+                      dest='last', default=90,
+                      help='Index of the build of the last revision; '
+                      'defaults to 90.')
+    parser.add_option('--crawl-threads', action='store', type='int',
+                      dest='crawl_threads',
+                      default=builds.BuildLocation.CRAWL_THREADS,
+                      help='Maximum number of concurrent requests; '
+                      'defaults to %d.' % builds.BuildLocation.CRAWL_THREADS)
+    (options, args) = parser.parse_args()
+
+    tree = TinderboxFixture(options.builds)
+    server = FixtureServer(tree)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    repo_url = '%s/%s/' % (tree.base_url, REPO)
+    builds.Tinderbox.main_http_url = tree.base_url + '/tinderbox-builds/'
+    builds.repo_urls[REPO] = repo_url
+    builds.urls_repos[repo_url] = REPO
+
+    first_revision = tree.pushes[options.first][1][:12]
+    last_revision = tree.pushes[options.last][1][:12]
+    found = [benchmark(server, strategy, first_revision, last_revision,
+                       options.crawl_threads)
+             for strategy in builds.BuildLocation.SEARCH_STRATEGIES]
+    # Close the keep-alive connections so the handler threads exit.
+    httpclient.get_client().close()
+    server.shutdown()
+    server.server_close()
+    if found[0] != found[1]:
+        print 'The search strategies found different builds!'
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
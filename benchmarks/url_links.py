@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Compare the streaming builds.LinkParser with the BeautifulSoup based
+link extraction previously used by builds.url_links.
+
+Listings can be recorded for later runs with --record, e.g.
+
+  python benchmarks/url_links.py --record listings \\
+      http://ftp.mozilla.org/pub/mozilla.org/mobile/tinderbox-builds/mozilla-central-android/
+
+then benchmarked with
+
+  python benchmarks/url_links.py listings/*.html
+
+If no listings are given, a synthetic Apache style listing of
+--entries Tinderbox timestamp directories is used.
+
+Requires beautifulsoup4, which autophone itself does not use:
+
+  pip install -r benchmarks/requirements.txt
+"""
+
+import os
+import sys
+import time
+import urllib2
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+from bs4 import BeautifulSoup
+
+import builds
+
+
+def beautifulsoup_links(content):
+    soup = BeautifulSoup(content, 'html.parser')
+    return [builds.Link(link.get('href'), link.get_text())
+            for link in soup.findAll('a')
+            if not link.get('href').startswith('?') and
+            link.get_text() != 'Parent Directory']
+
+
+def linkparser_links(content):
+    parser = builds.LinkParser()
+    for offset in range(0, len(content), builds.URL_LINKS_CHUNK_SIZE):
+        parser.feed(content[offset:offset + builds.URL_LINKS_CHUNK_SIZE])
+    parser.close()
+    return parser.links
+
+
+def synthetic_listing(entries):
+    lines = ['<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">',
+             '<html><head><title>Index of /pub/mozilla.org/mobile/'
+             'tinderbox-builds/mozilla-central-android</title></head>',
+             '<body><h1>Index of /pub/mozilla.org/mobile/tinderbox-builds/'
+             'mozilla-central-android</h1>',
+             '<pre><img src="/icons/blank.gif" alt="Icon "> '
+             '<a href="?C=N;O=D">Name</a> '
+             '<a href="?C=M;O=A">Last modified</a> '
+             '<a href="?C=S;O=A">Size</a><hr>',
+             '<img src="/icons/back.gif" alt="[DIR]"> '
+             '<a href="/pub/mozilla.org/mobile/tinderbox-builds/">'
+             'Parent Directory</a>                             -']
+    timestamp = 1380000000
+    for i in range(entries):
+        lines.append('<img src="/icons/folder.gif" alt="[DIR]"> '
+                     '<a href="%d/">%d/</a>               '
+                     '24-Sep-2013 05:20    -' % (timestamp, timestamp))
+        timestamp += 600
+    lines.append('<hr></pre></body></html>')
+    return '\n'.join(lines)
+
+
+def record(directory, urls):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for index, url in enumerate(urls):
+        path = os.path.join(directory, 'listing-%03d.html' % index)
+        with open(path, 'w') as listing:
+            listing.write(urllib2.urlopen(url).read())
+        print '%s -> %s' % (url, path)
+
+
+def benchmark(name, content, repeat):
+    expected = beautifulsoup_links(content)
+    if linkparser_links(content) != expected:
+        print '%s: LinkParser and BeautifulSoup links differ!' % name
+        return False
+    results = []
+    for extract in beautifulsoup_links, linkparser_links:
+        start = time.time()
+        for i in range(repeat):
+            extract(content)
+        results.append((time.time() - start) / repeat)
+    print ('%s: %d bytes, %d links, BeautifulSoup %.2f ms, '
+           'LinkParser %.2f ms, speedup %.1fx' % (
+               name, len(content), len(expected),
+               results[0] * 1000, results[1] * 1000,
+               results[0] / results[1]))
+    return True
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] [listing.html ...]')
+    parser.add_option('--record', action='store', type='string',
+                      dest='record', default=None,
+                      help='Save the listings at the urls given as '
+                      'arguments into this directory and exit.')
+    parser.add_option('--repeat', action='store', type='int',
+                      dest='repeat', default=10,
+                      help='Number of times to parse each listing; '
+                      'defaults to 10.')
+    parser.add_option('--entries', action='store', type='int',
+                      dest='entries', default=5000,
+                      help='Number of entries in the synthetic listing; '
+                      'defaults to 5000.')
+    (options, args) = parser.parse_args()
+
+    if options.record:
+        record(options.record, args)
+        return 0
+
+    if args:
+        listings = [(path, open(path).read()) for path in args]
+    else:
+        listings = [('synthetic', synthetic_listing(options.entries))]
+
+    success = True
+    for name, content in listings:
+        success = benchmark(name, content, options.repeat) and success
+    return 0 if success else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
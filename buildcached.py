@@ -0,0 +1,228 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import errno
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+
+import builds
+import buildserver
+
+from multiprocessinghandlers import MultiprocessingStreamHandler, MultiprocessingTimedRotatingFileHandler
+
+
+def main(options):
+    loglevel = e = None
+    try:
+        loglevel = getattr(logging, options.loglevel)
+    except AttributeError, e:
+        pass
+    finally:
+        if e or logging.getLevelName(loglevel) != options.loglevel:
+            print 'Invalid log level %s' % options.loglevel
+            return errno.EINVAL
+
+    logger = logging.getLogger('autophone')
+    logger.propagate = False
+    logger.setLevel(loglevel)
+    filehandler = MultiprocessingTimedRotatingFileHandler(options.logfile,
+                                                          when='midnight',
+                                                          backupCount=7)
+    fileformatstring = ('%(asctime)s|%(levelname)s'
+                        '|buildcached|%(message)s')
+    fileformatter = logging.Formatter(fileformatstring)
+    filehandler.setFormatter(fileformatter)
+    logger.addHandler(filehandler)
+
+    console_logger = logging.getLogger('autophone.console')
+    console_logger.setLevel(logging.INFO)
+    streamhandler = MultiprocessingStreamHandler(stream=sys.stderr)
+    streamformatstring = ('%(asctime)s|%(levelname)s'
+                          '|%(message)s')
+    streamformatter = logging.Formatter(streamformatstring)
+    streamhandler.setFormatter(streamformatter)
+    console_logger.addHandler(streamhandler)
+
+    # See BuildCache for why the pool is created first.
+    build_cache_pool = None
+    if options.build_cache_processes:
+        build_cache_pool = multiprocessing.Pool(options.build_cache_processes)
+
+    product = 'fennec'
+    build_platforms = ['android', 'android-armv6', 'android-x86']
+    buildfile_ext = '.apk'
+    # The controllers use the paths of the builds returned by the
+    # daemon, so they must not depend on its working directory.
+    cache_dir = os.path.abspath(options.cache_dir)
+    build_cache = builds.BuildCache(
+        options.repos,
+        options.buildtypes,
+        product,
+        build_platforms,
+        buildfile_ext,
+        cache_dir=cache_dir,
+        enable_unittests=options.enable_unittests,
+        build_cache_size=options.build_cache_size,
+        build_cache_expires=options.build_cache_expires,
+        build_cache_max_bytes=options.build_cache_max_bytes,
+        crawl_threads=options.crawl_threads,
+        pool=build_cache_pool)
+
+    console_logger.info('Starting build cache daemon for %s on port %d.' %
+                        (cache_dir, options.port))
+    build_cache_server = buildserver.BuildCacheServer(
+        ('127.0.0.1', options.port), buildserver.BuildCacheHandler)
+    build_cache_server.build_cache = build_cache
+    # The controllers pin the builds of their jobs with the server.
+    build_cache.pinned_build_urls = build_cache_server.pinned_build_urls
+
+    build_artifact_server = None
+    if options.http_port:
+        console_logger.info('Starting build artifact server on %s:%d.' %
+                            (options.http_address, options.http_port))
+        build_artifact_server = buildserver.BuildArtifactServer(
+            (options.http_address, options.http_port), cache_dir)
+        build_artifact_server_thread = threading.Thread(
+            target=build_artifact_server.serve_forever)
+        build_artifact_server_thread.daemon = True
+        build_artifact_server_thread.start()
+        build_cache_server.artifacts_url = 'http://%s:%d/' % (
+            buildserver.artifacts_host(options.http_address, options.ipaddr),
+            options.http_port)
+
+    build_cache_evictor = builds.BuildCacheEvictor(build_cache)
+    build_cache_evictor.start()
+
+    build_cache_scrubber = None
+    if options.build_cache_scrub_interval > 0:
+        build_cache_scrubber = builds.BuildCacheScrubber(
+            build_cache, options.build_cache_scrub_interval)
+        build_cache_scrubber.start()
+
+    def sigterm_handler(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it can
+        # not be called from the thread running it.
+        threading.Thread(target=build_cache_server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, sigterm_handler)
+    try:
+        build_cache_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    console_logger.info('Shutting down build cache daemon...')
+    if build_artifact_server:
+        build_artifact_server.shutdown()
+    build_cache_evictor.stop()
+    if build_cache_scrubber:
+        build_cache_scrubber.stop()
+    build_cache.close()
+    console_logger.info('Done.')
+    return 0
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    usage = '''%prog [options]
+Runs the build cache server as a daemon shared by the autophone
+controllers on this host.
+
+Each build is downloaded and unpacked once into the cache directory
+however many controllers test it. Start the controllers with
+--build-cache-daemon, the --build-cache-port given here as --port
+and the same --cache-dir.'''
+    parser = OptionParser(usage=usage)
+    parser.add_option('--port', action='store', type='int', dest='port',
+                      default=buildserver.DEFAULT_PORT,
+                      help='Port on localhost to listen for requests from '
+                      'the controllers; defaults to %d.' %
+                      buildserver.DEFAULT_PORT)
+    parser.add_option('--http-port', action='store', type='int',
+                      dest='http_port', default=0,
+                      help='Port on which the files of the cached builds are '
+                      'served over HTTP. Defaults to 0, which does not serve '
+                      'them.')
+    parser.add_option('--http-address', action='store', type='string',
+                      dest='http_address', default='127.0.0.1',
+                      help='Address on which the files are served with '
+                      '--http-port. Defaults to 127.0.0.1, which only serves '
+                      'this host. Use 0.0.0.0 to serve devices and other '
+                      'hosts.')
+    parser.add_option('--ipaddr', action='store', type='string', dest='ipaddr',
+                      default='127.0.0.1',
+                      help='IP address of this host used in the urls of the '
+                      'files served with --http-port; defaults to 127.0.0.1.')
+    parser.add_option('--cache-dir', action='store', type='string',
+                      dest='cache_dir', default='builds',
+                      help='Directory of the build cache shared by the '
+                      'controllers; defaults to builds.')
+    parser.add_option('--repo', dest='repos', action='append',
+                      help='The repos whose builds are searched when warming '
+                      'the cache. To specify multiple repos, specify them '
+                      'with additional --repo options. Defaults to '
+                      'mozilla-central.')
+    parser.add_option('--buildtype', dest='buildtypes', action='append',
+                      help='The build types searched when warming the cache. '
+                      'To specify multiple build types, specify them with '
+                      'additional --buildtype options. Defaults to opt.')
+    parser.add_option('--enable-unittests', action='store_true',
+                      dest='enable_unittests', default=False,
+                      help='Download the tests packages of all builds.')
+    parser.add_option('--build-cache-size', action='store', type='int',
+                      dest='build_cache_size',
+                      default=builds.BuildCache.MAX_NUM_BUILDS,
+                      help='Number of expired builds kept in the cache; '
+                      'defaults to %d.' % builds.BuildCache.MAX_NUM_BUILDS)
+    parser.add_option('--build-cache-expires', action='store', type='int',
+                      dest='build_cache_expires',
+                      default=builds.BuildCache.EXPIRE_AFTER_DAYS,
+                      help='Number of days after which unused builds expire; '
+                      'defaults to %d.' % builds.BuildCache.EXPIRE_AFTER_DAYS)
+    parser.add_option('--build-cache-max-bytes', action='store', type='int',
+                      dest='build_cache_max_bytes',
+                      default=builds.BuildCache.MAX_NUM_BYTES,
+                      help='Maximum number of bytes used by the cached '
+                      'builds; defaults to 0, which is unlimited.')
+    parser.add_option('--build-cache-scrub-interval', action='store',
+                      type='int', dest='build_cache_scrub_interval',
+                      default=builds.BuildCache.SCRUB_INTERVAL,
+                      help='Seconds between verifications of the cached '
+                      'files; 0 disables them. Defaults to %d.' %
+                      builds.BuildCache.SCRUB_INTERVAL)
+    parser.add_option('--build-cache-processes', action='store', type='int',
+                      dest='build_cache_processes',
+                      default=builds.BuildCache.FETCH_PROCESSES,
+                      help='Number of processes hashing, verifying and '
+                      'extracting the downloaded files; defaults to %d.' %
+                      builds.BuildCache.FETCH_PROCESSES)
+    parser.add_option('--crawl-threads', action='store', type='int',
+                      dest='crawl_threads',
+                      default=builds.BuildLocation.CRAWL_THREADS,
+                      help='Maximum number of directory listings to fetch '
+                      'concurrently while searching for builds; defaults '
+                      'to %d.' % builds.BuildLocation.CRAWL_THREADS)
+    parser.add_option('--logfile', action='store', type='string',
+                      dest='logfile', default='buildcached.log',
+                      help='Log file; defaults to buildcached.log.')
+    parser.add_option('--loglevel', action='store', type='string',
+                      dest='loglevel', default='DEBUG',
+                      help='Log level - ERROR, WARNING, DEBUG, or INFO, '
+                      'defaults to DEBUG')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.print_help()
+        sys.exit(errno.EINVAL)
+
+    if not options.repos:
+        options.repos = ['mozilla-central']
+
+    if not options.buildtypes:
+        options.buildtypes = ['opt']
+
+    sys.exit(main(options))
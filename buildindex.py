@@ -0,0 +1,237 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import calendar
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger('autophone.buildindex')
+
+
+def datetime_to_timestamp(d):
+    """Returns the seconds since the epoch for the datetime d, which
+    is assumed to be in UTC if it does not have a time zone.
+    """
+    return calendar.timegm(d.utctimetuple())
+
+
+class BuildIndex(object):
+    """Persistent index of the builds discovered in build directories.
+
+    Published build directories are immutable, so once a directory
+    has been found to contain a build it never has to be listed
+    again. Each entry is keyed by the url of its build directory and
+    records the build url, repo, platform and build time.
+
+    The buildid and revision published in each build's .txt file are
+    likewise recorded permanently, keyed by build url, and can be
+    looked up by revision prefix.
+
+    The pushlog of each repo is recorded as the (pushid, changeset,
+    date) of each pushed changeset so that revisions can be mapped to
+    push dates without querying hg.
+
+    The index is purely an optimization: errors accessing it are
+    logged and treated as misses.
+    """
+
+    # Maximum number of sql parameters in a single query.
+    MAX_QUERY_PARAMETERS = 500
+
+    COLUMNS = ('directory', 'build_url', 'repo', 'platform', 'build_time')
+    REVISION_COLUMNS = ('build_url', 'buildid', 'repo_url', 'revision')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        try:
+            conn = self._conn()
+            conn.execute('create table if not exists builds '
+                         '(directory text primary key, build_url text, '
+                         'repo text, platform text, build_time integer)')
+            conn.execute('create index if not exists builds_build_time '
+                         'on builds (build_time)')
+            conn.execute('create table if not exists build_revisions '
+                         '(build_url text primary key, buildid text, '
+                         'repo_url text, revision text)')
+            conn.execute('create index if not exists build_revisions_revision '
+                         'on build_revisions (revision)')
+            conn.execute('create table if not exists pushes '
+                         '(repo text, pushid integer, changeset text, '
+                         'date integer, primary key (repo, changeset))')
+            conn.execute('create index if not exists pushes_pushid '
+                         'on pushes (repo, pushid)')
+            conn.commit()
+            conn.close()
+        except sqlite3.Error:
+            logger.exception('Unable to initialize build index %s' %
+                             self.filename)
+
+    def _conn(self):
+        return sqlite3.connect(self.filename, timeout=60)
+
+    def get_builds(self, directories):
+        """Returns a dict mapping each of the directory urls which is
+        in the index to a dict containing its entry.
+        """
+        directories = list(directories)
+        builds = {}
+        try:
+            conn = self._conn()
+            for i in range(0, len(directories), self.MAX_QUERY_PARAMETERS):
+                chunk = directories[i:i + self.MAX_QUERY_PARAMETERS]
+                for row in conn.execute(
+                        'select %s from builds where directory in (%s)' % (
+                            ','.join(self.COLUMNS),
+                            ','.join('?' * len(chunk))),
+                        chunk):
+                    builds[row[0]] = dict(zip(self.COLUMNS, row))
+            conn.close()
+        except sqlite3.Error:
+            logger.exception('Unable to query build index %s' % self.filename)
+        return builds
+
+    def add_builds(self, builds):
+        """Adds the entries in the list of dicts builds to the index."""
+        if not builds:
+            return
+        try:
+            with self.lock:
+                conn = self._conn()
+                conn.executemany(
+                    'insert or replace into builds (%s) values (%s)' % (
+                        ','.join(self.COLUMNS),
+                        ','.join('?' * len(self.COLUMNS))),
+                    [[build[column] for column in self.COLUMNS]
+                     for build in builds])
+                conn.commit()
+                conn.close()
+        except sqlite3.Error:
+            logger.exception('Unable to update build index %s' %
+                             self.filename)
+
+    def get_build_revisions(self, build_urls):
+        """Returns a dict mapping each of the build urls which has a
+        recorded revision to a dict containing its build_url, buildid,
+        repo_url and revision.
+        """
+        build_urls = list(build_urls)
+        revisions = {}
+        try:
+            conn = self._conn()
+            for i in range(0, len(build_urls), self.MAX_QUERY_PARAMETERS):
+                chunk = build_urls[i:i + self.MAX_QUERY_PARAMETERS]
+                for row in conn.execute(
+                        'select %s from build_revisions '
+                        'where build_url in (%s)' % (
+                            ','.join(self.REVISION_COLUMNS),
+                            ','.join('?' * len(chunk))),
+                        chunk):
+                    revisions[row[0]] = dict(zip(self.REVISION_COLUMNS, row))
+            conn.close()
+        except sqlite3.Error:
+            logger.exception('Unable to query build index %s' % self.filename)
+        return revisions
+
+    def add_build_revisions(self, revisions):
+        """Adds the list of revision dicts to the index."""
+        if not revisions:
+            return
+        try:
+            with self.lock:
+                conn = self._conn()
+                conn.executemany(
+                    'insert or replace into build_revisions (%s) '
+                    'values (%s)' % (
+                        ','.join(self.REVISION_COLUMNS),
+                        ','.join('?' * len(self.REVISION_COLUMNS))),
+                    [[revision[column] for column in self.REVISION_COLUMNS]
+                     for revision in revisions])
+                conn.commit()
+                conn.close()
+        except sqlite3.Error:
+            logger.exception('Unable to update build index %s' %
+                             self.filename)
+
+    def find_build_revisions(self, revision, directory_prefix=''):
+        """Returns the list of dicts describing the indexed builds whose
+        revision starts with revision and whose build directory starts
+        with directory_prefix. Each dict contains the revision items
+        along with the build's directory and build_time.
+        """
+        columns = (['r.%s' % column for column in self.REVISION_COLUMNS] +
+                   ['b.directory', 'b.build_time'])
+        names = list(self.REVISION_COLUMNS) + ['directory', 'build_time']
+        try:
+            conn = self._conn()
+            rows = conn.execute(
+                'select %s from build_revisions r '
+                'join builds b on b.build_url = r.build_url '
+                'where substr(r.revision, 1, ?) = ? '
+                'and substr(b.directory, 1, ?) = ? '
+                'order by b.build_time' % ','.join(columns),
+                (len(revision), revision,
+                 len(directory_prefix), directory_prefix)).fetchall()
+            conn.close()
+        except sqlite3.Error:
+            logger.exception('Unable to query build index %s' % self.filename)
+            return []
+        return [dict(zip(names, row)) for row in rows]
+
+    def add_pushes(self, repo, pushes):
+        """Adds the list of (pushid, changeset, date) tuples from the
+        pushlog of repo to the index.
+        """
+        if not pushes:
+            return
+        try:
+            with self.lock:
+                conn = self._conn()
+                conn.executemany(
+                    'insert or replace into pushes '
+                    '(repo, pushid, changeset, date) values (?,?,?,?)',
+                    [(repo, pushid, changeset, date)
+                     for pushid, changeset, date in pushes])
+                conn.commit()
+                conn.close()
+        except sqlite3.Error:
+            logger.exception('Unable to update build index %s' %
+                             self.filename)
+
+    def get_pushid(self, repo, revision):
+        """Returns the id of the push to repo containing the changeset
+        which starts with revision or None if it is not in the index
+        or revision is ambiguous.
+        """
+        try:
+            conn = self._conn()
+            rows = conn.execute(
+                'select distinct pushid from pushes '
+                'where repo = ? and substr(changeset, 1, ?) = ?',
+                (repo, len(revision), revision)).fetchall()
+            conn.close()
+        except sqlite3.Error:
+            logger.exception('Unable to query build index %s' % self.filename)
+            return None
+        if len(rows) != 1:
+            return None
+        return rows[0][0]
+
+    def get_push_dates(self, repo, first_pushid, last_pushid):
+        """Returns a dict mapping the ids of the indexed pushes to repo
+        from first_pushid through last_pushid to their dates.
+        """
+        try:
+            conn = self._conn()
+            rows = conn.execute(
+                'select pushid, max(date) from pushes '
+                'where repo = ? and pushid between ? and ? '
+                'group by pushid',
+                (repo, first_pushid, last_pushid)).fetchall()
+            conn.close()
+        except sqlite3.Error:
+            logger.exception('Unable to query build index %s' % self.filename)
+            return {}
+        return dict(rows)
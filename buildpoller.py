@@ -0,0 +1,86 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import logging
+import threading
+import time
+
+logger = logging.getLogger('autophone.buildpoller')
+
+
+class BuildPoller(threading.Thread):
+    """Thread which periodically searches the build locations for new
+    builds and calls build_callback with the url of each build which
+    was not present when it was previously polled.
+
+    Each poll searches the builds from the last window seconds. The
+    directory listings are revalidated with conditional requests and
+    build directories already in the build index are not listed
+    again, so polls of an unchanged location are cheap.
+
+    The builds present when the poller starts are recorded without
+    calling build_callback.
+    """
+
+    POLL_INTERVAL = 300
+    POLL_WINDOW = 6 * 60 * 60
+    POLL_LOCATIONS = ['tinderbox']
+
+    def __init__(self, build_cache, build_callback,
+                 build_locations=POLL_LOCATIONS,
+                 interval=POLL_INTERVAL, window=POLL_WINDOW):
+        threading.Thread.__init__(self, name='BuildPoller')
+        self.daemon = True
+        self.build_cache = build_cache
+        self.build_callback = build_callback
+        self.build_locations = build_locations
+        self.interval = interval
+        self.window = window
+        # Maps the urls of the builds found to the time they were
+        # first found.
+        self.seen_builds = {}
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        logger.info('Polling %s for new builds every %d seconds.' %
+                    (self.build_locations, self.interval))
+        first_poll = True
+        while not self._stop_event.is_set():
+            try:
+                new_builds = self.poll()
+                if first_poll:
+                    logger.info('Found %d existing builds.' % len(new_builds))
+                else:
+                    for build_url in new_builds:
+                        logger.info('Found new build %s' % build_url)
+                        self.build_callback(build_url)
+                first_poll = False
+            except Exception:
+                logger.exception('Error polling for new builds.')
+            self._stop_event.wait(self.interval)
+
+    def poll(self):
+        """Returns the list of urls of the builds found in the build
+        locations which had not been seen before.
+        """
+        now = time.time()
+        end_time = datetime.datetime.fromtimestamp(now)
+        start_time = end_time - datetime.timedelta(seconds=self.window)
+        new_builds = []
+        for build_location in self.build_locations:
+            for build_url in self.build_cache.find_builds_by_time(
+                    start_time, end_time, build_location):
+                if build_url not in self.seen_builds:
+                    self.seen_builds[build_url] = now
+                    new_builds.append(build_url)
+        # Builds first seen more than a window ago are older than the
+        # start of the window and can no longer be found.
+        for build_url, seen_time in self.seen_builds.items():
+            if seen_time < now - self.window:
+                del self.seen_builds[build_url]
+        return new_builds
@@ -3,23 +3,34 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import ConfigParser
+import HTMLParser
+import Queue
+import StringIO
 import base64
+import collections
 import datetime
+import errno
+import fcntl
+import hashlib
+import htmlentitydefs
 import httplib
+import itertools
 import json
 import logging
 import math
 import os
 import re
 import shutil
+import sys
 import tempfile
+import threading
 import time
 import urllib
-import urllib2
 import urlparse
 import zipfile
 
-from bs4 import BeautifulSoup
+import buildindex
+import httpclient
 
 from build_dates import (TIMESTAMP, DIRECTORY_DATE, DIRECTORY_DATETIME,
                          parse_datetime, convert_datetime_to_string,
@@ -37,29 +48,645 @@ repo_urls = {
 
 urls_repos = dict([(url, repo) for repo, url in repo_urls.items()])
 
+URL_LINKS_CHUNK_SIZE = 16384
+FILE_SHA256_CHUNK_SIZE = 1024 * 1024
+
+# Directory of the BlobStore within the cache directory.
+BLOBS_DIR = 'blobs'
+
+# Directory of the CacheLock files within the cache directory.
+LOCKS_DIR = 'locks'
+
+# Crash reporter symbols zip file and the directory it is extracted
+# into within a cached build directory.
+SYMBOLS_ZIP = 'symbols.zip'
+SYMBOLS_DIR = 'symbols'
+
+# Top level directories of the tests package containing test suites,
+# which are only extracted when a test requires them.
+TESTS_SUITE_DIRECTORIES = ('mochitest', 'reftest', 'jsreftest', 'xpcshell',
+                           'jit-test', 'cppunittests', 'marionette',
+                           'web-platform', 'b2g')
+
+# Test suite directories required by each test, by test name prefix.
+TESTS_DIRECTORIES = (('robocoptest', ('mochitest',)),
+                     ('mochitest', ('mochitest',)),
+                     ('reftest', ('reftest',)),
+                     ('jsreftest', ('reftest', 'jsreftest')),
+                     ('crashtest', ('reftest',)))
+
+buildid_regex = re.compile(r'([\d]{14})$')
+
+def file_sha256(path):
+    """Returns the hex sha256 digest of the contents of the file path."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(FILE_SHA256_CHUNK_SIZE)
+            if not data:
+                break
+            sha256.update(data)
+    return sha256.hexdigest()
+
+def zip_is_valid(path):
+    """Returns True if the zip file path can be read and the CRCs of
+    its members match."""
+    try:
+        return zipfile.ZipFile(path).testzip() is None
+    except zipfile.BadZipfile:
+        return False
+
+class BlobStore(object):
+    """Content addressed store for the files extracted from zip files.
+
+    Each distinct file is written once to path/<sha256[:2]>/<sha256>
+    and hard linked into the directories it is extracted into, so the
+    files shared by the extracted tests of different builds occupy
+    disk space once. A blob whose only link is the one in the store is
+    no longer used by any build and is removed by collect_garbage().
+    """
+
+    # Members up to this size are hashed in memory so that blobs which
+    # already exist are not written at all.
+    MAX_IN_MEMORY_SIZE = 1024 * 1024
+    TMP_PREFIX = '.tmp'
+    # Age in seconds after which temporary files are assumed to have
+    # been abandoned.
+    TMP_EXPIRES = 3600
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def blob_path(self, sha256):
+        return os.path.join(self.path, sha256[:2], sha256)
+
+    def extract(self, zip_file, members, path):
+        """Extracts the named members of the ZipFile zip_file into the
+        directory path, linking each file to its blob. Returns the
+        number of bytes of the blobs written, and of the files copied
+        where hard links are not supported, as counted by
+        build_dir_size().
+        """
+        size = 0
+        for name in members:
+            dest = member_path(path, name)
+            if not dest:
+                continue
+            if name.endswith('/'):
+                if not os.path.isdir(dest):
+                    os.makedirs(dest)
+                continue
+            dest_dir = os.path.dirname(dest)
+            if not os.path.isdir(dest_dir):
+                os.makedirs(dest_dir)
+            info = zip_file.getinfo(name)
+            if info.file_size <= self.MAX_IN_MEMORY_SIZE:
+                data = zip_file.read(name)
+                sha256 = hashlib.sha256(data).hexdigest()
+                tmp_path = None
+            else:
+                data = None
+                sha256, tmp_path = self._write_tmp(zip_file, name)
+            if self._link(sha256, data, tmp_path, dest):
+                size += info.file_size
+        return size
+
+    def _write_tmp(self, zip_file, name):
+        """Writes the member to a temporary file in the store and returns
+        a tuple of its sha256 and the path of the temporary file."""
+        sha256 = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=self.TMP_PREFIX)
+        with os.fdopen(fd, 'wb') as tmp_file:
+            member = zip_file.open(name)
+            while True:
+                data = member.read(FILE_SHA256_CHUNK_SIZE)
+                if not data:
+                    break
+                sha256.update(data)
+                tmp_file.write(data)
+            member.close()
+        return sha256.hexdigest(), tmp_path
+
+    def _link(self, sha256, data, tmp_path, dest):
+        """Links dest to the blob sha256, creating the blob from data or
+        the temporary file tmp_path if it does not exist. Returns True
+        if the blob was created or dest is a copy of it."""
+        blob_path = self.blob_path(sha256)
+        created = False
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        while True:
+            try:
+                os.link(blob_path, dest)
+                break
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    # Hard links are not supported; fall back to a copy.
+                    logger.debug('BlobStore: unable to link %s: %s' %
+                                 (dest, e))
+                    shutil.copyfile(blob_path, dest)
+                    created = True
+                    break
+            # The blob does not exist yet.
+            if tmp_path is None:
+                fd, tmp_path = tempfile.mkstemp(dir=self.path,
+                                                prefix=self.TMP_PREFIX)
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    tmp_file.write(data)
+            blob_dir = os.path.dirname(blob_path)
+            if not os.path.isdir(blob_dir):
+                try:
+                    os.makedirs(blob_dir)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            os.rename(tmp_path, blob_path)
+            tmp_path = None
+            created = True
+        if tmp_path:
+            os.unlink(tmp_path)
+        return created
+
+    def collect_garbage(self):
+        """Removes the blobs which are not linked from any build and
+        abandoned temporary files. Returns the number of bytes freed.
+
+        A linked file does not record which blob it is linked to, so
+        every blob in the store is listed and stat()ed. The cost is
+        proportional to the number of distinct extracted files, and
+        it is paid once per eviction pass which evicts builds.
+        """
+        freed = 0
+        now = time.time()
+        for blob_dir in os.listdir(self.path):
+            blob_dir_path = os.path.join(self.path, blob_dir)
+            if blob_dir.startswith(self.TMP_PREFIX):
+                try:
+                    stat = os.stat(blob_dir_path)
+                    if stat.st_mtime < now - self.TMP_EXPIRES:
+                        os.unlink(blob_dir_path)
+                        freed += stat.st_size
+                except OSError:
+                    pass
+                continue
+            for blob in os.listdir(blob_dir_path):
+                blob_path = os.path.join(blob_dir_path, blob)
+                try:
+                    stat = os.stat(blob_path)
+                    if stat.st_nlink == 1:
+                        os.unlink(blob_path)
+                        freed += stat.st_size
+                except OSError:
+                    pass
+        logger.debug('BlobStore: freed %d bytes' % freed)
+        return freed
+
+
+def artifact_progress(progress, path):
+    """Returns a function for httpclient.retrieve which reports the
+    progress of downloading the file path to progress or None if
+    progress is None."""
+    if not progress:
+        return None
+    artifact = os.path.basename(path)
+    return lambda received, total: progress({'artifact': artifact,
+                                             'bytes': received,
+                                             'total': total})
+
+
+class CacheLock(object):
+    """Exclusive lock on the file path shared by the threads and
+    processes using the cache directory, such as several autophone
+    controllers and the build cache daemon on the same host.
+
+    The lock is held with flock(), so it is released by the operating
+    system if its process dies. The lock files are never removed,
+    since a process could otherwise lock a removed file while another
+    process locks its replacement.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lockfile = None
+
+    def acquire(self, blocking=True):
+        """Returns True once the lock is acquired or False if blocking
+        is False and another thread or process holds it."""
+        lockfile = open(self.path, 'a')
+        try:
+            fcntl.flock(lockfile.fileno(),
+                        fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except IOError, e:
+            lockfile.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self.lockfile = lockfile
+        return True
+
+    def release(self):
+        lockfile = self.lockfile
+        self.lockfile = None
+        # Closing the file releases the lock.
+        lockfile.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def build_lock(cache_build_dir):
+    """Returns the CacheLock held while the build in cache_build_dir is
+    fetched, evicted or has its tests extracted on demand."""
+    cache_dir, build_dir = os.path.split(os.path.normpath(cache_build_dir))
+    return CacheLock(os.path.join(cache_dir, LOCKS_DIR,
+                                  hashlib.sha1(build_dir).hexdigest()))
+
+
+def build_dir_size(path):
+    """Returns the number of bytes used by the files in the directory
+    path. The files with several links are the files linked to blobs
+    in the BlobStore, whose size is apportioned among the links from
+    the builds, excluding the blob store's own link, so that the
+    sizes of the builds sharing a blob add up to its size.
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                stat = os.lstat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            size += stat.st_size / max(stat.st_nlink - 1, 1)
+    return size
+
+
+def member_path(path, name):
+    """Returns the path which the zip member name is extracted to in
+    the directory path or None if the name is empty once absolute and
+    parent directory components are removed.
+    """
+    components = [component for component in name.split('/')
+                  if component not in ('', '.', '..')]
+    if not components:
+        return None
+    return os.path.join(path, *components)
+
+def symbols_path(cache_build_dir):
+    """Returns the location of the crash reporter symbols of the build
+    in cache_build_dir or None if it has no symbols.
+
+    The symbols directory is returned for builds cached with their
+    symbols extracted. Otherwise the file url of symbols.zip is
+    returned: the crash processing of the test harnesses retrieves and
+    extracts a symbols url only when it processes a minidump, so
+    builds which do not crash never have their symbols extracted.
+    """
+    symbols_dir = os.path.join(cache_build_dir, SYMBOLS_DIR)
+    if os.path.exists(symbols_dir):
+        return symbols_dir
+    symbols_zip_path = os.path.join(cache_build_dir, SYMBOLS_ZIP)
+    if not os.path.exists(symbols_zip_path):
+        return None
+    return 'file://' + urllib.pathname2url(os.path.abspath(symbols_zip_path))
+
+def tests_directories(test_name):
+    """Returns the list of the test suite directories of the tests
+    package required to run the test test_name.
+    """
+    test_name_lower = test_name.lower()
+    for prefix, directories in TESTS_DIRECTORIES:
+        if test_name_lower.startswith(prefix):
+            return list(directories)
+    return list(TESTS_SUITE_DIRECTORIES)
+
+def extract_tests(cache_build_dir, directories=None):
+    """Extracts top level entries of the tests package tests.zip in
+    cache_build_dir into its tests directory unless they have already
+    been extracted.
+
+    arguments:
+    cache_build_dir - build directory containing tests.zip.
+    directories     - list of the names of the top level directories
+                      to extract. If None, every top level entry other
+                      than the test suite directories is extracted.
+
+    returns: number of bytes added to the size of the build as
+             counted by build_dir_size(); the files of blobs already
+             in the blob store do not add to it.
+
+    Extraction is by whole top level directory, when a test which
+    requires it is about to run; the files of a directory are not
+    extracted individually as they are accessed.
+
+    Each entry is extracted into a temporary directory and renamed
+    into place, so several processes may extract the same build's
+    tests concurrently. The files are linked to the blob store shared
+    by the builds in the cache directory.
+    """
+    tests_zip_path = os.path.join(cache_build_dir, 'tests.zip')
+    tests_path = os.path.join(cache_build_dir, 'tests')
+    if not os.path.exists(tests_zip_path):
+        # Builds cached before the tests were extracted on demand and
+        # override build directories are already fully extracted.
+        return 0
+    tests_zipfile = zipfile.ZipFile(tests_zip_path)
+    try:
+        members = {}
+        for name in tests_zipfile.namelist():
+            members.setdefault(name.split('/')[0], []).append(name)
+        if directories is None:
+            entries = [entry for entry in members
+                       if entry not in TESTS_SUITE_DIRECTORIES]
+        else:
+            entries = [entry for entry in directories if entry in members]
+        entries = [entry for entry in entries
+                   if not os.path.exists(os.path.join(tests_path, entry))]
+        if not entries:
+            return 0
+        logger.debug('extract_tests: extracting %s into %s' %
+                     (entries, tests_path))
+        try:
+            os.makedirs(tests_path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        blob_store = BlobStore(os.path.join(os.path.dirname(cache_build_dir),
+                                            BLOBS_DIR))
+        tmpdir = tempfile.mkdtemp(dir=cache_build_dir, prefix='tests.')
+        size = 0
+        try:
+            for entry in entries:
+                size += blob_store.extract(tests_zipfile, members[entry],
+                                           tmpdir)
+                try:
+                    os.rename(os.path.join(tmpdir, entry),
+                              os.path.join(tests_path, entry))
+                except OSError:
+                    # Another process extracted it first.
+                    if not os.path.exists(os.path.join(tests_path, entry)):
+                        raise
+        finally:
+            shutil.rmtree(tmpdir)
+        return size
+    finally:
+        tests_zipfile.close()
+
+def parallel_map(func, items, max_threads=1):
+    """Return the list of results of calling func on each of items,
+    using up to max_threads threads to make the calls concurrently.
+
+    arguments:
+    func        - callable taking a single argument.
+    items       - iterable of arguments for func.
+    max_threads - maximum number of concurrent calls.
+
+    returns: list of results in the same order as items.
+
+    If any call raises an exception, the exception raised for the
+    earliest item is re-raised once all of the calls have completed.
+    """
+    items = list(items)
+    if max_threads <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    work_queue = Queue.Queue()
+    for index, item in enumerate(items):
+        work_queue.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = work_queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                errors.append((index, sys.exc_info()))
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(max_threads, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        errors.sort(key=lambda error: error[0])
+        exc_type, exc_value, exc_traceback = errors[0][1]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+
+Link = collections.namedtuple('Link', ['href', 'text'])
+
+
+class LinkParser(HTMLParser.HTMLParser):
+    """Incremental extractor of the links in a directory listing.
+
+    Feed the listing to the parser in chunks as it arrives; the
+    non-navigation links seen so far are available in self.links.
+    Links whose href is a sort query (starts with '?') or whose text
+    is 'Parent Directory' are skipped.
+    """
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.links = []
+        self._href = None
+        self._text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self._href = dict(attrs).get('href')
+            self._text = []
+
+    def handle_endtag(self, tag):
+        if tag != 'a' or self._href is None:
+            return
+        text = ''.join(self._text)
+        if not self._href.startswith('?') and text != 'Parent Directory':
+            self.links.append(Link(self._href, text))
+        self._href = None
+
+    def handle_data(self, data):
+        if self._href is not None:
+            self._text.append(data)
+
+    def handle_entityref(self, name):
+        if name in htmlentitydefs.name2codepoint:
+            self.handle_data(unichr(htmlentitydefs.name2codepoint[name]))
+        else:
+            self.handle_data('&%s;' % name)
+
+    def handle_charref(self, name):
+        try:
+            if name.lower().startswith('x'):
+                self.handle_data(unichr(int(name[1:], 16)))
+            else:
+                self.handle_data(unichr(int(name)))
+        except ValueError:
+            self.handle_data('&#%s;' % name)
+
+
+class ListingCache(object):
+    """Persistent cache of parsed directory listings keyed by url.
+
+    Each entry records the ETag and Last-Modified validators returned
+    with the listing along with its parsed links, so that an unchanged
+    listing can be revalidated with a conditional request and reused
+    without being downloaded or parsed again.
+
+    Entries which have not been used for EXPIRES seconds, such as the
+    listings of build directories whose builds have been added to the
+    build index, are removed by expire().
+    """
+
+    EXPIRES = 7 * 24 * 60 * 60
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def entry_path(self, url):
+        return os.path.join(self.cache_dir,
+                            '%s.json' % hashlib.sha1(url).hexdigest())
+
+    def get(self, url):
+        """Return the cached entry for url or None."""
+        try:
+            with open(self.entry_path(url)) as entry_file:
+                entry = json.loads(entry_file.read())
+        except (IOError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        try:
+            # Record the use of the entry for expire().
+            os.utime(self.entry_path(url), None)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, url, etag, last_modified, links):
+        """Store the links for url along with its validators. Listings
+        without validators can not be revalidated and are not stored.
+        """
+        if not etag and not last_modified:
+            return
+        entry = {'url': url,
+                 'etag': etag,
+                 'last_modified': last_modified,
+                 'links': links}
+        # Write to a temporary file then rename it over the entry so
+        # that concurrent readers never see a partial entry.
+        tmpf = tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False)
+        try:
+            tmpf.write(json.dumps(entry))
+            tmpf.close()
+            os.rename(tmpf.name, self.entry_path(url))
+        except (IOError, OSError):
+            logger.exception('Unable to cache listing for %s' % url)
+            if os.path.exists(tmpf.name):
+                os.unlink(tmpf.name)
+
+    def expire(self):
+        """Removes the entries not used for EXPIRES seconds. Returns
+        the number of entries removed."""
+        expires = time.time() - self.EXPIRES
+        removed = 0
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                if os.stat(path).st_mtime < expires:
+                    os.unlink(path)
+                    removed += 1
+            except OSError:
+                pass
+        logger.debug('ListingCache: removed %d entries' % removed)
+        return removed
+
+
 # lifted from mozregression:utils.py:urlLinks
-def url_links(url):
+def url_links(url, listing_cache=None):
     """Return list of all non-navigation links found in web page.
 
     arguments:
-    url - location of web page.
+    url           - location of web page.
+    listing_cache - optional ListingCache used to revalidate and store
+                    the links with conditional requests.
+
+    returns: list of Links.
 
-    returns: list of BeautifulSoup links.
+    The listing is parsed incrementally as it is read.
+    """
+    headers = {}
+    entry = None
+    if listing_cache:
+        entry = listing_cache.get(url)
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+    r = httpclient.get(url, headers=headers)
+    try:
+        if entry and r.status == httplib.NOT_MODIFIED:
+            logger.debug('url_links: %s not modified' % url)
+            return [Link(*link) for link in entry['links']]
+        if r.status != 200:
+            logger.warning("Unable to open url %s : %s" % (
+                url, httplib.responses.get(r.status, r.reason)))
+            return []
+
+        parser = LinkParser()
+        while True:
+            chunk = r.read(URL_LINKS_CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.feed(chunk)
+        parser.close()
+        links = parser.links
+        if listing_cache:
+            listing_cache.put(url,
+                              r.getheader('ETag'),
+                              r.getheader('Last-Modified'),
+                              links)
+    finally:
+        r.close()
+    return links
+
+def fetch_pushes(url):
+    """Returns the list of (pushid, changeset, date) tuples for each
+    changeset in the pushes returned by the json-pushes query url.
     """
-    r = urllib2.urlopen(url)
-    content = r.read()
-    if r.getcode() != 200:
-        logger.warning("Unable to open url %s : %s" % (
-            url, httplib.responses[r.getcode()]))
-        return []
-
-    soup = BeautifulSoup(content)
-    # do not return a generator but an array, so we can store it for later use
-    return [link for link in soup.findAll('a')
-            if not link.get('href').startswith('?') and
-            link.get_text() != 'Parent Directory']
-
-def get_revision_timestamps(repo, first_revision, last_revision):
+    pushlog = json.loads(httpclient.get(url).read())
+    pushes = []
+    for pushid, push in pushlog.items():
+        for changeset in push['changesets']:
+            pushes.append((int(pushid), changeset, push['date']))
+    return pushes
+
+def get_revision_timestamps(repo, first_revision, last_revision,
+                            build_index=None):
     """Returns a tuple containing timestamps for the revisions from
     the given repo.
 
@@ -69,36 +696,130 @@ def get_revision_timestamps(repo, first_revision, last_revision):
                       mozilla-inbound, fx-team
     first_revision  - string.
     last_revision - string.
+    build_index     - optional BuildIndex used to store the pushlog.
 
     returns: first_timestamp, last_timestamp.
 
     Note this will return the revisions after the fromchange up to and
     including the tochange.
+
+    If the build index contains every push from the one containing
+    first_revision through the one containing last_revision, the
+    timestamps are answered locally. Otherwise the range is fetched
+    from json-pushes and merged into the index.
     """
-    revisions = []
-    r = urllib2.urlopen('%sjson-pushes?fromchange=%s&tochange=%s' % (
+    if build_index:
+        first_pushid = build_index.get_pushid(repo, first_revision)
+        last_pushid = build_index.get_pushid(repo, last_revision)
+        if first_pushid is not None and last_pushid is not None:
+            dates = build_index.get_push_dates(repo, first_pushid + 1,
+                                               last_pushid).values()
+            if len(dates) == last_pushid - first_pushid:
+                logger.debug('get_revision_timestamps: %s %s %s from index' %
+                             (repo, first_revision, last_revision))
+                if not dates:
+                    return None, None
+                return min(dates), max(dates)
+
+    pushes = fetch_pushes('%sjson-pushes?fromchange=%s&tochange=%s' % (
         repo_urls[repo], first_revision, last_revision))
+    dates = [date for pushid, changeset, date in pushes]
 
-    pushlog = json.loads(r.read())
-    for pushid in sorted(pushlog.keys()):
-        push = pushlog[pushid]
-        revisions.append((push['changesets'][-1], push['date']))
+    if build_index:
+        # The range excludes the push containing first_revision which
+        # is needed to answer the same query locally.
+        if build_index.get_pushid(repo, first_revision) is None:
+            pushes += fetch_pushes('%sjson-pushes?changeset=%s' % (
+                repo_urls[repo], first_revision))
+        build_index.add_pushes(repo, pushes)
 
-    if not revisions:
+    if not dates:
         return None, None
-    revisions.sort(key=lambda r: r[1])
 
-    return revisions[0][1], revisions[-1][1]
+    return min(dates), max(dates)
+
+
+def get_revision_pushid(repo, revision, build_index=None):
+    """Returns the id of the push to repo which contains revision or
+    None if it can not be determined. The push is looked up in the
+    pushlog stored in the build index before querying json-pushes.
+    """
+    if build_index:
+        pushid = build_index.get_pushid(repo, revision)
+        if pushid is not None:
+            return pushid
+    pushes = fetch_pushes('%sjson-pushes?changeset=%s' % (
+        repo_urls[repo], revision))
+    if build_index:
+        build_index.add_pushes(repo, pushes)
+    pushids = set(pushid for pushid, changeset, date in pushes)
+    if len(pushids) != 1:
+        return None
+    return pushids.pop()
+
+def bisect_left(key, target, lo, hi):
+    """Returns the first index i in the range lo to hi for which
+    key(i) is not None and key(i) >= target, or hi if there is none.
+    key must be non-decreasing over the indexes for which it is not
+    None.
+    """
+    found = hi
+    while lo < hi:
+        mid = (lo + hi) // 2
+        # Skip over indexes without a key.
+        index = mid
+        while index < hi and key(index) is None:
+            index += 1
+        if index == hi:
+            hi = mid
+        elif key(index) >= target:
+            found = index
+            hi = mid
+        else:
+            lo = index + 1
+    return found
+
+def parse_build_txt(build_url, contents):
+    """Returns a dict with items build_url, buildid, repo_url and
+    revision parsed from the contents of a build's .txt file which
+    consists of the buildid followed by the url of the revision.
+    Items which can not be parsed are None.
+    """
+    build_revision = {'build_url': build_url,
+                      'buildid': None,
+                      'repo_url': None,
+                      'revision': None}
+    lines = contents.splitlines()
+    if len(lines) > 1 and buildid_regex.match(lines[0]):
+        build_revision['buildid'] = lines[0]
+        parts = lines[1].split('rev/')
+        if len(parts) == 2:
+            build_revision['repo_url'] = parts[0]
+            build_revision['revision'] = parts[1]
+    return build_revision
 
 
 class BuildLocation(object):
+
+    CRAWL_THREADS = 8
+    SEARCH_STRATEGIES = ('linear', 'bisect')
+    SEARCH_STRATEGY = 'linear'
+
     def __init__(self, repos, buildtypes,
-                 product, build_platforms, buildfile_ext):
+                 product, build_platforms, buildfile_ext,
+                 crawl_threads=CRAWL_THREADS, listing_cache=None,
+                 build_index=None, search_strategy=SEARCH_STRATEGY):
+        if search_strategy not in self.SEARCH_STRATEGIES:
+            raise Exception('Unsupported search strategy: %s' % search_strategy)
         self.repos = repos
         self.buildtypes = buildtypes
         self.product = product
         self.build_platforms = build_platforms
         self.buildfile_ext = buildfile_ext
+        self.crawl_threads = crawl_threads
+        self.listing_cache = listing_cache
+        self.build_index = build_index
+        self.search_strategy = search_strategy
         buildfile_pattern = self.product + '.*\.('
         for platform in self.build_platforms:
             if platform == 'android':
@@ -123,6 +844,8 @@ class BuildLocation(object):
                      'product: %s, '
                      'build_platforms: %s, '
                      'buildfile_ext: %s, '
+                     'crawl_threads: %s, '
+                     'search_strategy: %s, '
                      'pattern: %s, '
                      'buildfile_regex: %s, '
                      'build_regex: %s, '
@@ -132,11 +855,171 @@ class BuildLocation(object):
                          self.product,
                          self.build_platforms,
                          self.buildfile_ext,
+                         self.crawl_threads,
+                         self.search_strategy,
                          buildfile_pattern,
                          self.buildfile_regex.pattern,
                          self.build_regex.pattern,
                          self.buildtxt_regex.pattern))
 
+    def url_links(self, url):
+        """Returns the links found in the directory listing at url,
+        revalidating against the listing cache if there is one.
+        """
+        return url_links(url, self.listing_cache)
+
+    def build_directory_links(self, url):
+        """Returns the links found in the build directory at url or
+        None if the directory does not exist.
+        """
+        try:
+            return self.url_links(url)
+        except httpclient.HTTPError, e:
+            logger.debug('build_directory_links: %s' % e)
+            return None
+
+    def build_platform_from_filename(self, filename):
+        """Returns the build platform of the build file filename."""
+        for platform, build_platform in (('android-arm-armv6', 'android-armv6'),
+                                         ('android-i386', 'android-x86'),
+                                         ('android-arm', 'android')):
+            if platform in filename:
+                return build_platform
+        return None
+
+    def get_directory_builds(self, directories):
+        """Returns a dict mapping each build directory url which
+        contains a build to a dict describing the build with items
+        directory, build_url, repo, platform and build_time.
+
+        arguments:
+        directories - list of (directory url, repo, build time) tuples.
+
+        Directories already in the build index are answered from the
+        index. The remaining directories are listed concurrently and
+        the builds found in them are added to the index.
+        """
+        directory_builds = {}
+        if self.build_index:
+            directory_builds = self.build_index.get_builds(
+                [directory for directory, repo, build_time in directories])
+        new_directories = [(directory, repo, build_time)
+                           for directory, repo, build_time in directories
+                           if directory not in directory_builds]
+        logger.debug('get_directory_builds: %d indexed, %d new directories' %
+                     (len(directory_builds), len(new_directories)))
+        new_directory_links = parallel_map(
+            self.build_directory_links,
+            [directory for directory, repo, build_time in new_directories],
+            self.crawl_threads)
+
+        new_builds = []
+        for (directory, repo, build_time), links in zip(new_directories,
+                                                        new_directory_links):
+            for link in links or []:
+                filename = link.text
+                logger.debug('get_directory_builds: checking filename: %s' % filename)
+                if self.build_regex.match(filename):
+                    logger.debug('get_directory_builds: found filename: %s' % filename)
+                    build = {'directory': directory,
+                             'build_url': '%s%s' % (directory, filename),
+                             'repo': repo,
+                             'platform': self.build_platform_from_filename(filename),
+                             'build_time': buildindex.datetime_to_timestamp(build_time)}
+                    new_builds.append(build)
+                    directory_builds[directory] = build
+                    break
+        if self.build_index:
+            self.build_index.add_builds(new_builds)
+        return directory_builds
+
+    def build_txt_url(self, build_url):
+        """Returns the url of the .txt file describing the build."""
+        return '%s.txt' % build_url[:-len(self.buildfile_ext)]
+
+    def fetch_build_revision(self, build_url):
+        """Returns a dict describing the build's buildid, repo_url and
+        revision parsed from its .txt file or None if the file could
+        not be retrieved. Items which can not be parsed are None.
+        """
+        txturl = self.build_txt_url(build_url)
+        try:
+            contents = httpclient.get(txturl).read()
+        except httpclient.HTTPClientError, e:
+            logger.warning('fetch_build_revision: %s' % e)
+            return None
+        return parse_build_txt(build_url, contents)
+
+    def get_build_revisions(self, build_urls):
+        """Returns a dict mapping each of the build urls whose .txt
+        file could be retrieved to a dict with items build_url,
+        buildid, repo_url and revision.
+
+        The contents of a published .txt file never change, so the
+        revisions are answered from the build index where possible.
+        The remaining .txt files are fetched concurrently and recorded
+        in the index.
+        """
+        build_revisions = {}
+        if self.build_index:
+            build_revisions = self.build_index.get_build_revisions(build_urls)
+        new_build_urls = [build_url for build_url in build_urls
+                          if build_url not in build_revisions]
+        logger.debug('get_build_revisions: %d indexed, %d new builds' %
+                     (len(build_revisions), len(new_build_urls)))
+        new_build_revisions = [
+            build_revision for build_revision in parallel_map(
+                self.fetch_build_revision, new_build_urls, self.crawl_threads)
+            if build_revision]
+        for build_revision in new_build_revisions:
+            build_revisions[build_revision['build_url']] = build_revision
+        if self.build_index:
+            self.build_index.add_build_revisions(new_build_revisions)
+        return build_revisions
+
+    def build_directories_from_datetimestamps(self, repo, search_directory,
+                                              listed_directories,
+                                              datetimestamps):
+        """Returns the list of (directory url, repo, datetimestamp)
+        tuples of the build directories in search_directory for each
+        of the datetimestamps which appear in listed_directories.
+        """
+        directories = []
+        for datetimestamp in datetimestamps:
+            for directory_repo, directory_name in self.directory_names_from_datetimestamp(datetimestamp):
+
+                # Since Autophone requires returning builds
+                # for each of its supported platforms, arm,
+                # armv6 or x86, we need to search each to get
+                # all of the builds. That is why we don't
+                # terminate this loop when we find the first
+                # build which matches the ending revision.
+
+                if directory_name not in listed_directories:
+                    continue
+                logger.debug('build_directories_from_datetimestamps: '
+                             'datetimestamp: %s, repo: %s, '
+                             'search_directory: %s, directory_repo: %s, '
+                             'directory_name: %s' %
+                             (datetimestamp, repo, search_directory,
+                              directory_repo, directory_name))
+                directories.append(("%s%s/" % (search_directory, directory_name),
+                                    directory_repo or repo,
+                                    datetimestamp))
+        return directories
+
+    def get_directory_build_revisions(self, directories):
+        """Returns a tuple consisting of the dicts returned by
+        get_directory_builds for the directories and by
+        get_build_revisions for the builds found in them.
+        """
+        directory_builds = self.get_directory_builds(directories)
+        build_revisions = self.get_build_revisions(
+            [directory_builds[directory]['build_url']
+             for directory, directory_repo, build_time in directories
+             if directory in directory_builds])
+        return directory_builds, build_revisions
+
     def does_build_directory_contain_repo_name(self):
         """Returns True if the build directory name
         contains the repository name as a substring.
@@ -156,6 +1039,12 @@ class BuildLocation(object):
         """
         raise NotImplementedError()
 
+    def repo_from_directory_name(self, directory_name):
+        """Returns the repository parsed from the directory name or
+        None if the directory name does not contain the repository.
+        """
+        return None
+
     def directory_names_from_datetimestamp(self, datetimestamp):
         """A generator which returns the next directory name.
         """
@@ -193,14 +1082,23 @@ class BuildLocation(object):
         start_time = set_time_zone(start_time)
         end_time = set_time_zone(end_time)
 
-        builds = []
-
-        for directory_repo, directory in self.get_search_directories_by_time(start_time,
-                                                                             end_time):
-            logger.debug('Checking repo %s directory %s...' % (directory_repo, directory))
-            directory_links = url_links(directory)
+        # Fetch the listings of the search directories, then the
+        # listings of every new build directory within the time range,
+        # each wave concurrently, so that discovery costs a couple of
+        # round trips rather than one per directory.
+        search_directories = list(self.get_search_directories_by_time(start_time,
+                                                                      end_time))
+        logger.debug('Checking directories %s...' % search_directories)
+        search_directory_links = parallel_map(
+            self.url_links,
+            [directory for directory_repo, directory in search_directories],
+            self.crawl_threads)
+
+        build_directories = []
+        for (directory_repo, directory), directory_links in zip(search_directories,
+                                                                search_directory_links):
             for directory_link in directory_links:
-                directory_name = directory_link.get_text().rstrip('/')
+                directory_name = directory_link.text.rstrip('/')
                 directory_href = '%s%s/' % (directory, directory_name)
                 logger.debug('find_builds_by_time: directory: href: %s, name: %s' % (
                     directory_href, directory_name))
@@ -212,14 +1110,16 @@ class BuildLocation(object):
                 if build_time < start_time or build_time > end_time:
                     continue
 
-                build_links = url_links(directory_href)
-                for build_link in build_links:
-                    filename = build_link.get_text()
-                    logger.debug('find_builds_by_time: checking filename: %s' % filename)
-                    if self.build_regex.match(filename):
-                        logger.debug('find_builds_by_time: found filename: %s' % filename)
-                        builds.append('%s%s' % (directory_href, filename))
-                        break
+                build_directories.append(
+                    (directory_href,
+                     directory_repo or self.repo_from_directory_name(directory_name),
+                     build_time))
+
+        directory_builds = self.get_directory_builds(build_directories)
+        builds = [directory_builds[directory]['build_url']
+                  for directory, directory_repo, directory_time
+                  in build_directories
+                  if directory in directory_builds]
         if not builds:
             logger.error('No builds found.')
         return builds
@@ -229,14 +1129,19 @@ class BuildLocation(object):
                      (first_revision, last_revision))
 
         range = datetime.timedelta(hours=12)
-        buildid_regex = re.compile(r'([\d]{14})$')
         builds = []
 
-        for repo in self.repos:
-            first_timestamp, last_timestamp = get_revision_timestamps(
-                repo,
-                first_revision,
-                last_revision)
+        # Look up the revisions in each repo concurrently.
+        repo_timestamps = parallel_map(
+            lambda repo: get_revision_timestamps(repo,
+                                                 first_revision,
+                                                 last_revision,
+                                                 self.build_index),
+            self.repos,
+            self.crawl_threads)
+
+        for repo, (first_timestamp, last_timestamp) in zip(self.repos,
+                                                          repo_timestamps):
             first_datetime = convert_timestamp_to_date(first_timestamp)
             last_datetime = convert_timestamp_to_date(last_timestamp)
             logger.debug('find_builds_by_revision: repo %s, '
@@ -262,9 +1167,10 @@ class BuildLocation(object):
                 format = None
                 datetimestamps = []
 
-                for link in url_links(search_directory):
+                search_directory_links = self.url_links(search_directory)
+                for link in search_directory_links:
                     try:
-                        datetimestring = link.get('href').strip('/')
+                        datetimestring = link.href.strip('/')
                         if self.does_build_directory_contain_repo_name() and repo not in datetimestring:
                             logger.info('find_builds_by_revisions:'
                                         'skipping datetimestring: repo: %s, '
@@ -291,83 +1197,185 @@ class BuildLocation(object):
 
                 logger.debug('find_builds_by_revisions: datetimestamps: %s' % datetimestamps)
 
+                # Published build directories are immutable, so the
+                # builds of the first and last revisions recorded in the
+                # build index bound the datetimestamps to be searched.
+                # This is only done for Tinderbox search directories
+                # which contain the builds of a single repo and
+                # platform.
+                if search_directory_repo and self.build_index:
+                    first_builds = self.build_index.find_build_revisions(
+                        first_revision, search_directory)
+                    if first_builds:
+                        first_build_time = first_builds[0]['build_time']
+                        datetimestamps = [
+                            d for d in datetimestamps
+                            if buildindex.datetime_to_timestamp(d) >= first_build_time]
+                    last_builds = self.build_index.find_build_revisions(
+                        last_revision, search_directory)
+                    if last_builds:
+                        last_build_time = last_builds[0]['build_time']
+                        datetimestamps = [
+                            d for d in datetimestamps
+                            if buildindex.datetime_to_timestamp(d) <= last_build_time]
+                    logger.debug('find_builds_by_revision: %d datetimestamps '
+                                 'after index lookup' % len(datetimestamps))
+
+                # Only probe the build directories which actually
+                # appear in the search directory listing.
+                listed_directories = set(link.href.strip('/')
+                                         for link in search_directory_links)
+
+                if self.search_strategy == 'bisect':
+                    builds.extend(self.bisect_builds_by_revision(
+                        repo, first_revision, last_revision,
+                        search_directory, listed_directories,
+                        datetimestamps))
+                    continue
+
+                # Process the datetimestamps in batches so that the
+                # build directories and .txt files of each batch can
+                # be fetched concurrently.
                 start_time = None
                 end_time = None
-                for datetimestamp in datetimestamps:
-                    for directory_repo, directory_name in self.directory_names_from_datetimestamp(datetimestamp):
-
-                        # Since Autophone requires returning builds
-                        # for each of its supported platforms, arm,
-                        # armv6 or x86, we need to search each to get
-                        # all of the builds. That is why we don't
-                        # terminate this loop when we find the first
-                        # build which matches the ending revision.
-
-                        logger.debug('find_builds_by_revisions: '
-                                     'datetimestamp: %s, repo: %s, '
-                                     'search_directory_repo: %s, '
-                                     'search_directory: %s, directory_repo: %s, '
-                                     'directory_name: %s' %
-                                     (datetimestamp, repo, search_directory_repo,
-                                      search_directory, directory_repo,
-                                      directory_name))
-
-                        try:
-                            links = url_links("%s%s/" % (search_directory, directory_name))
-                        except urllib2.HTTPError:
-                            continue
-                        for link in links:
-                            href = link.get('href')
-                            match = self.buildtxt_regex.match(href)
-                            if match:
-                                txturl = "%s%s/%s" % (search_directory,
-                                                      directory_name, href)
-                                build_url = "%s%s/%s%s" % (search_directory,
-                                                         directory_name,
-                                                         match.group(1),
-                                                         self.buildfile_ext)
-                                logger.debug('find_builds_by_revisions: '
-                                             'found build: datetimestamp: %s, '
-                                             'repo: %s, search_directory_repo:%s,'
-                                             'search_directory: %s, '
-                                             'directory_repo: %s, '
-                                             'directory_name: %s, found build: %s'
-                                             % (datetimestamp, repo,
-                                             search_directory_repo,
-                                             search_directory, directory_repo,
-                                             directory_name, build_url))
-                                contents = urllib2.urlopen(txturl).read()
-                                lines = contents.splitlines()
-                                if len(lines) > 1 and buildid_regex.match(lines[0]):
-                                    buildid = lines[0]
-                                    parts = lines[1].split('rev/')
-                                    if len(parts) == 2:
-                                        if repo != urls_repos[parts[0]]:
-                                            logger.info('find_builds_by_revisions: '
-                                                        'skipping build: %s != %s'
-                                                        % (repo,
-                                                           urls_repos[parts[0]]))
-                                            continue
-                                        revision = parts[1]
-                                        if revision.startswith(first_revision):
-                                            start_time = convert_buildid_to_date(buildid)
-                                        elif revision.startswith(last_revision):
-                                            end_time = convert_buildid_to_date(buildid)
-                                    if start_time:
-                                        builds.append(build_url)
-                                        break
+                batch_size = max(1, self.crawl_threads)
+                for batch_start in xrange(0, len(datetimestamps), batch_size):
+                    directories = self.build_directories_from_datetimestamps(
+                        repo, search_directory, listed_directories,
+                        datetimestamps[batch_start:batch_start + batch_size])
+                    directory_builds, build_revisions = self.get_directory_build_revisions(
+                        directories)
+
+                    for datetimestamp, datetimestamp_directories in itertools.groupby(
+                            directories, lambda d: d[2]):
+                        for directory, directory_repo, build_time in datetimestamp_directories:
+                            if directory not in directory_builds:
+                                continue
+                            build_url = directory_builds[directory]['build_url']
+                            logger.debug('find_builds_by_revisions: '
+                                         'found build: datetimestamp: %s, '
+                                         'repo: %s, search_directory_repo:%s,'
+                                         'search_directory: %s, '
+                                         'directory_repo: %s, '
+                                         'directory: %s, found build: %s'
+                                         % (datetimestamp, repo,
+                                            search_directory_repo,
+                                            search_directory, directory_repo,
+                                            directory, build_url))
+                            build_revision = build_revisions.get(build_url)
+                            if not build_revision or not build_revision['buildid']:
+                                continue
+                            if build_revision['revision']:
+                                build_repo = urls_repos.get(build_revision['repo_url'])
+                                if repo != build_repo:
+                                    logger.info('find_builds_by_revisions: '
+                                                'skipping build: %s != %s'
+                                                % (repo, build_repo))
+                                    continue
+                                revision = build_revision['revision']
+                                buildid = build_revision['buildid']
+                                if revision.startswith(first_revision):
+                                    start_time = convert_buildid_to_date(buildid)
+                                elif revision.startswith(last_revision):
+                                    end_time = convert_buildid_to_date(buildid)
+                            if start_time:
+                                builds.append(build_url)
+                        if end_time:
+                            break
                     if end_time:
                         break
 
         return builds
 
+    def bisect_builds_by_revision(self, repo, first_revision, last_revision,
+                                  search_directory, listed_directories,
+                                  datetimestamps):
+        """Returns the builds in search_directory from the build of
+        first_revision through the build of last_revision.
+
+        Builds are assumed to be published in push order. The sorted
+        datetimestamps are bisected on the pushid of the revision of
+        their builds to find the first datetimestamp built from a push
+        no earlier than first_revision's and the first built from a
+        push later than last_revision's. Only O(log n) build
+        directories are checked to find these boundaries. Then only
+        the build directories between them are enumerated.
+        """
+        first_pushid = get_revision_pushid(repo, first_revision,
+                                           self.build_index)
+        last_pushid = get_revision_pushid(repo, last_revision,
+                                          self.build_index)
+        if first_pushid is None or last_pushid is None:
+            logger.warning('bisect_builds_by_revision: repo %s: unable to '
+                           'find the pushes of %s and %s' %
+                           (repo, first_revision, last_revision))
+            return []
+
+        pushids = {}
+
+        def datetimestamp_pushid(index):
+            """Returns the pushid of the revision built at
+            datetimestamps[index] or None if there is no build of repo
+            at that time.
+            """
+            if index not in pushids:
+                pushids[index] = None
+                directories = self.build_directories_from_datetimestamps(
+                    repo, search_directory, listed_directories,
+                    [datetimestamps[index]])
+                directory_builds, build_revisions = self.get_directory_build_revisions(
+                    directories)
+                for build_revision in build_revisions.values():
+                    if (build_revision['revision'] and
+                        urls_repos.get(build_revision['repo_url']) == repo):
+                        pushids[index] = get_revision_pushid(
+                            repo, build_revision['revision'], self.build_index)
+                        break
+                logger.debug('bisect_builds_by_revision: %s pushid %s' %
+                             (datetimestamps[index], pushids[index]))
+            return pushids[index]
+
+        start = bisect_left(datetimestamp_pushid, first_pushid,
+                            0, len(datetimestamps))
+        end = bisect_left(datetimestamp_pushid, last_pushid + 1,
+                          start, len(datetimestamps))
+        logger.debug('bisect_builds_by_revision: checked %d of %d '
+                     'datetimestamps, enumerating %d' %
+                     (len(pushids), len(datetimestamps), end - start))
+
+        directories = self.build_directories_from_datetimestamps(
+            repo, search_directory, listed_directories,
+            datetimestamps[start:end])
+        directory_builds, build_revisions = self.get_directory_build_revisions(
+            directories)
+        builds = []
+        for directory, directory_repo, build_time in directories:
+            if directory not in directory_builds:
+                continue
+            build_url = directory_builds[directory]['build_url']
+            build_revision = build_revisions.get(build_url)
+            if not build_revision or not build_revision['buildid']:
+                continue
+            if (build_revision['revision'] and
+                urls_repos.get(build_revision['repo_url']) != repo):
+                continue
+            builds.append(build_url)
+        return builds
+
 
 class Nightly(BuildLocation):
 
     def __init__(self, repos, buildtypes,
-                 product, build_platforms, buildfile_ext):
+                 product, build_platforms, buildfile_ext,
+                 crawl_threads=BuildLocation.CRAWL_THREADS,
+                 listing_cache=None, build_index=None,
+                 search_strategy=BuildLocation.SEARCH_STRATEGY):
         BuildLocation.__init__(self, repos, buildtypes,
-                               product, build_platforms, buildfile_ext)
+                               product, build_platforms, buildfile_ext,
+                               crawl_threads=crawl_threads,
+                               listing_cache=listing_cache,
+                               build_index=build_index,
+                               search_strategy=search_strategy)
         self.nightly_dirname_regexs = []
         for repo in repos:
             pattern = '(.*)-%s-(' % repo
@@ -408,6 +1416,12 @@ class Nightly(BuildLocation):
                      (directory_name, build_time))
         return build_time
 
+    def repo_from_directory_name(self, directory_name):
+        for repo, r in zip(self.repos, self.nightly_dirname_regexs):
+            if r.match(directory_name):
+                return repo
+        return None
+
     def directory_names_from_datetimestamp(self, datetimestamp):
         dates = [convert_datetime_to_string(datetimestamp, DIRECTORY_DATE), # only really needed for non mobile
                  convert_datetime_to_string(datetimestamp, DIRECTORY_DATETIME)]
@@ -422,9 +1436,16 @@ class Tinderbox(BuildLocation):
     main_http_url = 'http://ftp.mozilla.org/pub/mozilla.org/mobile/tinderbox-builds/'
 
     def __init__(self, repos, buildtypes,
-                 product, build_platforms, buildfile_ext):
+                 product, build_platforms, buildfile_ext,
+                 crawl_threads=BuildLocation.CRAWL_THREADS,
+                 listing_cache=None, build_index=None,
+                 search_strategy=BuildLocation.SEARCH_STRATEGY):
         BuildLocation.__init__(self, repos, buildtypes,
-                               product, build_platforms, buildfile_ext)
+                               product, build_platforms, buildfile_ext,
+                               crawl_threads=crawl_threads,
+                               listing_cache=listing_cache,
+                               build_index=build_index,
+                               search_strategy=search_strategy)
 
     def get_search_directories_by_time(self, start_time, end_time):
         logger.debug('Tinderbox:get_search_directories_by_time(%s, %s)' % (start_time, end_time))
@@ -455,17 +1476,90 @@ class BuildCacheException(Exception):
     pass
 
 
+class BuildCacheScrubber(threading.Thread):
+    """Thread which periodically verifies the contents of the build
+    cache with BuildCache.scrub().
+    """
+
+    def __init__(self, build_cache, interval=None):
+        threading.Thread.__init__(self, name='BuildCacheScrubber')
+        self.daemon = True
+        self.build_cache = build_cache
+        self.interval = interval or BuildCache.SCRUB_INTERVAL
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                corrupt = self.build_cache.scrub()
+                logger.debug('BuildCacheScrubber: %d corrupt files.' % corrupt)
+            except Exception:
+                logger.exception('Error scrubbing the build cache.')
+
+
+class BuildCacheEvictor(threading.Thread):
+    """Thread which evicts builds from the build cache with
+    BuildCache.clean_cache() whenever a build has been used and at
+    least every interval seconds.
+    """
+
+    def __init__(self, build_cache, interval=None):
+        threading.Thread.__init__(self, name='BuildCacheEvictor')
+        self.daemon = True
+        self.build_cache = build_cache
+        self.interval = interval or BuildCache.EVICT_INTERVAL
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        self.build_cache.evict_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.build_cache.evict_event.wait(self.interval)
+            self.build_cache.evict_event.clear()
+            if self._stop_event.is_set():
+                break
+            try:
+                evicted = self.build_cache.clean_cache()
+                if evicted:
+                    logger.debug('BuildCacheEvictor: evicted %d builds.' %
+                                 evicted)
+            except Exception:
+                logger.exception('Error cleaning the build cache.')
+
+
 class BuildCache(object):
 
     MAX_NUM_BUILDS = 20
     EXPIRE_AFTER_DAYS = 1
+    # Maximum number of bytes used by the cached builds; 0 is unlimited.
+    MAX_NUM_BYTES = 0
+    SCRUB_INTERVAL = 3600
+    EVICT_INTERVAL = 300
+    # Seconds between updates of the index from the cache directory.
+    REFRESH_INTERVAL = 300
+    MANIFEST = 'manifest.json'
+    # Default number of processes used by autophone to hash, verify
+    # and extract the downloaded files.
+    FETCH_PROCESSES = 2
+    EVICTED_PREFIX = '.evicted.'
 
     def __init__(self, repos, buildtypes,
                  product, build_platforms, buildfile_ext,
                  cache_dir='builds', override_build_dir=None,
                  enable_unittests=False,
                  build_cache_size=MAX_NUM_BUILDS,
-                 build_cache_expires=EXPIRE_AFTER_DAYS):
+                 build_cache_expires=EXPIRE_AFTER_DAYS,
+                 build_cache_max_bytes=MAX_NUM_BYTES,
+                 crawl_threads=BuildLocation.CRAWL_THREADS,
+                 search_strategy=BuildLocation.SEARCH_STRATEGY,
+                 pinned_build_urls=None,
+                 pool=None,
+                 load_index=True):
         self.repos = repos
         self.buildtypes = buildtypes
         self.product = product
@@ -489,22 +1583,85 @@ class BuildCache(object):
                                           override_build_dir)
         if not os.path.exists(self.cache_dir):
             os.mkdir(self.cache_dir)
+        self.listing_cache = ListingCache(os.path.join(self.cache_dir,
+                                                       'listings'))
+        self.build_index = buildindex.BuildIndex(os.path.join(self.cache_dir,
+                                                              'builds.sqlite'))
         self.build_cache_size = build_cache_size
         self.build_cache_expires = build_cache_expires
+        self.build_cache_max_bytes = build_cache_max_bytes
+        # Optional function returning the urls of builds which must
+        # not be evicted.
+        self.pinned_build_urls = pinned_build_urls
+        self.crawl_threads = crawl_threads
+        self.search_strategy = search_strategy
+        self.manifest_lock = threading.Lock()
+        self.blob_store = BlobStore(os.path.join(self.cache_dir, BLOBS_DIR))
+        self.locks_dir = os.path.join(self.cache_dir, LOCKS_DIR)
+        if not os.path.exists(self.locks_dir):
+            os.makedirs(self.locks_dir)
+        self.cache_index_lock = threading.Lock()
+        self.refreshed = time.time()
+        # Maps the paths of the build directories to their metadata, so
+        # that get() does not read it from disk.
+        self.metadata_index = {}
+        # Controllers using a build cache daemon only search for builds,
+        # so they do not load the indexes.
+        self.cache_index = {}
+        if load_index:
+            self.cache_index = self.load_cache_index()
+            self.metadata_index = self.load_metadata_index()
+        # Hashing, verifying and extracting downloaded files is done
+        # by a pool of processes so that it does not compete for the
+        # GIL with the rest of the controller; see call_in_pool(). The
+        # pool is created by the caller before it starts any threads,
+        # since the pool's processes are forked and would otherwise
+        # inherit locks held by those threads.
+        self.pool = pool
+        # Set when a build has been used; see BuildCacheEvictor.
+        self.evict_event = threading.Event()
+
+    def call_in_pool(self, func, *args):
+        """Returns the result of calling the module level function func
+        with args in one of the pool's processes, or in this process if
+        there is no pool. Exceptions raised by func are raised here.
+        """
+        if self.pool:
+            return self.pool.apply(func, args)
+        return func(*args)
+
+    def close(self):
+        """Stops the pool's processes."""
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
 
     def build_location(self, s):
         if 'nightly' in s:
             return Nightly(self.repos, self.buildtypes,
                            self.product, self.build_platforms,
-                           self.buildfile_ext)
+                           self.buildfile_ext,
+                           crawl_threads=self.crawl_threads,
+                           listing_cache=self.listing_cache,
+                           build_index=self.build_index,
+                           search_strategy=self.search_strategy)
         if 'tinderbox' in s:
             return Tinderbox(self.repos, self.buildtypes,
                              self.product, self.build_platforms,
-                             self.buildfile_ext)
+                             self.buildfile_ext,
+                             crawl_threads=self.crawl_threads,
+                             listing_cache=self.listing_cache,
+                             build_index=self.build_index,
+                             search_strategy=self.search_strategy)
         if 'inboundarchive' in s:
             return InboundArchive(self.repos, self.buildtypes,
                                   self.product, self.build_platforms,
-                                  self.buildfile_ext)
+                                  self.buildfile_ext,
+                                  crawl_threads=self.crawl_threads,
+                                  listing_cache=self.listing_cache,
+                                  build_index=self.build_index,
+                                  search_strategy=self.search_strategy)
         return None
 
     def find_latest_builds(self, build_location_name='nightly'):
@@ -531,7 +1688,8 @@ class BuildCache(object):
 
         return build_location.find_builds_by_revision(first_revision, last_revision)
 
-    def get(self, buildurl, force=False, enable_unittests=False):
+    def get(self, buildurl, force=False, enable_unittests=False,
+            progress=None):
         """Returns info on a cached build, fetching it if necessary.
         Returns a dict with a boolean 'success' item.
         If 'success' is False, the dict also contains an 'error' item holding a
@@ -539,167 +1697,598 @@ class BuildCache(object):
         If 'success' is True, the dict also contains a 'metadata' item, which is
         a dict of build metadata.  The path to the build is the
         'cache_build_dir' item, which is a directory containing build.apk,
-        symbols/, and, if self.enable_unittests is true, robocop.apk and tests/.
+        symbols.zip, and, if self.enable_unittests is true, robocop.apk,
+        tests.zip and tests/. Only the parts of tests.zip shared by the
+        test harnesses are extracted into tests/; see extract_tests().
+        The symbols are located with symbols_path().
         If not found, fetches them, assuming a standard file structure.
-        Cleans the cache before getting started.
+        The build is pinned in the cache while it is being fetched
+        and its build_lock() is held, so that the processes sharing
+        the cache directory fetch it once.
         If self.override_build_dir is set, 'cache_build_dir' is set to
         that value without verifying the contents nor fetching anything (though
-        it will still try to open build.apk to read in the metadata).
+        it will still try to open build.apk to read in the metadata),
+        and the metadata's 'override_build_dir' item is set to True.
         See BuildCache.build_metadata() for the other metadata items.
+        If progress is given, it is called with a dict with items
+        artifact, bytes and total as each file is downloaded.
         """
         if self.override_build_dir:
-            return {'success': True,
-                    'metadata': self.build_metadata(self.override_build_dir)}
+            metadata = self.build_metadata(self.override_build_dir)
+            if metadata:
+                # The override build directory is not in the cache and
+                # its tests are already extracted.
+                metadata = dict(metadata, override_build_dir=True)
+            return {'success': True, 'metadata': metadata}
         build_dir = base64.b64encode(buildurl)
-        self.clean_cache([build_dir])
+        self.pin_build(build_dir)
+        try:
+            with self.build_lock(build_dir):
+                return self._get(buildurl, build_dir, force,
+                                 enable_unittests, progress)
+        finally:
+            self.unpin_build(build_dir)
+
+    def _get(self, buildurl, build_dir, force, enable_unittests, progress):
         cache_build_dir = os.path.join(self.cache_dir, build_dir)
         build_path = os.path.join(cache_build_dir, 'build.apk')
         if not os.path.exists(cache_build_dir):
             os.makedirs(cache_build_dir)
 
-        # build
-        try:
-            download_build = (force or not os.path.exists(build_path) or
-                              zipfile.ZipFile(build_path).testzip() is not None)
-        except zipfile.BadZipfile:
-            download_build = True
-        if download_build:
-            # retrieve to temporary file then move over, so we don't end
-            # up with half a file if it aborts
-            tmpf = tempfile.NamedTemporaryFile(delete=False)
-            tmpf.close()
-            try:
-                urllib.urlretrieve(buildurl, tmpf.name)
-            except IOError:
-                os.unlink(tmpf.name)
-                err = 'IO Error retrieving build: %s.' % buildurl
-                logger.exception(err)
-                return {'success': False, 'error': err}
-            shutil.move(tmpf.name, build_path)
         file(os.path.join(cache_build_dir, 'lastused'), 'w')
 
-        # symbols
-        symbols_path = os.path.join(cache_build_dir, 'symbols')
-        if force or not os.path.exists(symbols_path):
-            tmpf = tempfile.NamedTemporaryFile(delete=False)
-            tmpf.close()
-            # XXX: assumes fixed buildurl-> symbols_url mapping
-            symbols_url = re.sub('.apk$', '.crashreporter-symbols.zip', buildurl)
-            try:
-                urllib.urlretrieve(symbols_url, tmpf.name)
-                symbols_zipfile = zipfile.ZipFile(tmpf.name)
-                symbols_zipfile.extractall(symbols_path)
-                symbols_zipfile.close()
-            except IOError, ioerror:
-                if '550 Failed to change directory' in str(ioerror):
-                    logger.info('No symbols found: %s.' % symbols_url)
-                else:
-                    logger.exception('IO Error retrieving symbols: %s.' % symbols_url)
-            except zipfile.BadZipfile:
-                logger.info('Ignoring zipfile.BadZipfile Error retrieving symbols: %s.' % symbols_url)
-                try:
-                    with open(tmpf.name, 'r') as badzipfile:
-                        logger.debug(badzipfile.read())
-                except:
-                    pass
-            os.unlink(tmpf.name)
+        # The build and its other artifacts are independent of each
+        # other, so they are fetched concurrently. Each fetch returns
+        # an error message or None if it succeeded.
+        fetches = [(self.fetch_build, buildurl, build_path, force, progress)]
+
+        # XXX: assumes fixed buildurl-> symbols_url mapping
+        symbols_url = re.sub('.apk$', '.crashreporter-symbols.zip', buildurl)
+        if force or not (
+                self.manifest_matches(cache_build_dir, SYMBOLS_ZIP) or
+                os.path.exists(os.path.join(cache_build_dir, SYMBOLS_DIR))):
+            fetches.append((self.fetch_symbols, symbols_url, cache_build_dir,
+                            force, progress))
 
         # tests
         if self.enable_unittests or enable_unittests:
-            tests_path = os.path.join(cache_build_dir, 'tests')
-            if force or not os.path.exists(tests_path):
-                tmpf = tempfile.NamedTemporaryFile(delete=False)
-                tmpf.close()
-                # XXX: assumes fixed buildurl-> tests_url mapping
-                tests_url = re.sub('.apk$', '.tests.zip', buildurl)
-                try:
-                    urllib.urlretrieve(tests_url, tmpf.name)
-                except IOError:
-                    os.unlink(tmpf.name)
-                    err = 'IO Error retrieving tests: %s.' % tests_url
-                    logger.exception(err)
-                    return {'success': False, 'error': err}
-                tests_zipfile = zipfile.ZipFile(tmpf.name)
-                tests_zipfile.extractall(tests_path)
-                tests_zipfile.close()
-                os.unlink(tmpf.name)
-                # XXX: assumes fixed buildurl-> robocop mapping
-                robocop_url = urlparse.urljoin(buildurl, 'robocop.apk')
-                robocop_path = os.path.join(cache_build_dir, 'robocop.apk')
-                tmpf = tempfile.NamedTemporaryFile(delete=False)
-                tmpf.close()
-                try:
-                    urllib.urlretrieve(robocop_url, tmpf.name)
-                except IOError:
-                    os.unlink(tmpf.name)
-                    err = 'IO Error retrieving robocop.apk: %s.' % robocop_url
-                    logger.exception(err)
-                    return {'success': False, 'error': err}
-                shutil.move(tmpf.name, robocop_path)
-                # XXX: assumes fixed buildurl-> fennec_ids.txt mapping
-                fennec_ids_url = urlparse.urljoin(buildurl, 'fennec_ids.txt')
-                fennec_ids_path = os.path.join(cache_build_dir, 'fennec_ids.txt')
-                tmpf = tempfile.NamedTemporaryFile(delete=False)
-                tmpf.close()
-                try:
-                    urllib.urlretrieve(fennec_ids_url, tmpf.name)
-                except IOError:
-                    os.unlink(tmpf.name)
-                    err = 'IO Error retrieving fennec_ids.txt: %s.' % \
-                        fennec_ids_url
-                    logger.exception(err)
-                    return {'success': False, 'error': err}
-                shutil.move(tmpf.name, fennec_ids_path)
+            # XXX: assumes fixed buildurl-> tests_url mapping
+            tests_url = re.sub('.apk$', '.tests.zip', buildurl)
+            if force or not self.manifest_matches(cache_build_dir, 'tests.zip'):
+                fetches.append((self.fetch_tests, tests_url, cache_build_dir,
+                                force, progress))
+            elif not self.complete_tests(cache_build_dir):
+                # The tests extracted from the corrupt tests.zip are
+                # replaced.
+                fetches.append((self.fetch_tests, tests_url, cache_build_dir,
+                                True, progress))
+            # XXX: assumes fixed buildurl-> robocop and fennec_ids.txt mapping
+            for filename in 'robocop.apk', 'fennec_ids.txt':
+                path = os.path.join(cache_build_dir, filename)
+                if force or not self.manifest_matches(cache_build_dir, filename):
+                    fetches.append((self.fetch_file,
+                                    urlparse.urljoin(buildurl, filename),
+                                    path, progress))
+
+        errors = [error for error in
+                  parallel_map(lambda fetch: fetch[0](*fetch[1:]),
+                               fetches, len(fetches))
+                  if error]
+        if errors:
+            return {'success': False, 'error': ' '.join(errors)}
 
         return {'success': True,
                 'metadata': self.build_metadata(cache_build_dir)}
 
-    def clean_cache(self, preserve=[]):
-        def lastused_path(d):
-            return os.path.join(self.cache_dir, d, 'lastused')
+    def read_manifest(self, cache_build_dir):
+        """Returns the manifest of the build directory, a dict mapping
+        the names of the files downloaded into it to dicts with items
+        url, size, mtime and sha256.
+        """
+        try:
+            with open(os.path.join(cache_build_dir, self.MANIFEST)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def update_manifest(self, cache_build_dir, filename, url):
+        """Records the size, modification time and sha256 of the
+        downloaded file in the manifest of the build directory.
+        """
+        path = os.path.join(cache_build_dir, filename)
+        stat = os.stat(path)
+        entry = {'url': url,
+                 'size': stat.st_size,
+                 'mtime': stat.st_mtime,
+                 'sha256': self.call_in_pool(file_sha256, path)}
+        with self.manifest_lock:
+            manifest = self.read_manifest(cache_build_dir)
+            self.add_build_size(cache_build_dir, entry['size'] -
+                                manifest.get(filename, {}).get('size', 0))
+            manifest[filename] = entry
+            self.write_manifest(cache_build_dir, manifest)
+
+    def write_manifest(self, cache_build_dir, manifest):
+        tmpf = tempfile.NamedTemporaryFile(dir=cache_build_dir, delete=False)
+        with tmpf:
+            json.dump(manifest, tmpf)
+        os.rename(tmpf.name, os.path.join(cache_build_dir, self.MANIFEST))
+
+    def set_tests_extracted(self, cache_build_dir):
+        """Records in the manifest entry of tests.zip that the parts of
+        it shared by the test harnesses have been extracted. The entry
+        is replaced, clearing the record, when tests.zip is downloaded
+        again."""
+        with self.manifest_lock:
+            manifest = self.read_manifest(cache_build_dir)
+            if 'tests.zip' in manifest:
+                manifest['tests.zip']['extracted'] = True
+                self.write_manifest(cache_build_dir, manifest)
+
+    def manifest_matches(self, cache_build_dir, filename):
+        """Returns True if the file's size and modification time
+        match those recorded in the manifest when it was downloaded.
+        """
+        entry = self.read_manifest(cache_build_dir).get(filename)
+        if not entry:
+            return False
+        try:
+            stat = os.stat(os.path.join(cache_build_dir, filename))
+        except OSError:
+            return False
+        return stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']
 
-        def keep_build(d):
-            if preserve and d in preserve:
-                # specifically keep this build
-                return True
-            if not os.path.exists(lastused_path(d)):
-                # probably not a build dir
-                return True
-            if ((datetime.datetime.now() -
-                 datetime.datetime.fromtimestamp(os.stat(lastused_path(d)).st_mtime) <=
-                 datetime.timedelta(days=self.build_cache_expires))):
-                # too new
+    def fetch_file(self, url, path, progress=None):
+        """Downloads url to path and records it in the manifest.
+        Returns an error message or None if the file was retrieved.
+
+        The download is written to a partial file next to path and
+        renamed over path once complete, so path never holds half a
+        file. An interrupted download is resumed by the next fetch.
+        """
+        try:
+            httpclient.retrieve(url, path,
+                                progress=artifact_progress(progress, path))
+        except (IOError, OSError):
+            err = 'IO Error retrieving %s: %s.' % (os.path.basename(path), url)
+            logger.exception(err)
+            return err
+        self.update_manifest(os.path.dirname(path), os.path.basename(path),
+                             url)
+        return None
+
+    def fetch_build(self, buildurl, build_path, force=False, progress=None):
+        """Downloads the build to build_path unless a valid build is
+        already present. Returns an error message or None.
+
+        A cached build is valid if it matches its manifest entry. The
+        contents are verified in the background by scrub().
+        """
+        cache_build_dir, filename = os.path.split(build_path)
+        if not force:
+            if self.manifest_matches(cache_build_dir, filename):
+                return None
+            if (os.path.exists(build_path) and
+                filename not in self.read_manifest(cache_build_dir)):
+                # Builds cached without a manifest are verified once.
+                if self.call_in_pool(zip_is_valid, build_path):
+                    self.update_manifest(cache_build_dir, filename, buildurl)
+                    return None
+        err = self.fetch_file(buildurl, build_path, progress)
+        if not err:
+            self.clear_build_metadata(cache_build_dir)
+        return err
+
+    def scrub(self):
+        """Verifies the sha256 of each file recorded in the manifests
+        of the cached builds and downloads any corrupt file again.
+        Returns the number of corrupt files found.
+        """
+        corrupt = 0
+        for build_dir in os.listdir(self.cache_dir):
+            cache_build_dir = os.path.join(self.cache_dir, build_dir)
+            for filename, entry in self.read_manifest(cache_build_dir).items():
+                path = os.path.join(cache_build_dir, filename)
+                try:
+                    if (os.path.getsize(path) == entry['size'] and
+                        self.call_in_pool(file_sha256, path) ==
+                        entry['sha256']):
+                        continue
+                except (IOError, OSError):
+                    if not os.path.exists(cache_build_dir):
+                        # The build was expired while being scrubbed.
+                        break
+                if self.refetch_corrupt_file(build_dir, filename, entry):
+                    corrupt += 1
+        return corrupt
+
+    def refetch_corrupt_file(self, build_dir, filename, entry):
+        """Downloads the corrupt file of the build again unless its
+        manifest entry has changed since it was verified. Returns True
+        if the file was still corrupt.
+
+        Like get(), the build is pinned and its build_lock() is held,
+        so that the file is not fetched concurrently nor evicted while
+        it is downloaded. The extracted tests are removed along with a
+        corrupt tests.zip, so that they are extracted from the new one.
+        """
+        cache_build_dir = os.path.join(self.cache_dir, build_dir)
+        path = os.path.join(cache_build_dir, filename)
+        self.pin_build(build_dir)
+        try:
+            with self.build_lock(build_dir):
+                if self.read_manifest(cache_build_dir).get(filename) != entry:
+                    # The file was downloaded again or the build was
+                    # evicted while being scrubbed.
+                    return False
+                logger.warning('scrub: %s is corrupt; downloading %s again.' %
+                               (path, entry['url']))
+                if filename == 'tests.zip':
+                    self.fetch_tests(entry['url'], cache_build_dir, force=True)
+                elif filename == 'build.apk':
+                    self.fetch_build(entry['url'], path, force=True)
+                else:
+                    self.fetch_file(entry['url'], path)
                 return True
+        finally:
+            self.unpin_build(build_dir)
+
+    def fetch_symbols(self, symbols_url, cache_build_dir, force=False,
+                      progress=None):
+        """Downloads the symbols zip file into cache_build_dir. It is
+        only extracted by the test harnesses when they need it; see
+        symbols_path(). Symbols are optional so errors are logged and
+        None is returned.
+        """
+        symbols_dir = os.path.join(cache_build_dir, SYMBOLS_DIR)
+        if force and os.path.exists(symbols_dir):
+            shutil.rmtree(symbols_dir)
+        try:
+            httpclient.retrieve(symbols_url,
+                                os.path.join(cache_build_dir, SYMBOLS_ZIP),
+                                progress=artifact_progress(progress,
+                                                           SYMBOLS_ZIP))
+        except IOError, ioerror:
+            if (getattr(ioerror, 'code', None) == httplib.NOT_FOUND or
+                '550 Failed to change directory' in str(ioerror)):
+                logger.info('No symbols found: %s.' % symbols_url)
+            else:
+                logger.exception('IO Error retrieving symbols: %s.' % symbols_url)
+            return None
+        self.update_manifest(cache_build_dir, SYMBOLS_ZIP, symbols_url)
+        return None
+
+    def fetch_tests(self, tests_url, cache_build_dir, force=False,
+                    progress=None):
+        """Downloads the tests package into cache_build_dir and
+        extracts the parts of it shared by the test harnesses. The
+        test suite directories are extracted on demand by
+        extract_tests(). Returns an error message or None.
+        """
+        tests_zip_path = os.path.join(cache_build_dir, 'tests.zip')
+        tests_path = os.path.join(cache_build_dir, 'tests')
+        err = self.fetch_file(tests_url, tests_zip_path, progress)
+        if err:
+            return err
+        if force and os.path.exists(tests_path):
+            shutil.rmtree(tests_path)
+            self.add_build_size(cache_build_dir, None)
+        try:
+            self.add_build_size(cache_build_dir,
+                                self.call_in_pool(extract_tests,
+                                                  cache_build_dir))
+        except zipfile.BadZipfile:
+            os.unlink(tests_zip_path)
+            err = 'Bad zip file retrieving tests: %s.' % tests_url
+            logger.exception(err)
+            return err
+        self.set_tests_extracted(cache_build_dir)
+        return None
+
+    def complete_tests(self, cache_build_dir):
+        """Extracts the parts of the downloaded tests package shared by
+        the test harnesses which are missing, such as when the process
+        died after tests.zip was downloaded. Returns False if tests.zip
+        is not a valid zip file.
+
+        The extraction is recorded in the manifest, so that a cache hit
+        only reads the manifest instead of tests.zip.
+        """
+        entry = self.read_manifest(cache_build_dir).get('tests.zip', {})
+        if entry.get('extracted'):
+            return True
+        try:
+            self.add_build_size(cache_build_dir,
+                                self.call_in_pool(extract_tests,
+                                                  cache_build_dir))
+        except zipfile.BadZipfile:
+            logger.exception('Bad zip file %s' %
+                             os.path.join(cache_build_dir, 'tests.zip'))
             return False
+        self.set_tests_extracted(cache_build_dir)
+        return True
 
-        builds = [(x, os.stat(lastused_path(x)).st_mtime) for x in
-                  os.listdir(self.cache_dir) if not keep_build(x)]
-        builds.sort(key=lambda x: x[1])
-        while len(builds) > self.build_cache_size:
-            b = builds.pop(0)[0]
-            logger.info('Expiring %s' % b)
-            shutil.rmtree(os.path.join(self.cache_dir, b))
+    def build_lock(self, build_dir):
+        """Returns the CacheLock held while the build is fetched or
+        evicted."""
+        return build_lock(os.path.join(self.cache_dir, build_dir))
 
-    def build_metadata(self, build_dir):
-        build_metadata_path = os.path.join(build_dir, 'metadata.json')
-        if os.path.exists(build_metadata_path):
+    def evict_lock(self):
+        """Returns the CacheLock held while builds are evicted."""
+        return CacheLock(os.path.join(self.locks_dir, 'evict'))
+
+    def load_cache_index(self):
+        """Returns the index of the builds in the cache directory, a
+        dict mapping the name of each build directory to a dict with
+        items size, lastused, measured and pinned.
+
+        size is the number of bytes used by the build, measured when
+        the build was last used before measured. pinned counts the
+        requests using the build which prevent it from being evicted.
+        """
+        cache_index = {}
+        evict_lock = self.evict_lock()
+        # Another process sharing the cache directory may be evicting.
+        evicting = not evict_lock.acquire(blocking=False)
+        for build_dir in os.listdir(self.cache_dir):
+            cache_build_dir = os.path.join(self.cache_dir, build_dir)
+            if build_dir.startswith(self.EVICTED_PREFIX):
+                if not evicting:
+                    # Left behind by an interrupted eviction.
+                    shutil.rmtree(cache_build_dir, ignore_errors=True)
+                continue
             try:
-                return json.loads(file(build_metadata_path).read())
-            except (ValueError, IOError):
-                pass
-        tmpdir = tempfile.mkdtemp()
+                lastused = os.stat(os.path.join(cache_build_dir,
+                                                'lastused')).st_mtime
+            except OSError:
+                # probably not a build dir
+                continue
+            cache_index[build_dir] = {'size': build_dir_size(cache_build_dir),
+                                      'lastused': lastused,
+                                      'measured': lastused,
+                                      'pinned': 0}
+        if not evicting:
+            evict_lock.release()
+        logger.debug('load_cache_index: %d builds, %d bytes' %
+                     (len(cache_index),
+                      sum(entry['size'] for entry in cache_index.values())))
+        return cache_index
+
+    def measure_builds(self):
+        """Measures the sizes of the builds used since they were last
+        measured. Builds being fetched are measured again next time."""
+        with self.cache_index_lock:
+            stale = [(build_dir, entry['lastused'])
+                     for build_dir, entry in self.cache_index.items()
+                     if entry['lastused'] > entry['measured']]
+        for build_dir, lastused in stale:
+            size = build_dir_size(os.path.join(self.cache_dir, build_dir))
+            with self.cache_index_lock:
+                entry = self.cache_index.get(build_dir)
+                if entry:
+                    entry['size'] = size
+                    if not entry['pinned']:
+                        entry['measured'] = lastused
+
+    def refresh_cache_index(self):
+        """Updates the index with the builds fetched, used and evicted
+        by the other processes sharing the cache directory, which are
+        recorded by the build directories and their lastused files.
+        """
+        with self.cache_index_lock:
+            build_dirs = set(self.cache_index)
+        build_dirs.update(os.listdir(self.cache_dir))
+        lastused = {}
+        for build_dir in build_dirs:
+            try:
+                lastused[build_dir] = os.stat(os.path.join(
+                    self.cache_dir, build_dir, 'lastused')).st_mtime
+            except OSError:
+                continue
+        with self.cache_index_lock:
+            for build_dir, entry in self.cache_index.items():
+                if build_dir not in lastused and not entry['pinned']:
+                    del self.cache_index[build_dir]
+                    self.metadata_index.pop(os.path.join(self.cache_dir,
+                                                         build_dir), None)
+            for build_dir in lastused:
+                entry = self.cache_index.setdefault(
+                    build_dir, {'size': 0, 'lastused': 0, 'measured': 0,
+                                'pinned': 0})
+                # Unmeasured builds are measured by clean_cache().
+                entry['lastused'] = max(entry['lastused'],
+                                        lastused[build_dir])
+
+    def add_build_size(self, cache_build_dir, size):
+        """Adds size bytes to the size of the build in the index, so
+        that it is kept up to date without measuring the build. If size
+        is None, the build's size is unknown and it is measured the
+        next time the index is refreshed.
+        """
+        build_dir = os.path.relpath(cache_build_dir, self.cache_dir)
+        with self.cache_index_lock:
+            entry = self.cache_index.get(build_dir)
+            if not entry:
+                return
+            if size is None:
+                entry['measured'] = 0
+            else:
+                entry['size'] += size
+
+    def pin_build(self, build_dir):
+        """Marks the build as used now and prevents it from being
+        evicted until unpin_build() is called."""
+        with self.cache_index_lock:
+            entry = self.cache_index.setdefault(
+                build_dir, {'size': 0, 'lastused': 0, 'measured': 0,
+                            'pinned': 0})
+            entry['lastused'] = time.time()
+            entry['pinned'] += 1
+
+    def unpin_build(self, build_dir):
+        with self.cache_index_lock:
+            self.cache_index[build_dir]['pinned'] -= 1
+        # The build may have grown, so check the cache's limits.
+        self.evict_event.set()
+
+    def clean_cache(self):
+        """Evicts the least recently used builds which are not pinned
+        until at most build_cache_size of the builds not used within
+        build_cache_expires days remain and, if build_cache_max_bytes
+        is set, the builds use at most build_cache_max_bytes bytes.
+        Returns the number of builds evicted.
+
+        Builds whose urls are returned by pinned_build_urls, such as
+        the builds with queued or running jobs, are pinned as well, so
+        that they are not downloaded again when a slower device
+        reaches them.
+
+        The sizes of the builds are updated as their files are fetched
+        and extracted. Every REFRESH_INTERVAL seconds, the index is
+        also updated from the cache directory and the builds used since
+        they were last measured are measured, since the test harnesses
+        extract parts of the tests package in other processes.
+
+        Builds being fetched by other processes sharing the cache
+        directory are skipped, and only one process evicts at a time.
+        """
+        with self.evict_lock():
+            return self._clean_cache()
+
+    def _clean_cache(self):
+        if time.time() - self.refreshed >= self.REFRESH_INTERVAL:
+            self.refreshed = time.time()
+            self.refresh_cache_index()
+            self.measure_builds()
+            self.listing_cache.expire()
+
+        pinned_build_dirs = set()
+        if self.pinned_build_urls:
+            try:
+                pinned_build_urls = self.pinned_build_urls()
+            except Exception:
+                # Evicting without knowing the pinned builds could
+                # evict the builds of pending jobs.
+                logger.exception('Unable to get the pinned builds; '
+                                 'skipping eviction.')
+                return 0
+            pinned_build_dirs = set(base64.b64encode(build_url) for build_url
+                                    in pinned_build_urls)
+
+        expires = time.time() - self.build_cache_expires * 24 * 60 * 60
+        evicted = []
+        with self.cache_index_lock:
+            lru = sorted((entry['lastused'], build_dir)
+                         for build_dir, entry in self.cache_index.items()
+                         if not entry['pinned'] and
+                         build_dir not in pinned_build_dirs)
+            num_expired = len([lastused for lastused, build_dir in lru
+                               if lastused < expires])
+            cache_bytes = sum(entry['size']
+                              for entry in self.cache_index.values())
+            for lastused, build_dir in lru:
+                if num_expired > self.build_cache_size:
+                    num_expired -= 1
+                elif not (self.build_cache_max_bytes and
+                          cache_bytes > self.build_cache_max_bytes):
+                    break
+                build_lock = self.build_lock(build_dir)
+                if not build_lock.acquire(blocking=False):
+                    logger.debug('Not expiring %s since it is being '
+                                 'fetched by another process.' % build_dir)
+                    continue
+                logger.info('Expiring %s' % build_dir)
+                cache_bytes -= self.cache_index.pop(build_dir)['size']
+                self.metadata_index.pop(os.path.join(self.cache_dir,
+                                                     build_dir), None)
+                # The build is moved aside while the index is locked so
+                # that a concurrent get() starts from an empty directory.
+                evicted_dir = tempfile.mkdtemp(dir=self.cache_dir,
+                                               prefix=self.EVICTED_PREFIX)
+                try:
+                    os.rename(os.path.join(self.cache_dir, build_dir),
+                              os.path.join(evicted_dir, 'build'))
+                except OSError, e:
+                    os.rmdir(evicted_dir)
+                    if e.errno == errno.ENOENT:
+                        logger.info('%s was already evicted.' % build_dir)
+                    else:
+                        logger.exception('Unable to evict %s' % build_dir)
+                    continue
+                finally:
+                    build_lock.release()
+                evicted.append(evicted_dir)
+        if (self.build_cache_max_bytes and
+            cache_bytes > self.build_cache_max_bytes):
+            logger.warning('The build cache uses %d bytes, more than its '
+                           'limit of %d bytes, since its remaining builds '
+                           'are pinned.' %
+                           (cache_bytes, self.build_cache_max_bytes))
+        for evicted_dir in evicted:
+            shutil.rmtree(evicted_dir)
+        if evicted:
+            # Remove the extracted files no longer linked from any build.
+            self.blob_store.collect_garbage()
+        return len(evicted)
+
+    def load_metadata_index(self):
+        """Returns a dict mapping the paths of the cached builds whose
+        metadata has been saved to their metadata."""
+        metadata_index = {}
+        for build_dir in self.cache_index:
+            cache_build_dir = os.path.join(self.cache_dir, build_dir)
+            metadata = self.read_build_metadata(cache_build_dir)
+            if metadata:
+                metadata_index[cache_build_dir] = metadata
+        return metadata_index
+
+    def read_build_metadata(self, build_dir):
+        """Returns the metadata saved in the build directory or None.
+
+        The saved cache_build_dir is replaced by build_dir, since it
+        may have been saved by a process with a different cache_dir,
+        such as autophone with the relative builds directory before a
+        build cache daemon was used.
+        """
+        try:
+            with open(os.path.join(build_dir, 'metadata.json')) as f:
+                metadata = json.load(f)
+        except (ValueError, IOError):
+            return None
+        metadata['cache_build_dir'] = build_dir
+        return metadata
+
+    def clear_build_metadata(self, build_dir):
+        """Forgets the metadata of the build, whose build.apk has been
+        downloaded again."""
+        with self.cache_index_lock:
+            self.metadata_index.pop(build_dir, None)
+        try:
+            os.unlink(os.path.join(build_dir, 'metadata.json'))
+        except OSError:
+            pass
+
+    def build_metadata(self, build_dir):
+        metadata = self.metadata_index.get(build_dir)
+        if metadata:
+            return metadata
+        metadata = self.read_build_metadata(build_dir)
+        if metadata:
+            with self.cache_index_lock:
+                self.metadata_index[build_dir] = metadata
+            return metadata
         try:
             build_path = os.path.join(build_dir, 'build.apk')
             apkfile = zipfile.ZipFile(build_path)
-            apkfile.extract('application.ini', tmpdir)
+            application_ini = apkfile.read('application.ini')
+            apkfile.close()
         except zipfile.BadZipfile:
             # we should have already tried to redownload bad zips, so treat
             # this as fatal.
             logger.error('%s is a bad apk; aborting job.' % build_path)
-            shutil.rmtree(tmpdir)
             return None
         cfg = ConfigParser.RawConfigParser()
-        cfg.read(os.path.join(tmpdir, 'application.ini'))
+        cfg.readfp(StringIO.StringIO(application_ini))
         rev = cfg.get('App', 'SourceStamp')
         ver = cfg.get('App', 'Version')
         repo = cfg.get('App', 'SourceRepository')
@@ -720,7 +2309,7 @@ class BuildCache(object):
                 break
         if not tree:
             raise BuildCacheException('build %s contains an unknown SourceRepository %s' %
-                                      (apkfile, repo))
+                                      (build_path, repo))
 
         metadata = {'cache_build_dir': build_dir,
                     'tree': tree,
@@ -730,6 +2319,8 @@ class BuildCache(object):
                     'androidprocname': procname,
                     'version': ver,
                     'bldtype': 'opt'}
-        shutil.rmtree(tmpdir)
-        file(build_metadata_path, 'w').write(json.dumps(metadata))
+        file(os.path.join(build_dir, 'metadata.json'),
+             'w').write(json.dumps(metadata))
+        with self.cache_index_lock:
+            self.metadata_index[build_dir] = metadata
         return metadata
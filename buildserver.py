@@ -2,22 +2,407 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import BaseHTTPServer
+import Queue
 import SocketServer
 import errno
+import itertools
 import json
+import logging
+import os
+import re
 import socket
 import threading
+import time
+import urllib
+import urlparse
+
+try:
+    # pysendfile provides zero-copy transfers of the artifacts.
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+import builds
+import httpclient
+from build_dates import parse_datetime, set_time_zone
 
 DEFAULT_PORT = 28008
 
+logger = logging.getLogger('autophone.buildserver')
+
+class FetchRequest(object):
+    """A build requested with the submit command.
+
+    The progress of the request is recorded as a list of event dicts,
+    each with a request_id item and either a queue_position item, the
+    number of requests for the same build ahead of it, or the
+    artifact, bytes and total items of a download. The last event has
+    a done item set to True and a result item holding the results of
+    BuildCache.get.
+    """
+
+    # Minimum number of seconds between the recorded progress events
+    # of a download.
+    PROGRESS_INTERVAL = 1
+
+    def __init__(self, request_id, build, force=False, enable_unittests=False):
+        self.request_id = request_id
+        self.build = build
+        self.force = force
+        self.enable_unittests = enable_unittests
+        self.events = []
+        self.finished = None
+        self.condition = threading.Condition()
+        self._progress_times = {}
+
+    def add_event(self, event):
+        with self.condition:
+            event['request_id'] = self.request_id
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def progress(self, event):
+        artifact = event.get('artifact')
+        if artifact and event['bytes'] != event['total']:
+            now = time.time()
+            with self.condition:
+                if (now - self._progress_times.get(artifact, 0) <
+                    self.PROGRESS_INTERVAL):
+                    return
+                self._progress_times[artifact] = now
+        self.add_event(event)
+
+    def finish(self, result):
+        self.add_event({'done': True, 'result': result})
+        self.finished = time.time()
+
+    def wait_events(self, start, timeout=None):
+        """Returns the events from index start, waiting up to timeout
+        seconds for one if there are none yet."""
+        with self.condition:
+            if len(self.events) <= start:
+                self.condition.wait(timeout)
+            return self.events[start:]
+
+    def status(self):
+        """Returns a dict describing the latest progress of the request
+        and its result if it has finished."""
+        status = {'request_id': self.request_id, 'done': False,
+                  'queue_position': None, 'progress': {}}
+        with self.condition:
+            for event in self.events:
+                if 'queue_position' in event:
+                    status['queue_position'] = event['queue_position']
+                elif 'artifact' in event:
+                    status['progress'][event['artifact']] = event
+                elif event.get('done'):
+                    status['done'] = True
+                    status['result'] = event['result']
+        return status
+
+
 class BuildCacheServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
 
     build_cache = None
-    cache_lock = threading.Lock()
+    # Base url of the BuildArtifactServer serving the cache, if any.
+    artifacts_url = None
+
+    # Maximum number of builds fetched concurrently by a warm up.
+    WARM_THREADS = 4
+    # Number of seconds finished requests and warm ups are kept for
+    # polling.
+    REQUEST_EXPIRES = 3600
+    # Number of seconds between the expirations of finished requests
+    # and warm ups.
+    EXPIRE_INTERVAL = 300
+    # Number of seconds a subscribe command waits for an event before
+    # sending a keepalive event.
+    KEEPALIVE_INTERVAL = 30
+    # Number of seconds after which the builds pinned by a controller
+    # are unpinned unless it pins them again; see pin().
+    PIN_EXPIRES = 600
+    REVISION_RE = re.compile(r'^[0-9a-fA-F]{1,40}$')
+
+    def __init__(self, *args, **kwargs):
+        SocketServer.TCPServer.__init__(self, *args, **kwargs)
+        # Builds are prefetched one at a time by a background thread.
+        self.prefetch_queue = Queue.Queue()
+        self.prefetch_pending = set()
+        self.prefetch_lock = threading.Lock()
+        self.prefetch_thread = threading.Thread(target=self.prefetch_loop,
+                                                name='BuildCachePrefetch')
+        self.prefetch_thread.daemon = True
+        self.prefetch_thread.start()
+        # Maps the id of each warm up to a dict describing its
+        # progress; see warm().
+        self.warmups = {}
+        self.warmups_lock = threading.Lock()
+        self.warm_ids = itertools.count(1)
+        # Maps each build being fetched to a list of its lock and the
+        # number of requests using the lock.
+        self.build_locks = {}
+        self.build_locks_lock = threading.Lock()
+        # Maps the ids of submitted requests to their FetchRequests.
+        self.requests = {}
+        self.requests_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        # Maps the ids of the controllers to the time they last pinned
+        # builds and the urls of the builds.
+        self.pins = {}
+        self.pins_lock = threading.Lock()
+        self.expire_thread = threading.Thread(target=self.expire_loop,
+                                              name='BuildCacheExpire')
+        self.expire_thread.daemon = True
+        self.expire_thread.start()
+
+    def fetch(self, build, force=False, enable_unittests=False,
+              progress=None):
+        """Returns the results of BuildCache.get for the build.
+
+        Requests for the same build are serialized, so concurrent
+        requests wait for a single download and then find the build
+        in the cache, while requests for other builds proceed in
+        parallel. BuildCache.get pins the build so it is not evicted
+        while it is being fetched.
+
+        If progress is given, it is called with a dict with the
+        request's queue_position when it is queued and started and
+        with the progress of each download; see BuildCache.get.
+        """
+        with self.build_locks_lock:
+            build_lock = self.build_locks.setdefault(build,
+                                                     [threading.Lock(), 0])
+            queue_position = build_lock[1]
+            build_lock[1] += 1
+        if progress:
+            progress({'queue_position': queue_position})
+        try:
+            with build_lock[0]:
+                if progress and queue_position:
+                    progress({'queue_position': 0})
+                results = self.build_cache.get(build, force, enable_unittests,
+                                               progress)
+            if self.artifacts_url and results['success']:
+                metadata = dict(results['metadata'])
+                metadata['artifacts_url'] = artifacts_url(
+                    self.artifacts_url, self.build_cache.cache_dir,
+                    metadata['cache_build_dir'])
+                results = dict(results, metadata=metadata)
+            return results
+        finally:
+            with self.build_locks_lock:
+                build_lock[1] -= 1
+                if not build_lock[1]:
+                    del self.build_locks[build]
+
+    def submit(self, build, force=False, enable_unittests=False):
+        """Starts fetching the build in the background and returns the
+        id of its FetchRequest."""
+        with self.requests_lock:
+            request = FetchRequest(self.request_ids.next(), build, force,
+                                   enable_unittests)
+            self.requests[request.request_id] = request
+        thread = threading.Thread(target=self.run_request,
+                                  name='BuildCacheRequest-%d' %
+                                  request.request_id,
+                                  args=(request,))
+        thread.daemon = True
+        thread.start()
+        return request.request_id
+
+    def run_request(self, request):
+        try:
+            result = self.fetch(request.build, request.force,
+                                request.enable_unittests, request.progress)
+        except Exception:
+            logger.exception('Error fetching %s' % request.build)
+            result = {'success': False,
+                      'error': 'Exception fetching %s' % request.build}
+        request.finish(result)
+
+    def find_request(self, request_id):
+        with self.requests_lock:
+            return self.requests.get(request_id)
+
+    def expire_requests(self):
+        """Forgets the requests which finished more than
+        REQUEST_EXPIRES seconds ago."""
+        expires = time.time() - self.REQUEST_EXPIRES
+        with self.requests_lock:
+            for request_id, request in self.requests.items():
+                if request.finished and request.finished < expires:
+                    del self.requests[request_id]
+
+    def expire_loop(self):
+        while True:
+            time.sleep(self.EXPIRE_INTERVAL)
+            try:
+                self.expire_requests()
+                self.expire_warmups()
+            except Exception:
+                logger.exception('Error expiring requests')
+
+    def pin(self, controller, build_urls):
+        """Replaces the urls of the builds pinned by the controller,
+        such as the builds of its queued and running jobs, so that
+        they are not evicted from the cache.
+
+        Controllers pin their builds again at least every
+        PIN_EXPIRES seconds. The builds of a controller which has not,
+        for example because it has exited, are no longer pinned.
+        """
+        with self.pins_lock:
+            if build_urls:
+                self.pins[controller] = (time.time(), set(build_urls))
+            else:
+                self.pins.pop(controller, None)
+
+    def pinned_build_urls(self):
+        """Returns the urls of the builds pinned by the controllers;
+        used as the pinned_build_urls of the BuildCache."""
+        expires = time.time() - self.PIN_EXPIRES
+        build_urls = set()
+        with self.pins_lock:
+            for controller, (pinned, controller_build_urls) in \
+                    self.pins.items():
+                if pinned < expires:
+                    del self.pins[controller]
+                else:
+                    build_urls.update(controller_build_urls)
+        return build_urls
+
+    def prefetch(self, build, enable_unittests=False):
+        """Queues the build to be fetched into the cache in the
+        background unless it is already queued."""
+        with self.prefetch_lock:
+            if (build, enable_unittests) in self.prefetch_pending:
+                return
+            self.prefetch_pending.add((build, enable_unittests))
+        self.prefetch_queue.put((build, enable_unittests))
+
+    def prefetch_loop(self):
+        while True:
+            build, enable_unittests = self.prefetch_queue.get()
+            try:
+                logger.info('Prefetching %s' % build)
+                results = self.fetch(build, False, enable_unittests)
+                if not results['success']:
+                    logger.warning('Errors occurred prefetching %s: %s' %
+                                   (build, results['error']))
+            except Exception:
+                logger.exception('Error prefetching %s' % build)
+            finally:
+                with self.prefetch_lock:
+                    self.prefetch_pending.discard((build, enable_unittests))
+
+    def warm(self, search, build_location, first, last,
+             enable_unittests=False):
+        """Starts fetching the builds in build_location from first
+        through last into the cache in the background and returns the
+        id of the warm up.
+
+        arguments:
+        search         - 'revision' if first and last are revisions or
+                         'time' if they are date/datetime strings.
+        build_location - nightly, tinderbox or inboundarchive.
+
+        The progress of the warm up is described by a dict with items
+        state (searching, fetching, done or error), builds, fetched,
+        failed and finished, the time the warm up finished or None;
+        see warm_status().
+
+        Raises ValueError if the arguments are invalid.
+        """
+        if not self.build_cache.build_location(build_location):
+            raise ValueError('Unsupported build location %s' %
+                             build_location)
+        if search == 'revision':
+            if not (self.REVISION_RE.match(first) and
+                    self.REVISION_RE.match(last)):
+                raise ValueError('Invalid revisions %s %s' % (first, last))
+        elif search == 'time':
+            first = set_time_zone(parse_datetime(first)[1])
+            last = set_time_zone(parse_datetime(last)[1])
+        else:
+            raise ValueError('Invalid search %s' % search)
+        with self.warmups_lock:
+            warm_id = self.warm_ids.next()
+            self.warmups[warm_id] = {'state': 'searching', 'builds': 0,
+                                     'fetched': 0, 'failed': 0,
+                                     'finished': None}
+        thread = threading.Thread(target=self.warm_builds,
+                                  name='BuildCacheWarm-%d' % warm_id,
+                                  args=(warm_id, search, build_location,
+                                        first, last, enable_unittests))
+        thread.daemon = True
+        thread.start()
+        return warm_id
+
+    def warm_status(self, warm_id):
+        with self.warmups_lock:
+            return dict(self.warmups[warm_id])
+
+    def expire_warmups(self):
+        """Forgets the warm ups which finished more than
+        REQUEST_EXPIRES seconds ago."""
+        expires = time.time() - self.REQUEST_EXPIRES
+        with self.warmups_lock:
+            for warm_id, status in self.warmups.items():
+                if status['finished'] and status['finished'] < expires:
+                    del self.warmups[warm_id]
+
+    def warm_builds(self, warm_id, search, build_location, first, last,
+                    enable_unittests):
+        status = self.warmups[warm_id]
+        try:
+            if search == 'revision':
+                build_urls = self.build_cache.find_builds_by_revision(
+                    first, last, build_location)
+            else:
+                build_urls = self.build_cache.find_builds_by_time(
+                    first, last, build_location)
+            logger.info('Warm up %d: fetching %d builds.' %
+                        (warm_id, len(build_urls)))
+            with self.warmups_lock:
+                status['builds'] = len(build_urls)
+                status['state'] = 'fetching'
+
+            def warm_build(build):
+                try:
+                    success = self.fetch(build, False,
+                                         enable_unittests)['success']
+                except Exception:
+                    logger.exception('Error warming %s' % build)
+                    success = False
+                with self.warmups_lock:
+                    status['fetched' if success else 'failed'] += 1
+                    logger.info('Warm up %d: fetched %d, failed %d of %d '
+                                'builds.' % (warm_id, status['fetched'],
+                                             status['failed'],
+                                             status['builds']))
+
+            builds.parallel_map(warm_build, build_urls, self.WARM_THREADS)
+            with self.warmups_lock:
+                status['state'] = 'done'
+        except Exception:
+            logger.exception('Error in warm up %d' % warm_id)
+            with self.warmups_lock:
+                status['state'] = 'error'
+        finally:
+            with self.warmups_lock:
+                status['finished'] = time.time()
 
 
 class BuildCacheHandler(SocketServer.BaseRequestHandler):
 
+    # Usage of the commands which require arguments and are otherwise
+    # taken for build urls.
+    USAGE = {
+        'pin': 'pin <controller> [<build_url> ...]',
+        'submit': 'submit <build_url> [force] [enable_unittests]',
+    }
+
     def handle(self):
         buffer = ''
         while True:
@@ -41,18 +426,276 @@ class BuildCacheHandler(SocketServer.BaseRequestHandler):
                 if line == 'quit' or line == 'exit':
                     return
                 cmds = line.split()
+                if cmds[0] == 'warm':
+                    self.request.send(json.dumps(self.warm(cmds[1:])) + '\n')
+                    continue
+                if cmds[0] in ('poll', 'subscribe'):
+                    self.poll(cmds[0], cmds[1:])
+                    continue
+                if cmds[0] in self.USAGE and len(cmds) < 2:
+                    self.request.send(json.dumps(
+                        {'success': False,
+                         'error': 'usage: %s' % self.USAGE[cmds[0]]}) + '\n')
+                    continue
+                if cmds[0] == 'pin':
+                    self.server.pin(cmds[1], cmds[2:])
+                    self.request.send(json.dumps({'success': True}) + '\n')
+                    continue
+                submit = cmds[0] == 'submit'
+                if submit:
+                    cmds = cmds[1:]
                 build = cmds[0]
-                force = False
-                enable_unittests = False
-                cmds = cmds[1:]
-                for cmd in cmds:
-                    force = (cmd.lower() == 'force')
-                    enable_unittests = (cmd.lower() == 'enable_unittests')
-                self.server.cache_lock.acquire()
-                results = self.server.build_cache.get(build, force, enable_unittests)
-                self.server.cache_lock.release()
+                cmds = [cmd.lower() for cmd in cmds[1:]]
+                force = 'force' in cmds
+                enable_unittests = 'enable_unittests' in cmds
+                if submit:
+                    request_id = self.server.submit(build, force,
+                                                    enable_unittests)
+                    self.request.send(json.dumps(
+                        {'success': True, 'request_id': request_id}) + '\n')
+                    continue
+                if 'prefetch' in cmds:
+                    self.server.prefetch(build, enable_unittests)
+                    self.request.send(json.dumps({'success': True}) + '\n')
+                    continue
+                results = self.server.fetch(build, force, enable_unittests)
                 self.request.send(json.dumps(results) + '\n')
 
+    def poll(self, cmd, args):
+        """Handles the asynchronous request commands:
+
+        poll <request_id>
+            returns the status of the request; see FetchRequest.status.
+        subscribe <request_id>
+            sends each of the request's events, one per line, until
+            the event with done set to True. An event with keepalive
+            set to True is sent whenever no event has been recorded
+            for KEEPALIVE_INTERVAL seconds, so that the subscription
+            ends if the client has gone away.
+        """
+        try:
+            request = self.server.find_request(int(args[0]))
+        except (IndexError, ValueError):
+            request = None
+        if not request:
+            self.request.send(json.dumps(
+                {'success': False,
+                 'error': 'Unknown request: %s' % ' '.join(args)}) + '\n')
+            return
+        if cmd == 'poll':
+            status = request.status()
+            status['success'] = True
+            self.request.send(json.dumps(status) + '\n')
+            return
+        start = 0
+        while True:
+            events = request.wait_events(start,
+                                         self.server.KEEPALIVE_INTERVAL)
+            start += len(events)
+            if not events:
+                events = [{'request_id': request.request_id,
+                           'keepalive': True}]
+            for event in events:
+                try:
+                    self.request.sendall(json.dumps(event) + '\n')
+                except socket.error, e:
+                    logger.debug('Subscriber of request %d went away: %s' %
+                                 (request.request_id, e))
+                    return
+                if event.get('done'):
+                    return
+
+    def warm(self, args):
+        """Handles the warm commands:
+
+        warm revision|time <build_location> <first> <last> [enable_unittests]
+            starts a warm up and returns its warm_id.
+        warm status <warm_id>
+            returns the progress of the warm up.
+        """
+        try:
+            if args[0] == 'status':
+                status = self.server.warm_status(int(args[1]))
+                status['success'] = True
+                return status
+            if args[0] in ('revision', 'time') and len(args) in (4, 5):
+                warm_id = self.server.warm(
+                    args[0], args[1], args[2], args[3],
+                    enable_unittests='enable_unittests' in args[4:])
+                return {'success': True, 'warm_id': warm_id}
+        except ValueError, e:
+            return {'success': False,
+                    'error': 'Invalid warm command: %s: %s' %
+                    (' '.join(args), e)}
+        except (IndexError, KeyError):
+            pass
+        return {'success': False,
+                'error': 'Invalid warm command: %s' % ' '.join(args)}
+
+
+def artifacts_host(address, ipaddr):
+    """Returns the host used in the urls of a BuildArtifactServer
+    listening on address: address itself, or ipaddr, the address of
+    this host, if it listens on all interfaces."""
+    if address in ('', '0.0.0.0'):
+        return ipaddr
+    return address
+
+
+def artifacts_url(base_url, cache_dir, cache_build_dir):
+    """Returns the url of the build directory cache_build_dir on the
+    BuildArtifactServer at base_url serving cache_dir."""
+    return urlparse.urljoin(base_url, urllib.quote(
+        os.path.relpath(cache_build_dir, cache_dir)) + '/')
+
+
+def parse_range(header, size):
+    """Returns the (first, last) byte positions of the Range header
+    for a file of size bytes, None if the header is absent or not
+    supported, in which case the whole file is sent, or False if the
+    range can not be satisfied.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    spec = header[len('bytes='):].strip()
+    if ',' in spec:
+        # Multiple ranges are not supported.
+        return None
+    first, sep, last = spec.partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:
+            # The last bytes of the file.
+            suffix_length = int(last)
+            if suffix_length <= 0:
+                return False
+            first = max(0, size - suffix_length)
+            last = size - 1
+        else:
+            first = int(first)
+            last = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if first >= size or first > last:
+        return False
+    return first, last
+
+
+class BuildArtifactServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    """HTTP server for the files of the builds in the build cache, so
+    that devices, harnesses and other hosts can retrieve them directly.
+    The build directories are served at their paths relative to the
+    cache directory; see artifacts_url().
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, cache_dir):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address,
+                                           BuildArtifactHandler)
+        self.cache_dir = os.path.realpath(cache_dir)
+
+
+class BuildArtifactHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    COPY_CHUNK_SIZE = 1024 * 1024
+    # Files in the cache directory which are not build artifacts.
+    PRIVATE = (builds.BLOBS_DIR, builds.LOCKS_DIR, 'listings', 'builds.sqlite')
+
+    def do_HEAD(self):
+        self.send_artifact(head=True)
+
+    def do_GET(self):
+        self.send_artifact()
+
+    def log_message(self, format, *args):
+        logger.debug('BuildArtifactHandler: %s %s' % (self.client_address[0],
+                                                      format % args))
+
+    def artifact_path(self):
+        """Returns the path of the requested file or None if it is not
+        a complete file of a cached build."""
+        path = urllib.unquote(urlparse.urlsplit(self.path).path)
+        path = os.path.realpath(os.path.join(self.server.cache_dir,
+                                             path.lstrip('/')))
+        relpath = os.path.relpath(path, self.server.cache_dir)
+        top_dir = relpath.split(os.sep)[0]
+        if (relpath.startswith(os.pardir) or relpath.startswith('.') or
+            top_dir.startswith(builds.BuildCache.EVICTED_PREFIX) or
+            top_dir in self.PRIVATE or
+            path.endswith((httpclient.PARTIAL_SUFFIX,
+                           httpclient.VALIDATOR_SUFFIX)) or
+            not os.path.isfile(path)):
+            return None
+        return path
+
+    def send_artifact(self, head=False):
+        path = self.artifact_path()
+        if not path:
+            self.send_error(404)
+            return
+        f = open(path, 'rb')
+        try:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            etag = '"%x-%x"' % (int(stat.st_mtime), size)
+            if self.headers.getheader('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            byte_range = parse_range(self.headers.getheader('Range'), size)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range:
+                first, last = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range',
+                                 'bytes %d-%d/%d' % (first, last, size))
+            else:
+                first, last = 0, size - 1
+                self.send_response(200)
+            length = last - first + 1
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified',
+                             self.date_time_string(stat.st_mtime))
+            self.end_headers()
+            if not head:
+                self.copy_range(f, first, length)
+        finally:
+            f.close()
+
+    def copy_range(self, f, offset, length):
+        """Sends length bytes of the file f from offset, without
+        copying them through Python if pysendfile is available."""
+        self.wfile.flush()
+        if sendfile:
+            while length > 0:
+                sent = sendfile(self.connection.fileno(), f.fileno(),
+                                offset, length)
+                if not sent:
+                    break
+                offset += sent
+                length -= sent
+            return
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(self.COPY_CHUNK_SIZE, length))
+            if not data:
+                break
+            self.wfile.write(data)
+            length -= len(data)
+
 
 class BuildCacheClient(object):
 
@@ -60,29 +703,92 @@ class BuildCacheClient(object):
         self.host = host
         self.port = port
         self.sock = None
+        self.buffer = ''
 
     def connect(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((self.host, self.port))
+        self.buffer = ''
 
     def close(self):
-        self.sock.close()
-        self.sock = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
 
-    def get(self, url, force=False, enable_unittests=False):
-        if not self.sock:
-            self.connect()
+    def get(self, url, force=False, enable_unittests=False, prefetch=False):
         line = url
         if force:
             line += ' force'
         if enable_unittests:
             line += ' enable_unittests'
+        if prefetch:
+            line += ' prefetch'
+        return self.send_command(line)
+
+    def send_command(self, line):
+        if not self.sock:
+            self.connect()
         self.sock.sendall(line + '\n')
-        buf = ''
-        while not '\n' in buf:
+        return self.read_response()
+
+    def read_response(self):
+        while not '\n' in self.buffer:
             data = self.sock.recv(1024)
             if not data:
                 print 'build server hung up!'
                 return None
-            buf += data
-        return json.loads(buf)
+            self.buffer += data
+        line, nl, self.buffer = self.buffer.partition('\n')
+        return json.loads(line)
+
+    def submit(self, url, force=False, enable_unittests=False):
+        """Asks the server to fetch the build in the background.
+        Returns a dict with a request_id item if successful."""
+        line = 'submit %s' % url
+        if force:
+            line += ' force'
+        if enable_unittests:
+            line += ' enable_unittests'
+        return self.send_command(line)
+
+    def poll(self, request_id):
+        return self.send_command('poll %d' % request_id)
+
+    def subscribe(self, request_id, callback=None):
+        """Waits for the request to finish, calling callback with each
+        of its progress events, and returns its result, which is the
+        same as that returned by get()."""
+        event = self.send_command('subscribe %d' % request_id)
+        while event:
+            if not event.get('success', True):
+                return event
+            if event.get('done'):
+                return event['result']
+            if callback and not event.get('keepalive'):
+                callback(event)
+            event = self.read_response()
+        return None
+
+    def pin(self, controller, build_urls):
+        """Asks the server not to evict the builds until the controller
+        pins other builds; see BuildCacheServer.pin()."""
+        return self.send_command(' '.join(['pin', controller] +
+                                          sorted(build_urls)))
+
+    def prefetch(self, url, enable_unittests=False):
+        """Asks the server to fetch the build in the background and
+        returns without waiting for it."""
+        return self.get(url, enable_unittests=enable_unittests, prefetch=True)
+
+    def warm(self, search, build_location, first, last,
+             enable_unittests=False):
+        """Asks the server to fetch the builds from first through last
+        in the background. search is 'revision' or 'time'. Returns a
+        dict with a warm_id item if successful."""
+        line = 'warm %s %s %s %s' % (search, build_location, first, last)
+        if enable_unittests:
+            line += ' enable_unittests'
+        return self.send_command(line)
+
+    def warm_status(self, warm_id):
+        return self.send_command('warm status %d' % warm_id)
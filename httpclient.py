@@ -0,0 +1,377 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import httplib
+import logging
+import os
+import socket
+import threading
+import time
+import urlparse
+
+logger = logging.getLogger('autophone.httpclient')
+
+# Suffixes of the files retrieve() writes next to the file it downloads:
+# the partial download and the validator of the version being resumed.
+PARTIAL_SUFFIX = '.partial'
+VALIDATOR_SUFFIX = '.partial-validator'
+
+
+class HTTPClientError(IOError):
+    """Raised when a request can not be completed."""
+    pass
+
+
+class HTTPError(HTTPClientError):
+    """Raised when a request completes with an error status."""
+
+    def __init__(self, url, code, reason):
+        HTTPClientError.__init__(self, 'HTTP Error %d: %s: %s' %
+                                 (code, reason, url))
+        self.url = url
+        self.code = code
+        self.reason = reason
+
+
+class HTTPResponse(object):
+    """Response to an HTTPClient request.
+
+    The body must be read to the end or the response closed so that
+    the underlying connection can be returned to its pool.
+    """
+
+    def __init__(self, client, key, conn, response, url):
+        self.client = client
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+
+    def getcode(self):
+        return self.status
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        try:
+            data = self.response.read(amt)
+        except (socket.error, httplib.HTTPException), e:
+            self.close()
+            raise HTTPClientError('Error reading %s: %s' % (self.url, e))
+        if not data or amt is None:
+            self.close()
+        return data
+
+    def close(self):
+        if not self.conn:
+            return
+        # A connection may only be reused once its response has been
+        # consumed completely.
+        if self.response.length == 0 and not self.response.isclosed():
+            # Responses without a body such as 304 Not Modified.
+            self.response.read()
+        reusable = self.response.isclosed() and not self.response.will_close
+        if not reusable:
+            self.response.close()
+        self.client._release_connection(self.key, self.conn, reusable)
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+class HTTPClient(object):
+    """HTTP client with per-host pools of keep-alive connections,
+    timeouts and retries with exponential backoff.
+
+    Idempotent requests are retried after connection errors and server
+    errors, and are resent without counting as an attempt when a
+    pooled connection turns out to have been closed by the server.
+    Other requests are never retried, since the server may have
+    received a request whose response was lost, so they are sent on
+    new connections rather than idle pooled ones.
+    """
+
+    TIMEOUT = 60
+    MAX_RETRIES = 3
+    RETRY_BACKOFF = 1
+    MAX_IDLE_CONNECTIONS = 8
+    MAX_REDIRECTS = 5
+    RETRIEVE_CHUNK_SIZE = 65536
+
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+    REDIRECT_STATUSES = (httplib.MOVED_PERMANENTLY, httplib.FOUND,
+                         httplib.SEE_OTHER, httplib.TEMPORARY_REDIRECT)
+
+    def __init__(self, timeout=TIMEOUT, max_retries=MAX_RETRIES,
+                 retry_backoff=RETRY_BACKOFF,
+                 max_idle_connections=MAX_IDLE_CONNECTIONS):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_idle_connections = max_idle_connections
+        self.pid = os.getpid()
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def _get_connection(self, key, pooled=True):
+        """Returns a tuple consisting of a connection to the host
+        identified by key and a boolean indicating if the connection
+        was taken from the pool. A new connection is made if pooled is
+        False.
+        """
+        if pooled:
+            with self.lock:
+                pool = self.pools.get(key)
+                if pool:
+                    return pool.pop(), True
+        scheme, netloc = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        elif scheme == 'http':
+            conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+        else:
+            raise HTTPClientError('Unsupported url scheme %s' % scheme)
+        return conn, False
+
+    def _release_connection(self, key, conn, reusable=True):
+        if reusable:
+            with self.lock:
+                pool = self.pools.setdefault(key, [])
+                if len(pool) < self.max_idle_connections:
+                    pool.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            pools = self.pools
+            self.pools = {}
+        for pool in pools.values():
+            for conn in pool:
+                conn.close()
+
+    def request(self, method, url, body=None, headers=None):
+        """Perform the request and return an HTTPResponse.
+
+        Redirects are followed for GET and HEAD requests. Raises
+        HTTPError if the final response has a status of 400 or
+        greater and HTTPClientError if the request could not be
+        completed.
+        """
+        method = method.upper()
+        for redirect in range(self.MAX_REDIRECTS + 1):
+            response = self._request(method, url, body, headers)
+            if (method not in ('GET', 'HEAD') or
+                response.status not in self.REDIRECT_STATUSES):
+                break
+            location = response.getheader('location')
+            response.read()
+            if not location:
+                raise HTTPClientError('Redirect without location: %s' % url)
+            logger.debug('request: %s redirected to %s' % (url, location))
+            url = urlparse.urljoin(url, location)
+        else:
+            raise HTTPClientError('Too many redirects: %s' % url)
+
+        if response.status >= 400:
+            response.read()
+            raise HTTPError(url, response.status, response.reason)
+        return response
+
+    def _request(self, method, url, body, headers):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        idempotent = method in self.IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            attempt += 1
+            conn, pooled = self._get_connection(key, pooled=idempotent)
+            try:
+                conn.request(method, path, body, headers or {})
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if pooled:
+                    # The server closed the idle connection. This does
+                    # not count against the retries.
+                    logger.debug('_request: stale connection to %s: %s' %
+                                 (parts.netloc, e))
+                    attempt -= 1
+                    continue
+                if not idempotent or attempt > self.max_retries:
+                    raise HTTPClientError('Error requesting %s: %s' % (url, e))
+                logger.warning('_request: attempt %d %s %s failed: %s' %
+                               (attempt, method, url, e))
+                self._backoff(attempt)
+                continue
+            response = HTTPResponse(self, key, conn, response, url)
+            if (response.status >= 500 and idempotent and
+                attempt <= self.max_retries):
+                logger.warning('_request: attempt %d %s %s failed: %d %s' %
+                               (attempt, method, url,
+                                response.status, response.reason))
+                response.read()
+                self._backoff(attempt)
+                continue
+            return response
+
+    def _backoff(self, attempt):
+        time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+
+    def get(self, url, headers=None):
+        return self.request('GET', url, headers=headers)
+
+    def post(self, url, body, headers=None):
+        return self.request('POST', url, body=body, headers=headers)
+
+    def retrieve(self, url, path, progress=None):
+        """Download url to the file path.
+
+        The body is written to path.partial, which is renamed to path
+        once complete, so path never contains a partial download. An
+        existing path.partial left by an interrupted transfer, either
+        during this call or an earlier one, is resumed with a Range
+        request rather than downloaded again. Interrupted transfers
+        are retried as long as they make progress.
+
+        The strong ETag or, failing that, the Last-Modified date of the
+        response is saved in path.partial-validator and sent as the
+        If-Range of the resumed requests, so that the rest of a file
+        which has changed is not appended to the old part; the server
+        then sends the whole file. A partial download without a
+        validator is discarded.
+
+        If progress is given, it is called with the number of bytes of
+        the file retrieved so far and its total size, or None if the
+        size is unknown, after each chunk is written.
+        """
+        partial_path = path + PARTIAL_SUFFIX
+        validator_path = path + VALIDATOR_SUFFIX
+        failures = 0
+        while True:
+            offset = 0
+            validator = None
+            if os.path.exists(partial_path):
+                offset = os.path.getsize(partial_path)
+                try:
+                    with open(validator_path) as f:
+                        validator = f.read()
+                except IOError:
+                    pass
+            headers = {}
+            if offset and validator:
+                headers['Range'] = 'bytes=%d-' % offset
+                headers['If-Range'] = validator
+            else:
+                offset = 0
+            try:
+                response = self.get(url, headers=headers)
+            except HTTPError, e:
+                if offset and e.code == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+                    logger.warning('retrieve: discarding %s: %s' %
+                                   (partial_path, e))
+                    os.unlink(partial_path)
+                    continue
+                raise
+            try:
+                if response.status == httplib.PARTIAL_CONTENT:
+                    content_range = response.getheader('content-range', '')
+                    if not content_range.startswith('bytes %d-' % offset):
+                        os.unlink(partial_path)
+                        raise HTTPClientError('Unexpected Content-Range %s '
+                                              'resuming %s at %d' %
+                                              (content_range, url, offset))
+                    mode = 'ab'
+                else:
+                    # The download starts over, since there was nothing
+                    # to resume, the file changed or the server ignored
+                    # the Range request.
+                    offset = 0
+                    mode = 'wb'
+                    self._save_validator(response, validator_path)
+                length = response.getheader('content-length')
+                total = None
+                if length is not None:
+                    total = offset + int(length)
+                with open(partial_path, mode) as f:
+                    received = offset
+                    while True:
+                        data = response.read(self.RETRIEVE_CHUNK_SIZE)
+                        if not data:
+                            break
+                        f.write(data)
+                        received += len(data)
+                        if progress:
+                            progress(received, total)
+                size = os.path.getsize(partial_path)
+                if length is not None and size != offset + int(length):
+                    raise HTTPClientError('Incomplete body retrieving %s: '
+                                          '%d of %d bytes' %
+                                          (url, size - offset, int(length)))
+            except HTTPClientError, e:
+                if os.path.exists(partial_path) and \
+                        os.path.getsize(partial_path) > offset:
+                    # Only count failures which made no progress.
+                    failures = 0
+                failures += 1
+                if failures > self.max_retries:
+                    raise
+                logger.warning('retrieve: attempt %d failed, resuming: %s' %
+                               (failures, e))
+                self._backoff(failures)
+                continue
+            finally:
+                response.close()
+            os.rename(partial_path, path)
+            if os.path.exists(validator_path):
+                os.unlink(validator_path)
+            return
+
+    def _save_validator(self, response, validator_path):
+        """Saves the validator of the response for resuming its
+        download, or removes the old one if it has none. Weak ETags
+        can not be used in If-Range."""
+        validator = response.getheader('etag')
+        if not validator or validator.startswith('W/'):
+            validator = response.getheader('last-modified')
+        if validator:
+            with open(validator_path, 'w') as f:
+                f.write(validator)
+        elif os.path.exists(validator_path):
+            os.unlink(validator_path)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Returns the HTTPClient shared by this process."""
+    global _client
+    with _client_lock:
+        # Pooled connections must not be shared with forked processes.
+        if not _client or _client.pid != os.getpid():
+            _client = HTTPClient()
+        return _client
+
+def request(method, url, body=None, headers=None):
+    return get_client().request(method, url, body=body, headers=headers)
+
+def get(url, headers=None):
+    return get_client().get(url, headers=headers)
+
+def post(url, body, headers=None):
+    return get_client().post(url, body, headers=headers)
+
+def retrieve(url, path, progress=None):
+    return get_client().retrieve(url, path, progress=progress)
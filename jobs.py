@@ -119,6 +119,32 @@ class Jobs(object):
             count = 0
         return count
 
+    def pending_build_urls(self):
+        """Returns the set of the urls of the builds of the queued and
+        running jobs. Raises sqlite3.OperationalError if the jobs
+        database can not be queried within SQL_MAX_RETRIES attempts,
+        since callers pin these builds and must not mistake an error
+        for no pending jobs.
+        """
+        attempt = 0
+        email_sent = False
+        while True:
+            attempt += 1
+            try:
+                return set(row[0] for row in self._conn().cursor().execute(
+                    'select distinct build_url from jobs'))
+            except sqlite3.OperationalError:
+                email_sent = self.report_sql_error(attempt, email_sent,
+                                                   'Unable to query pending '
+                                                   'builds in jobs database.',
+                                                   'Please check the logs for '
+                                                   'full details.',
+                                                   'Attempt %d failed to query '
+                                                   'pending builds in jobs '
+                                                   'database.' % attempt)
+                if attempt > self.SQL_MAX_RETRIES:
+                    raise
+
     def get_next_job(self, device=None):
         if not device:
             device = self.default_device
@@ -18,10 +18,19 @@ OVERRIDE_BUILD_DIR = 'override_build_dir'
 REPOS = 'repos'
 BUILDTYPES = 'buildtypes'
 BUILD_CACHE_PORT = 'build_cache_port'
+BUILD_CACHE_HTTP_PORT = 'build_cache_http_port'
+BUILD_CACHE_HTTP_ADDRESS = 'build_cache_http_address'
+BUILD_CACHE_DAEMON = 'build_cache_daemon'
 
 # ini file internal options
 BUILD_CACHE_SIZE = 'build_cache_size'
 BUILD_CACHE_EXPIRES = 'build_cache_expires'
+BUILD_CACHE_MAX_BYTES = 'build_cache_max_bytes'
+BUILD_CACHE_SCRUB_INTERVAL = 'build_cache_scrub_interval'
+BUILD_CACHE_PROCESSES = 'build_cache_processes'
+BUILD_CRAWL_THREADS = 'build_crawl_threads'
+BUILD_POLL_INTERVAL = 'build_poll_interval'
+BUILD_POLL_LOCATIONS = 'build_poll_locations'
 DEVICEMANAGER_RETRY_LIMIT = 'devicemanager_retry_limit'
 DEVICEMANAGER_SETTLING_TIME = 'devicemanager_settling_time'
 PHONE_RETRY_LIMIT = 'phone_retry_limit'
@@ -49,13 +58,22 @@ CMD_OPTION_NAMES = {
     OVERRIDE_BUILD_DIR: 'get',
     REPOS: 'get',
     BUILDTYPES: 'get',
-    BUILD_CACHE_PORT: 'getint'
+    BUILD_CACHE_PORT: 'getint',
+    BUILD_CACHE_HTTP_PORT: 'getint',
+    BUILD_CACHE_HTTP_ADDRESS: 'get',
+    BUILD_CACHE_DAEMON: 'getboolean'
 }
 
 # application configuration settings.
 INI_OPTION_NAMES = {
     BUILD_CACHE_SIZE: 'getint',
     BUILD_CACHE_EXPIRES: 'getint',
+    BUILD_CACHE_MAX_BYTES: 'getint',
+    BUILD_CACHE_SCRUB_INTERVAL: 'getint',
+    BUILD_CACHE_PROCESSES: 'getint',
+    BUILD_CRAWL_THREADS: 'getint',
+    BUILD_POLL_INTERVAL: 'getint',
+    BUILD_POLL_LOCATIONS: 'get',
     DEVICEMANAGER_RETRY_LIMIT: 'getint',
     DEVICEMANAGER_SETTLING_TIME: 'getint',
     PHONE_RETRY_LIMIT: 'getint',
@@ -2,13 +2,126 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import base64
 import datetime
+import hashlib
+import httplib
+import json
 import logging
+import os
 import shutil
+import sqlite3
 import tempfile
+import threading
+import time
 import unittest
+import urlparse
+import zipfile
 
+import buildindex
+import buildpoller
 import builds
+import buildserver
+import httpclient
+import tinderboxfixture
+
+
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path,
+                                     dict(self.headers)))
+        content = self.server.content(self.path)
+        if content is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        byte_range = self.headers.getheader('Range')
+        if_range = self.headers.getheader('If-Range')
+        if byte_range and (not if_range or if_range == etag):
+            # Only ranges of the form bytes=<first>- are supported.
+            first = int(byte_range[len('bytes='):-len('-')])
+            if first >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(content))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (first, len(content) - 1, len(content)))
+            content = content[first:]
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        # Drop the connection after receiving the request, as if the
+        # response had been lost.
+        self.server.requests.append((self.command, self.path,
+                                     dict(self.headers)))
+        self.rfile.read(int(self.headers.getheader('Content-Length')))
+        self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server for the files dict, which maps paths to their
+    contents, and listings of the directories containing them. The
+    requests received are recorded as (method, path, headers) tuples."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FixtureHandler)
+        self.base_url = 'http://127.0.0.1:%d' % self.server_port
+        self.files = {}
+        self.requests = []
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def content(self, path):
+        if path in self.files:
+            return self.files[path]
+        if not path.endswith('/'):
+            return None
+        names = set()
+        for filename in self.files:
+            if filename.startswith(path):
+                rest = filename[len(path):]
+                names.add(rest.split('/')[0] + ('/' if '/' in rest else ''))
+        if not names:
+            return None
+        return ('<html><body><pre>' +
+                ''.join('<a href="%s">%s</a>\n' % (name, name)
+                        for name in sorted(names)) +
+                '</pre></body></html>')
+
+    def stop(self):
+        # Close the keep-alive connections so the handler threads exit.
+        httpclient.get_client().close()
+        self.shutdown()
+        self.server_close()
+
 
 class BuildsTest(unittest.TestCase):
 
@@ -32,3 +145,890 @@ class BuildsTest(unittest.TestCase):
         for l in buildlist:
             logging.info(l)
         self.assertTrue(buildlist)
+
+
+class ParallelMapTest(unittest.TestCase):
+
+    def test_order(self):
+        """Results are returned in the order of the items, however the
+        calls complete."""
+        def slow_square(item):
+            time.sleep(0.01 * (5 - item))
+            return item * item
+        self.assertEqual(builds.parallel_map(slow_square, range(5), 5),
+                         [0, 1, 4, 9, 16])
+
+    def test_errors(self):
+        """The exception raised for the earliest item is re-raised after
+        every call has completed."""
+        calls = []
+
+        def check(item):
+            calls.append(item)
+            if item in (1, 3):
+                raise ValueError(item)
+            return item
+        try:
+            builds.parallel_map(check, range(5), 3)
+            self.fail('No exception raised')
+        except ValueError, e:
+            self.assertEqual(e.args, (1,))
+        self.assertEqual(sorted(calls), range(5))
+
+
+class LinkParserTest(unittest.TestCase):
+
+    listing = ('<html><body><pre>'
+               '<a href="?C=N;O=D">Name</a> '
+               '<a href="/pub/mobile/">Parent Directory</a>\n'
+               '<a href="1380000000/">1380000000/</a>\n'
+               '<a href="fennec-27.0a1.en-US.android-arm.apk">'
+               'fennec-27.0a1.en-US.android-arm.apk</a>\n'
+               '<a href="a&amp;b/">a&amp;b/</a>\n'
+               '</pre></body></html>')
+
+    def test_links(self):
+        """Navigation links are skipped and the remaining links are
+        returned in order regardless of how the listing is chunked."""
+        expected = [builds.Link('1380000000/', '1380000000/'),
+                    builds.Link('fennec-27.0a1.en-US.android-arm.apk',
+                                'fennec-27.0a1.en-US.android-arm.apk'),
+                    builds.Link('a&b/', 'a&b/')]
+        for chunk_size in 1, 7, len(self.listing):
+            parser = builds.LinkParser()
+            for offset in range(0, len(self.listing), chunk_size):
+                parser.feed(self.listing[offset:offset + chunk_size])
+            parser.close()
+            self.assertEqual(parser.links, expected)
+
+
+class ListingCacheTest(unittest.TestCase):
+
+    listing = ('<html><body><pre>'
+               '<a href="1380000000/">1380000000/</a>\n'
+               '</pre></body></html>')
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.server = FixtureServer()
+        self.server.files['/builds/'] = self.listing
+        self.url = self.server.base_url + '/builds/'
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_revalidation(self):
+        """Cached listings are revalidated with conditional requests
+        and downloaded again when they change."""
+        listing_cache = builds.ListingCache(self.cache_dir)
+        expected = [builds.Link('1380000000/', '1380000000/')]
+        self.assertEqual(builds.url_links(self.url, listing_cache), expected)
+        self.assertEqual(listing_cache.get(self.url)['links'],
+                         [list(link) for link in expected])
+        self.assertEqual(builds.url_links(self.url, listing_cache), expected)
+        headers = self.server.requests[-1][2]
+        self.assertEqual(headers['if-none-match'],
+                         listing_cache.get(self.url)['etag'])
+        self.server.files['/builds/'] = self.listing.replace('1380000000',
+                                                             '1390000000')
+        self.assertEqual(builds.url_links(self.url, listing_cache),
+                         [builds.Link('1390000000/', '1390000000/')])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_expire(self):
+        """Entries which have not been used recently are removed."""
+        listing_cache = builds.ListingCache(self.cache_dir)
+        listing_cache.put('old', '"etag"', None, [])
+        listing_cache.put('new', '"etag"', None, [])
+        expired = time.time() - listing_cache.EXPIRES - 1
+        os.utime(listing_cache.entry_path('old'), (expired, expired))
+        os.utime(listing_cache.entry_path('new'), (expired, expired))
+        self.assertNotEqual(listing_cache.get('new'), None)
+        self.assertEqual(listing_cache.expire(), 1)
+        self.assertEqual(listing_cache.get('old'), None)
+        self.assertNotEqual(listing_cache.get('new'), None)
+
+
+class HTTPClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FixtureServer()
+        self.server.files['/file'] = 'content'
+        self.url = self.server.base_url + '/file'
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'file')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def retrieve(self, partial_content, partial_version='content'):
+        with open(self.path + httpclient.PARTIAL_SUFFIX, 'w') as f:
+            f.write(partial_content)
+        with open(self.path + httpclient.VALIDATOR_SUFFIX, 'w') as f:
+            f.write('"%s"' % hashlib.sha1(partial_version).hexdigest())
+        httpclient.retrieve(self.url, self.path)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'content')
+        self.assertEqual(os.listdir(self.tmpdir), ['file'])
+
+    def test_retrieve_resume(self):
+        """Partial downloads are resumed with Range requests."""
+        self.retrieve('con')
+        self.assertEqual(self.server.requests[-1][2]['range'], 'bytes=3-')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_retrieve_changed(self):
+        """Partial downloads of a file which has changed since are
+        replaced by the whole file."""
+        self.retrieve('old', 'old content')
+        self.assertEqual(self.server.requests[0][2]['range'], 'bytes=3-')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_retrieve_no_validator(self):
+        """Partial downloads without a validator are not resumed."""
+        with open(self.path + httpclient.PARTIAL_SUFFIX, 'w') as f:
+            f.write('con')
+        httpclient.retrieve(self.url, self.path)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'content')
+        self.assertFalse('range' in self.server.requests[0][2])
+
+    def test_retrieve_discard(self):
+        """Partial downloads which can not be resumed are discarded and
+        downloaded again."""
+        self.retrieve('content plus garbage')
+        self.assertEqual(self.server.requests[0][2]['range'], 'bytes=20-')
+        self.assertFalse('range' in self.server.requests[1][2])
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_post_not_resent(self):
+        """Requests which are not idempotent are not sent again when
+        their response is lost, even after pooled connections have
+        been used."""
+        client = httpclient.HTTPClient(retry_backoff=0)
+        self.assertEqual(client.get(self.url).read(), 'content')
+        self.assertRaises(httpclient.HTTPClientError,
+                          client.post, self.url, 'data')
+        client.close()
+        self.assertEqual([request[0] for request in self.server.requests],
+                         ['GET', 'POST'])
+
+
+class TinderboxFixtureServer(FixtureServer):
+    """Serves the TinderboxFixture tree of num_builds builds of repo,
+    recording the requests."""
+
+    def __init__(self, repo, num_builds):
+        FixtureServer.__init__(self)
+        self.tree = tinderboxfixture.TinderboxFixture(num_builds, repo)
+        self.tree.base_url = self.base_url
+
+    def content(self, path):
+        parts = urlparse.urlsplit(path)
+        return self.tree.content(parts.path, urlparse.parse_qs(parts.query))
+
+
+class TinderboxTestCase(unittest.TestCase):
+    """Base class of the tests of the build searches of num_builds
+    builds served by a TinderboxFixtureServer."""
+
+    repo = 'mozilla-central'
+    num_builds = 48
+
+    def setUp(self):
+        self.server = TinderboxFixtureServer(self.repo, self.num_builds)
+        self.saved_urls = (builds.Tinderbox.main_http_url,
+                           dict(builds.repo_urls), dict(builds.urls_repos))
+        repo_url = '%s/%s/' % (self.server.base_url, self.repo)
+        builds.Tinderbox.main_http_url = (self.server.base_url +
+                                          '/tinderbox-builds/')
+        builds.repo_urls[self.repo] = repo_url
+        builds.urls_repos[repo_url] = self.repo
+        self.cache_dirs = []
+
+    def tearDown(self):
+        self.server.stop()
+        (builds.Tinderbox.main_http_url, repo_urls,
+         urls_repos) = self.saved_urls
+        builds.repo_urls.clear()
+        builds.repo_urls.update(repo_urls)
+        builds.urls_repos.clear()
+        builds.urls_repos.update(urls_repos)
+        for cache_dir in self.cache_dirs:
+            shutil.rmtree(cache_dir)
+
+    def build_cache(self, **kwargs):
+        cache_dir = tempfile.mkdtemp()
+        self.cache_dirs.append(cache_dir)
+        return builds.BuildCache([self.repo], ['opt'], 'fennec', ['android'],
+                                 '.apk', cache_dir=cache_dir, **kwargs)
+
+
+class SearchStrategyTest(TinderboxTestCase):
+
+    def find_builds(self, strategy, first, last):
+        bc = self.build_cache(search_strategy=strategy)
+        pushes = self.server.tree.pushes
+        return bc.find_builds_by_revision(pushes[first][1][:12],
+                                          pushes[last][1][:12],
+                                          'tinderbox')
+
+    def test_bisect(self):
+        """The bisect strategy finds the same builds as the linear
+        strategy with fewer requests."""
+        linear_builds = self.find_builds('linear', 20, 24)
+        linear_requests = len(self.server.requests)
+        del self.server.requests[:]
+        bisect_builds = self.find_builds('bisect', 20, 24)
+        self.assertEqual(len(linear_builds), 5)
+        self.assertEqual(bisect_builds, linear_builds)
+        self.assertTrue(len(self.server.requests) < linear_requests)
+
+
+class BuildPollerTest(TinderboxTestCase):
+
+    num_builds = 4
+
+    def test_new_builds(self):
+        """Polls report the builds which have appeared since the
+        previous poll and add them to the build index."""
+        tree = self.server.tree
+        new_files = dict((path, content)
+                         for path, content in tree.files.items()
+                         if path.split('/')[3] == str(
+                             tinderboxfixture.START_TIMESTAMP +
+                             3 * tinderboxfixture.BUILD_INTERVAL))
+        for path in new_files:
+            del tree.files[path]
+        bc = self.build_cache()
+        window = time.time() - tinderboxfixture.START_TIMESTAMP + 24 * 3600
+        poller = buildpoller.BuildPoller(bc, None, window=window)
+        self.assertEqual(len(poller.poll()), 3)
+        self.assertEqual(poller.poll(), [])
+        tree.files.update(new_files)
+        new_builds = poller.poll()
+        self.assertEqual(len(new_builds), 1)
+        directory = new_builds[0].rsplit('/', 1)[0] + '/'
+        self.assertEqual(bc.build_index.get_builds([directory])[directory]
+                         ['build_url'], new_builds[0])
+
+
+class RevisionTimestampsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.build_index = buildindex.BuildIndex(
+            os.path.join(self.cache_dir, 'builds.sqlite'))
+        self.build_index.add_pushes('mozilla-central', [
+            (1, 'aaaa0001', 1000),
+            (2, 'bbbb0002', 2000),
+            (2, 'bbbb0003', 2000),
+            (3, 'cccc0004', 3000),
+            (4, 'dddd0005', 4000)])
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_indexed_range(self):
+        """Revision ranges covered by the pushlog in the build index
+        are answered without querying hg."""
+        self.assertEqual(
+            builds.get_revision_timestamps('mozilla-central', 'aaaa',
+                                           'dddd0005', self.build_index),
+            (2000, 4000))
+        self.assertEqual(
+            builds.get_revision_timestamps('mozilla-central', 'bbbb0003',
+                                           'cccc', self.build_index),
+            (3000, 3000))
+        self.assertEqual(
+            builds.get_revision_timestamps('mozilla-central', 'bbbb0002',
+                                           'bbbb0003', self.build_index),
+            (None, None))
+
+
+class CacheIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        for i in range(3):
+            cache_build_dir = os.path.join(self.cache_dir, 'build%d' % i)
+            os.mkdir(cache_build_dir)
+            with open(os.path.join(cache_build_dir, 'build.apk'), 'w') as f:
+                f.write('x' * 1000)
+            lastused_path = os.path.join(cache_build_dir, 'lastused')
+            open(lastused_path, 'w').close()
+            os.utime(lastused_path, (1000 + i, 1000 + i))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_byte_budget(self):
+        """The least recently used unpinned builds are evicted until the
+        cache is within its byte budget."""
+        bc = builds.BuildCache([], [], 'fennec', [], '.apk',
+                               cache_dir=self.cache_dir,
+                               build_cache_size=3,
+                               build_cache_max_bytes=2500)
+        self.assertEqual(sorted(bc.cache_index), ['build0', 'build1', 'build2'])
+        bc.pin_build('build0')
+        self.assertEqual(bc.clean_cache(), 1)
+        self.assertEqual(sorted(bc.cache_index), ['build0', 'build2'])
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir,
+                                                     'build1')))
+        bc.unpin_build('build0')
+        self.assertEqual(bc.clean_cache(), 0)
+
+    def test_pinned_build_urls(self):
+        """Builds with pending jobs are not evicted, and nothing is
+        evicted if the pending builds can not be determined."""
+        os.rename(os.path.join(self.cache_dir, 'build0'),
+                  os.path.join(self.cache_dir, base64.b64encode('url0')))
+
+        def locked():
+            raise sqlite3.OperationalError('database is locked')
+
+        bc = builds.BuildCache([], [], 'fennec', [], '.apk',
+                               cache_dir=self.cache_dir,
+                               build_cache_size=3,
+                               build_cache_max_bytes=1,
+                               pinned_build_urls=locked)
+        self.assertEqual(bc.clean_cache(), 0)
+        self.assertEqual(len(bc.cache_index), 3)
+        bc.pinned_build_urls = lambda: set(['url0'])
+        self.assertEqual(bc.clean_cache(), 2)
+        self.assertEqual(sorted(bc.cache_index), [base64.b64encode('url0')])
+
+    def test_incremental_size(self):
+        """The sizes of the builds are updated as files are fetched,
+        without measuring the builds."""
+        bc = builds.BuildCache([], [], 'fennec', [], '.apk',
+                               cache_dir=self.cache_dir)
+        cache_build_dir = os.path.join(self.cache_dir, 'build0')
+        with open(os.path.join(cache_build_dir, 'robocop.apk'), 'w') as f:
+            f.write('x' * 500)
+        bc.update_manifest(cache_build_dir, 'robocop.apk', 'url')
+        self.assertEqual(bc.cache_index['build0']['size'], 1500)
+        with open(os.path.join(cache_build_dir, 'robocop.apk'), 'w') as f:
+            f.write('x' * 200)
+        bc.update_manifest(cache_build_dir, 'robocop.apk', 'url')
+        self.assertEqual(bc.cache_index['build0']['size'], 1200)
+
+    def test_extracted_tests_size(self):
+        """The sizes of the builds updated as tests are extracted match
+        their measured sizes, counting the files shared by the builds
+        through the blob store once."""
+        for build_dir in 'build0', 'build1':
+            tests_zipfile = zipfile.ZipFile(
+                os.path.join(self.cache_dir, build_dir, 'tests.zip'), 'w')
+            tests_zipfile.writestr('bin/xpcshell', 'x' * 300)
+            tests_zipfile.writestr('mozinfo.json', build_dir * 10)
+            tests_zipfile.close()
+        bc = builds.BuildCache([], [], 'fennec', [], '.apk',
+                               cache_dir=self.cache_dir)
+        for build_dir in 'build0', 'build1':
+            cache_build_dir = os.path.join(self.cache_dir, build_dir)
+            bc.add_build_size(cache_build_dir,
+                              builds.extract_tests(cache_build_dir))
+            self.assertEqual(builds.extract_tests(cache_build_dir), 0)
+            if build_dir == 'build0':
+                self.assertEqual(bc.cache_index['build0']['size'],
+                                 builds.build_dir_size(cache_build_dir))
+        sizes = dict((build_dir, entry['size'])
+                     for build_dir, entry in bc.cache_index.items())
+        for build_dir in sizes:
+            bc.add_build_size(os.path.join(self.cache_dir, build_dir), None)
+        bc.measure_builds()
+        self.assertEqual(sum(sizes.values()),
+                         sum(entry['size']
+                             for entry in bc.cache_index.values()))
+
+    def test_already_evicted(self):
+        """Builds removed by other processes are skipped when evicting."""
+        bc = builds.BuildCache([], [], 'fennec', [], '.apk',
+                               cache_dir=self.cache_dir,
+                               build_cache_max_bytes=1)
+        shutil.rmtree(os.path.join(self.cache_dir, 'build0'))
+        self.assertEqual(bc.clean_cache(), 2)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         ['blobs', 'builds.sqlite', 'listings', 'locks'])
+
+    def test_shared_cache_dir(self):
+        """Builds added by other processes sharing the cache directory
+        are indexed and builds locked by them are not evicted."""
+        bc = builds.BuildCache([], [], 'fennec', [], '.apk',
+                               cache_dir=self.cache_dir,
+                               build_cache_size=3,
+                               build_cache_max_bytes=1)
+        cache_build_dir = os.path.join(self.cache_dir, 'build3')
+        os.mkdir(cache_build_dir)
+        with open(os.path.join(cache_build_dir, 'build.apk'), 'w') as f:
+            f.write('x' * 1000)
+        open(os.path.join(cache_build_dir, 'lastused'), 'w').close()
+        # The index is updated from the cache directory periodically.
+        self.assertEqual(bc.clean_cache(), 3)
+        self.assertEqual(bc.cache_index, {})
+        bc.refreshed = 0
+        build_lock = bc.build_lock('build3')
+        with build_lock:
+            self.assertFalse(bc.build_lock('build3').acquire(blocking=False))
+            self.assertEqual(bc.clean_cache(), 0)
+            self.assertEqual(sorted(bc.cache_index), ['build3'])
+        self.assertEqual(bc.clean_cache(), 1)
+        self.assertEqual(bc.cache_index, {})
+
+    def test_metadata_index(self):
+        """The metadata of the indexed builds is returned without
+        reading their build directories."""
+        cache_build_dir = os.path.join(self.cache_dir, 'build0')
+        metadata = {'cache_build_dir': cache_build_dir, 'buildid': '1'}
+        with open(os.path.join(cache_build_dir, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+        bc = builds.BuildCache([], [], 'fennec', [], '.apk',
+                               cache_dir=self.cache_dir)
+        os.unlink(os.path.join(cache_build_dir, 'metadata.json'))
+        os.unlink(os.path.join(cache_build_dir, 'build.apk'))
+        self.assertEqual(bc.build_metadata(cache_build_dir), metadata)
+
+    def test_saved_cache_build_dir(self):
+        """The metadata saved with a different cache directory locates
+        the build in this cache directory."""
+        cache_build_dir = os.path.join(self.cache_dir, 'build0')
+        with open(os.path.join(cache_build_dir, 'metadata.json'), 'w') as f:
+            json.dump({'cache_build_dir': 'builds/build0'}, f)
+        bc = builds.BuildCache([], [], 'fennec', [], '.apk',
+                               cache_dir=self.cache_dir)
+        self.assertEqual(bc.metadata_index[cache_build_dir],
+                         {'cache_build_dir': cache_build_dir})
+
+    def test_no_index(self):
+        """Caches created without loading the index do not read the
+        cache directory."""
+        bc = builds.BuildCache([], [], 'fennec', [], '.apk',
+                               cache_dir=self.cache_dir, load_index=False)
+        self.assertEqual(bc.cache_index, {})
+        self.assertEqual(bc.metadata_index, {})
+        bc = builds.BuildCache([], [], 'fennec', [], '.apk',
+                               cache_dir=self.cache_dir)
+        self.assertEqual(sorted(bc.cache_index), ['build0', 'build1', 'build2'])
+
+
+class GetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FixtureServer()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_artifact_errors(self):
+        """The errors of the artifacts fetched concurrently are all
+        reported."""
+        self.server.files['/fennec_ids.txt'] = 'ids'
+        bc = builds.BuildCache([], [], 'fennec', [], '.apk',
+                               cache_dir=self.cache_dir)
+        results = bc.get(self.server.base_url + '/build.apk',
+                         enable_unittests=True)
+        self.assertFalse(results['success'])
+        for filename in 'build.apk', 'tests.zip', 'robocop.apk':
+            self.assertTrue(filename in results['error'], filename)
+        self.assertFalse('fennec_ids.txt' in results['error'])
+        paths = set(request[1] for request in self.server.requests)
+        self.assertEqual(paths, set(['/build.apk',
+                                     '/build.crashreporter-symbols.zip',
+                                     '/build.tests.zip', '/robocop.apk',
+                                     '/fennec_ids.txt']))
+
+
+class ScrubTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FixtureServer()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_corrupt_tests(self):
+        """A corrupt tests.zip is downloaded again and the tests
+        extracted from it are replaced."""
+        tests_zip = StringIO.StringIO()
+        tests_zipfile = zipfile.ZipFile(tests_zip, 'w')
+        tests_zipfile.writestr('mozinfo.json', 'mozinfo.json')
+        tests_zipfile.close()
+        self.server.files['/tests.zip'] = tests_zip.getvalue()
+        bc = builds.BuildCache([], [], 'fennec', [], '.apk',
+                               cache_dir=self.cache_dir)
+        cache_build_dir = os.path.join(self.cache_dir, 'build')
+        os.mkdir(cache_build_dir)
+        open(os.path.join(cache_build_dir, 'lastused'), 'w').close()
+        tests_zip_path = os.path.join(cache_build_dir, 'tests.zip')
+        self.assertEqual(bc.fetch_tests(self.server.base_url + '/tests.zip',
+                                        cache_build_dir), None)
+        self.assertEqual(bc.scrub(), 0)
+        with open(tests_zip_path, 'r+') as f:
+            f.write('x')
+        # A test suite partially extracted from the corrupt tests.zip.
+        os.mkdir(os.path.join(cache_build_dir, 'tests', 'mochitest'))
+        self.assertEqual(bc.scrub(), 1)
+        with open(tests_zip_path) as f:
+            self.assertEqual(f.read(), tests_zip.getvalue())
+        self.assertEqual(os.listdir(os.path.join(cache_build_dir, 'tests')),
+                         ['mozinfo.json'])
+        self.assertEqual(bc.scrub(), 0)
+
+
+class BlockingBuildCache(object):
+    """Stand-in for BuildCache whose get() waits until release is set,
+    recording the number of concurrent calls for each build."""
+
+    cache_dir = '/'
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.active = {}
+        self.max_active = {}
+        self.calls = []
+
+    def get(self, build, force=False, enable_unittests=False, progress=None):
+        with self.lock:
+            self.calls.append(build)
+            self.active[build] = self.active.get(build, 0) + 1
+            self.max_active[build] = max(self.max_active.get(build, 0),
+                                         self.active[build])
+        if progress:
+            progress({'artifact': 'build.apk', 'bytes': 0, 'total': 1})
+        self.release.wait(10)
+        if progress:
+            progress({'artifact': 'build.apk', 'bytes': 1, 'total': 1})
+        with self.lock:
+            self.active[build] -= 1
+        return {'success': True, 'metadata': {'cache_build_dir': build}}
+
+
+class BuildCacheServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.build_cache = builds.BuildCache(['mozilla-central'], ['opt'],
+                                             'fennec', ['android'], '.apk',
+                                             cache_dir=self.cache_dir)
+        self.server = buildserver.BuildCacheServer(
+            ('127.0.0.1', 0), buildserver.BuildCacheHandler)
+        self.server.build_cache = self.build_cache
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = buildserver.BuildCacheClient(
+            port=self.server.server_address[1])
+
+    def tearDown(self):
+        if self.client.sock:
+            self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def wait_for(self, condition):
+        for i in range(100):
+            if condition():
+                return
+            time.sleep(0.05)
+        self.fail('Timed out')
+
+    def test_build_locks(self):
+        """Fetches of the same build are serialized while fetches of
+        other builds proceed, and the per-build locks are removed when
+        they are no longer used."""
+        build_cache = self.server.build_cache = BlockingBuildCache()
+        threads = [threading.Thread(target=self.server.fetch, args=(build,))
+                   for build in ('a', 'a', 'a', 'b')]
+        for thread in threads:
+            thread.start()
+        self.wait_for(lambda: build_cache.active == {'a': 1, 'b': 1} and
+                      self.server.build_locks['a'][1] == 3)
+        self.assertEqual(self.server.build_locks['b'][1], 1)
+        build_cache.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(build_cache.max_active, {'a': 1, 'b': 1})
+        self.assertEqual(self.server.build_locks, {})
+
+    def test_submit(self):
+        """Submitted requests stream their progress to subscribers,
+        which ignore the keepalive events, and are expired after they
+        finish."""
+        build_cache = self.server.build_cache = BlockingBuildCache()
+        self.server.KEEPALIVE_INTERVAL = 0.05
+        response = self.client.submit('a')
+        self.assertTrue(response['success'])
+        request_id = response['request_id']
+        self.wait_for(lambda: build_cache.active == {'a': 1})
+        status = self.client.poll(request_id)
+        self.assertFalse(status['done'])
+        self.assertEqual(status['queue_position'], 0)
+        self.assertEqual(status['progress']['build.apk']['bytes'], 0)
+
+        events = []
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(
+                self.client.subscribe(request_id, events.append)))
+        thread.start()
+        time.sleep(0.2)
+        build_cache.release.set()
+        thread.join()
+        self.assertEqual(results, [{'success': True,
+                                    'metadata': {'cache_build_dir': 'a'}}])
+        self.assertEqual([event.get('bytes') for event in events],
+                         [None, 0, 1])
+
+        status = self.client.poll(request_id)
+        self.assertTrue(status['done'])
+        self.assertTrue(status['result']['success'])
+        self.server.requests[request_id].finished -= (
+            self.server.REQUEST_EXPIRES + 1)
+        self.server.expire_requests()
+        self.assertFalse(self.client.poll(request_id)['success'])
+
+    def test_subscriber_gone(self):
+        """A subscription ends when its client goes away before the
+        request finishes."""
+        build_cache = self.server.build_cache = BlockingBuildCache()
+        self.server.KEEPALIVE_INTERVAL = 0.05
+        request_id = self.client.submit('a')['request_id']
+        self.wait_for(lambda: build_cache.active == {'a': 1})
+        threads = threading.active_count()
+        client = buildserver.BuildCacheClient(
+            port=self.server.server_address[1])
+        client.connect()
+        client.sock.sendall('subscribe %d\n' % request_id)
+        self.wait_for(lambda: threading.active_count() == threads + 1)
+        client.close()
+        self.wait_for(lambda: threading.active_count() == threads)
+        build_cache.release.set()
+
+    def test_pin(self):
+        """The builds pinned by each controller replace its previous
+        pins and are unpinned when they expire."""
+        self.client.pin('host:1', ['url1', 'url2'])
+        self.client.pin('host:2', ['url2', 'url3'])
+        self.assertEqual(self.server.pinned_build_urls(),
+                         set(['url1', 'url2', 'url3']))
+        self.client.pin('host:1', [])
+        self.assertEqual(self.server.pinned_build_urls(),
+                         set(['url2', 'url3']))
+        pinned, build_urls = self.server.pins['host:2']
+        self.server.pins['host:2'] = (
+            pinned - self.server.PIN_EXPIRES - 1, build_urls)
+        self.assertEqual(self.server.pinned_build_urls(), set())
+        self.assertEqual(self.server.pins, {})
+
+    def test_missing_arguments(self):
+        """Commands missing their arguments are rejected instead of
+        being taken for build urls."""
+        for line in ('submit', 'pin'):
+            response = self.client.send_command(line)
+            self.assertFalse(response['success'], line)
+            self.assertTrue(response['error'].startswith('usage: ' + line))
+        self.assertEqual(self.server.requests, {})
+        self.assertEqual(self.server.pins, {})
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         ['blobs', 'builds.sqlite', 'listings', 'locks'])
+
+    def test_prefetch(self):
+        """Prefetches of a build which is already queued or being
+        fetched are dropped."""
+        build_cache = self.server.build_cache = BlockingBuildCache()
+        for i in range(3):
+            self.assertTrue(self.client.prefetch('a')['success'])
+        self.wait_for(lambda: build_cache.active == {'a': 1})
+        self.assertEqual(self.server.prefetch_queue.qsize(), 0)
+        build_cache.release.set()
+        self.wait_for(lambda: not self.server.prefetch_pending)
+        self.assertEqual(build_cache.calls, ['a'])
+
+    def test_warm_validation(self):
+        """Warm ups with invalid ranges or build locations are
+        rejected."""
+        for args in (('revision', 'tinderbox', 'None', 'None'),
+                     ('time', 'tinderbox', 'None', '2014-05-13'),
+                     ('revision', 'nowhere', 'abcdef', '123456')):
+            response = self.client.warm(*args)
+            self.assertFalse(response['success'], args)
+        self.assertEqual(self.server.warmups, {})
+
+
+class BuildArtifactServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.server = buildserver.BuildArtifactServer(('127.0.0.1', 0),
+                                                      self.cache_dir)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def write_file(self, path, content='0123456789'):
+        path = os.path.join(self.cache_dir, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def request(self, path, method='GET', headers={}):
+        """Returns the status, headers and body of the response."""
+        conn = httplib.HTTPConnection('127.0.0.1',
+                                      self.server.server_address[1])
+        try:
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+            return response.status, dict(response.getheaders()), \
+                response.read()
+        finally:
+            conn.close()
+
+    def test_artifacts_url(self):
+        self.assertEqual(buildserver.artifacts_url(
+            'http://10.0.0.1:8080/', self.cache_dir,
+            os.path.join(self.cache_dir, 'mozilla-central', 'a b')),
+                         'http://10.0.0.1:8080/mozilla-central/a%20b/')
+        self.assertEqual(buildserver.artifacts_host('0.0.0.0', '10.0.0.1'),
+                         '10.0.0.1')
+        self.assertEqual(buildserver.artifacts_host('127.0.0.1', '10.0.0.1'),
+                         '127.0.0.1')
+
+    def test_ranges(self):
+        """Whole files, byte ranges, HEAD and conditional requests
+        are served."""
+        self.write_file('build/build.apk')
+        status, headers, body = self.request('/build/build.apk')
+        self.assertEqual((status, body), (200, '0123456789'))
+        self.assertEqual(headers['accept-ranges'], 'bytes')
+        etag = headers['etag']
+
+        status, headers, body = self.request('/build/build.apk', 'HEAD')
+        self.assertEqual((status, body), (200, ''))
+        self.assertEqual(headers['content-length'], '10')
+
+        for byte_range, content_range, content in (
+            ('bytes=2-4', 'bytes 2-4/10', '234'),
+            ('bytes=7-', 'bytes 7-9/10', '789'),
+            ('bytes=-3', 'bytes 7-9/10', '789'),
+            ('bytes=8-20', 'bytes 8-9/10', '89')):
+            status, headers, body = self.request(
+                '/build/build.apk', headers={'Range': byte_range})
+            self.assertEqual((status, headers['content-range'], body),
+                             (206, content_range, content), byte_range)
+
+        status, headers, body = self.request(
+            '/build/build.apk', headers={'Range': 'bytes=10-'})
+        self.assertEqual((status, headers['content-range']),
+                         (416, 'bytes */10'))
+
+        status, headers, body = self.request(
+            '/build/build.apk', headers={'If-None-Match': etag})
+        self.assertEqual((status, body), (304, ''))
+
+    def test_private(self):
+        """Only the complete files of the cached builds are served."""
+        self.write_file('build/build.apk')
+        for path in (os.path.join(builds.BLOBS_DIR, 'ab', 'abcdef'),
+                     os.path.join(builds.LOCKS_DIR, 'abcdef'),
+                     os.path.join('listings', 'abcdef'),
+                     'builds.sqlite',
+                     builds.BuildCache.EVICTED_PREFIX + 'abc/build.apk',
+                     'build/tests.zip.partial',
+                     'build/tests.zip.partial-validator'):
+            self.write_file(path)
+            self.assertEqual(self.request('/' + path)[0], 404, path)
+        outside = tempfile.NamedTemporaryFile()
+        for path in ('/build', '/build/missing.apk', '/../build/build.apk',
+                     '/%2e%2e/' + os.path.basename(outside.name)):
+            self.assertEqual(self.request(path)[0], 404, path)
+        outside.close()
+
+
+class ExtractTestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_build_dir = os.path.join(self.cache_dir, 'build')
+        os.mkdir(self.cache_build_dir)
+        tests_zipfile = zipfile.ZipFile(
+            os.path.join(self.cache_build_dir, 'tests.zip'), 'w')
+        for name in ('bin/xpcshell', 'certs/cert8.db', 'mozinfo.json',
+                     'mochitest/runtestsremote.py', 'reftest/remotereftest.py',
+                     'jsreftest/tests/user.js'):
+            tests_zipfile.writestr(name, name)
+        tests_zipfile.close()
+        self.tests_path = os.path.join(self.cache_build_dir, 'tests')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_extract_tests(self):
+        """Test suites are only extracted when they are required."""
+        builds.extract_tests(self.cache_build_dir)
+        self.assertEqual(sorted(os.listdir(self.tests_path)),
+                         ['bin', 'certs', 'mozinfo.json'])
+        builds.extract_tests(self.cache_build_dir,
+                             builds.tests_directories('jsreftest'))
+        self.assertEqual(sorted(os.listdir(self.tests_path)),
+                         ['bin', 'certs', 'jsreftest', 'mozinfo.json',
+                          'reftest'])
+        self.assertEqual(sorted(os.listdir(self.cache_build_dir)),
+                         ['tests', 'tests.zip'])
+
+    def test_interrupted_extraction(self):
+        """The shared parts of a downloaded tests package which were
+        not extracted are extracted when the build is used again."""
+        bc = builds.BuildCache([], [], 'fennec', [], '.apk',
+                               cache_dir=self.cache_dir)
+        bc.update_manifest(self.cache_build_dir, 'tests.zip', 'url')
+        self.assertTrue(bc.manifest_matches(self.cache_build_dir,
+                                            'tests.zip'))
+        self.assertTrue(bc.complete_tests(self.cache_build_dir))
+        self.assertEqual(sorted(os.listdir(self.tests_path)),
+                         ['bin', 'certs', 'mozinfo.json'])
+        self.assertTrue(bc.read_manifest(
+            self.cache_build_dir)['tests.zip']['extracted'])
+        # Once recorded, cache hits do not read tests.zip.
+        os.unlink(os.path.join(self.cache_build_dir, 'tests.zip'))
+        self.assertTrue(bc.complete_tests(self.cache_build_dir))
+        with open(os.path.join(self.cache_build_dir, 'tests.zip'), 'w') as f:
+            f.write('x')
+        bc.update_manifest(self.cache_build_dir, 'tests.zip', 'url')
+        self.assertFalse(bc.complete_tests(self.cache_build_dir))
+
+    def test_blob_store(self):
+        """Identical files are stored once and unused blobs are removed."""
+        other_build_dir = os.path.join(self.cache_dir, 'other')
+        os.mkdir(other_build_dir)
+        shutil.copy(os.path.join(self.cache_build_dir, 'tests.zip'),
+                    other_build_dir)
+        builds.extract_tests(self.cache_build_dir)
+        builds.extract_tests(other_build_dir)
+        stat = os.stat(os.path.join(other_build_dir, 'tests', 'mozinfo.json'))
+        self.assertEqual(stat.st_nlink, 3)
+        blob_store = builds.BlobStore(os.path.join(self.cache_dir,
+                                                   builds.BLOBS_DIR))
+        blob_path = blob_store.blob_path(
+            hashlib.sha256('mozinfo.json').hexdigest())
+        self.assertEqual(os.stat(blob_path).st_ino, stat.st_ino)
+        shutil.rmtree(self.cache_build_dir)
+        blob_store.collect_garbage()
+        self.assertTrue(os.path.exists(blob_path))
+        shutil.rmtree(other_build_dir)
+        blob_store.collect_garbage()
+        self.assertFalse(os.path.exists(blob_path))
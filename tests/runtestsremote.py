@@ -18,6 +18,7 @@ import re
 import time
 from mozdevice import DMError
 
+import builds
 import newlogparser
 
 try:
@@ -57,9 +58,9 @@ class UnitTest(PhoneTest):
         device_port = self.phone_cfg['sutcmdport']
 
         cache_build_dir = os.path.abspath(build_metadata["cache_build_dir"])
-        symbols_path = os.path.join(cache_build_dir, 'symbols')
-        if not os.path.exists(symbols_path):
-            symbols_path = None
+        # The symbols are only extracted if the harness processes a
+        # crash.
+        symbols_path = builds.symbols_path(cache_build_dir)
 
         androidprocname = build_metadata['androidprocname']
         re_revision = re.compile(r'http.*/rev/(.*)')
@@ -111,6 +112,19 @@ class UnitTest(PhoneTest):
                 }
 
                 self.load_test_parameters(test_parameters, config_file)
+                if not build_metadata.get('override_build_dir'):
+                    # Only the test suites which are run are extracted
+                    # from the tests package. The build's lock keeps the
+                    # build cache from replacing the tests while they are
+                    # extracted, but it is not held while the tests run,
+                    # since it would block the other phones fetching the
+                    # build, so a scrub which downloads a corrupt
+                    # tests.zip again can still replace them.
+                    with builds.build_lock(cache_build_dir):
+                        builds.extract_tests(
+                            cache_build_dir,
+                            builds.tests_directories(
+                                test_parameters['test_name']))
                 self.runtest(test_parameters)
 
             except:
@@ -13,10 +13,10 @@ import posixpath
 import re
 import sys
 import urllib
-import urllib2
 from math import sqrt
 from time import sleep
 
+import httpclient
 from logdecorator import LogDecorator
 from mozdevice import DMError
 from mozprofile import FirefoxProfile
@@ -566,11 +566,10 @@ class S1S2Test(PhoneTest):
         else:
             encoded_result = json.dumps(result)
             content_type = 'application/json; charset=utf-8'
-        req = urllib2.Request(self._resulturl + 'add/', encoded_result,
-                              {'Content-Type': content_type})
         try:
-            f = urllib2.urlopen(req)
-        except urllib2.URLError, e:
+            f = httpclient.post(self._resulturl + 'add/', encoded_result,
+                                {'Content-Type': content_type})
+        except httpclient.HTTPClientError, e:
             self.loggerdeco.error('Could not send results to server: %s' % e)
         else:
             f.read()
@@ -592,8 +591,8 @@ class S1S2Test(PhoneTest):
 
         try:
             url = self._resulturl + 'check/?' + urllib.urlencode(query)
-            f = urllib2.urlopen(url)
-        except urllib2.URLError, e:
+            f = httpclient.get(url)
+        except httpclient.HTTPClientError, e:
             self.loggerdeco.error(
                 'check_results: %s could not check: '
                 'phoneid: %s, test: %s, revision: %s, product: %s' % (
@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Synthetic Tinderbox tree and pushlog shared by the build cache self
+tests and benchmarks/find_builds_by_revision.py, which serve it from
+a local HTTP server.
+"""
+
+import hashlib
+import json
+import time
+
+REPO = 'mozilla-central'
+PLATFORM = 'android'
+BUILD_NAME = 'fennec-30.0a1.en-US.android-arm'
+START_TIMESTAMP = 1400000000
+BUILD_INTERVAL = 3600
+
+
+class TinderboxFixture(object):
+    """Tinderbox tree of num_builds builds of repo, one per hourly
+    push, and the json-pushes pushlog of the repo.
+
+    base_url is the url of the server, without a trailing slash, and
+    must be set before the tree is served. pushes is the list of
+    (pushid, changeset, date) tuples of the pushes.
+    """
+
+    def __init__(self, num_builds, repo=REPO):
+        self.repo = repo
+        self.base_url = None
+        self.files = {}
+        self.pushes = []
+        for i in range(num_builds):
+            changeset = hashlib.sha1('%s%d' % (repo, i)).hexdigest()
+            build_timestamp = START_TIMESTAMP + i * BUILD_INTERVAL
+            self.pushes.append((i + 1, changeset, build_timestamp - 600))
+            directory = '/tinderbox-builds/%s-%s/%d/' % (repo, PLATFORM,
+                                                          build_timestamp)
+            buildid = time.strftime('%Y%m%d%H%M%S',
+                                    time.localtime(build_timestamp))
+            self.files[directory + BUILD_NAME + '.apk'] = 'apk'
+            # The revision urls of the .txt files depend on base_url.
+            self.files[directory + BUILD_NAME + '.txt'] = (buildid, changeset)
+
+    def listing(self, path):
+        names = set()
+        for filename in self.files:
+            if filename.startswith(path) and filename != path:
+                rest = filename[len(path):]
+                names.add(rest.split('/')[0] + ('/' if '/' in rest else ''))
+        if not names:
+            return None
+        return ('<html><body><pre><a href="?C=N;O=D">Name</a>\n' +
+                ''.join('<a href="%s">%s</a>\n' % (name, name)
+                        for name in sorted(names)) +
+                '</pre></body></html>')
+
+    def pushid(self, revision):
+        for pushid, changeset, date in self.pushes:
+            if changeset.startswith(revision):
+                return pushid
+        return None
+
+    def json_pushes(self, query):
+        if 'changeset' in query:
+            first = self.pushid(query['changeset'][0]) - 1
+            last = first + 1
+        else:
+            first = self.pushid(query['fromchange'][0])
+            last = self.pushid(query['tochange'][0])
+        return json.dumps(dict(
+            (str(pushid), {'changesets': [changeset], 'date': date})
+            for pushid, changeset, date in self.pushes
+            if first < pushid <= last))
+
+    def content(self, path, query):
+        """Returns the content of path given the dict query of its
+        parsed query string, or None if it does not exist."""
+        if path == '/%s/json-pushes' % self.repo:
+            return self.json_pushes(query)
+        if path in self.files:
+            content = self.files[path]
+            if isinstance(content, tuple):
+                buildid, changeset = content
+                return '%s\n%s/%s/rev/%s\n' % (buildid, self.base_url,
+                                               self.repo, changeset)
+            return content
+        if path.endswith('/'):
+            return self.listing(path)
+        return None
@@ -7,11 +7,16 @@ import logging
 import pytz
 import re
 import socket
+import time
 
 import builds
+import buildserver
 
 from multiprocessinghandlers import MultiprocessingStreamHandler, MultiprocessingTimedRotatingFileHandler
 
+# Seconds between requests for the progress of a warm up.
+WARM_POLL_INTERVAL = 10
+
 def from_iso_date_or_datetime(s):
     datefmt = '%Y-%m-%d'
     datetimefmt = datefmt + 'T%H:%M:%S'
@@ -22,6 +27,74 @@ def from_iso_date_or_datetime(s):
     return d
 
 
+def time_range(args):
+    """Returns the start and end times in the date/datetime
+    arguments."""
+    if re.match('\d{14}', args[0]):
+        # build id
+        build_time = datetime.datetime.strptime(args[0], '%Y%m%d%H%M%S')
+        start_time = build_time
+        end_time = build_time
+    else:
+        start_time = from_iso_date_or_datetime(args[0])
+        if len(args) > 1:
+            end_time = from_iso_date_or_datetime(args[1])
+        else:
+            end_time = datetime.datetime.now()
+    if not start_time.tzinfo:
+        start_time = start_time.replace(tzinfo=pytz.timezone('US/Pacific'))
+    if not end_time.tzinfo:
+        end_time = end_time.replace(tzinfo=pytz.timezone('US/Pacific'))
+    return start_time, end_time
+
+
+def warm(args, options, logger):
+    """Asks the build cache server to fetch the builds in the range
+    and reports its progress until it has finished."""
+    client = buildserver.BuildCacheClient(host=options.ip,
+                                          port=options.build_cache_port)
+    try:
+        if not args:
+            response = client.warm('revision', options.build_location,
+                                   options.first_revision,
+                                   options.last_revision,
+                                   enable_unittests=options.enable_unittests)
+        else:
+            start_time, end_time = time_range(args)
+            datetimefmt = '%Y-%m-%dT%H:%M:%S'
+            response = client.warm('time', options.build_location,
+                                   start_time.strftime(datetimefmt),
+                                   end_time.strftime(datetimefmt),
+                                   enable_unittests=options.enable_unittests)
+        if not response or not response['success']:
+            print 'Unable to warm the build cache: %s' % (
+                response and response['error'])
+            return 1
+        warm_id = response['warm_id']
+        progress = None
+        while True:
+            status = client.warm_status(warm_id)
+            if not status:
+                return 1
+            if (status['state'], status['fetched'],
+                status['failed']) != progress:
+                progress = (status['state'], status['fetched'],
+                            status['failed'])
+                s = ('Warm up %d %s: fetched %d, failed %d of %d builds' %
+                     (warm_id, status['state'], status['fetched'],
+                      status['failed'], status['builds']))
+                logger.info(s)
+                print s
+            if status['state'] in ('done', 'error'):
+                break
+            time.sleep(WARM_POLL_INTERVAL)
+    finally:
+        client.close()
+    if status['state'] == 'error' or status['failed']:
+        return 1
+    return 0
+
+
 def command_str(build, devices):
     s = 'triggerjobs %s' % build
     if devices:
@@ -51,6 +124,9 @@ def main(args, options):
     filehandler.setFormatter(fileformatter)
     logger.addHandler(filehandler)
 
+    if options.warm_only:
+        return warm(args, options, logger)
+
     logger.info('Looking for builds...')
     product = 'fennec'
     build_platforms = ['android', 'android-armv6', 'android-x86']
@@ -61,35 +137,25 @@ def main(args, options):
         build_urls = builds.BuildCache(
             options.repos, options.buildtypes,
             product, build_platforms,
-            buildfile_ext).find_builds_by_revision(
+            buildfile_ext,
+            crawl_threads=options.crawl_threads,
+            search_strategy=options.search_strategy).find_builds_by_revision(
                 options.first_revision, options.last_revision,
                 options.build_location)
     elif args[0] == 'latest':
         build_urls = builds.BuildCache(
             options.repos, options.buildtypes,
             product, build_platforms,
-            buildfile_ext).find_latest_builds(
+            buildfile_ext,
+            crawl_threads=options.crawl_threads).find_latest_builds(
             options.build_location)
     else:
-        if re.match('\d{14}', args[0]):
-            # build id
-            build_time = datetime.datetime.strptime(args[0], '%Y%m%d%H%M%S')
-            start_time = build_time
-            end_time = build_time
-        else:
-            start_time = from_iso_date_or_datetime(args[0])
-            if len(args) > 1:
-                end_time = from_iso_date_or_datetime(args[1])
-            else:
-                end_time = datetime.datetime.now()
-        if not start_time.tzinfo:
-            start_time = start_time.replace(tzinfo=pytz.timezone('US/Pacific'))
-        if not end_time.tzinfo:
-            end_time = end_time.replace(tzinfo=pytz.timezone('US/Pacific'))
+        start_time, end_time = time_range(args)
         build_urls = builds.BuildCache(
             options.repos, options.buildtypes,
             product, build_platforms,
-            buildfile_ext).find_builds_by_time(
+            buildfile_ext,
+            crawl_threads=options.crawl_threads).find_builds_by_time(
             start_time, end_time, options.build_location)
 
     if not build_urls:
@@ -134,7 +200,11 @@ with build IDs between the given date/datetime and now.
 If a date/datetime range is given, test runs are initiated for all builds
 with build IDs in the given range.
 
-If "latest" is given, test runs are initiated for the most recent build.'''
+If "latest" is given, test runs are initiated for the most recent build.
+
+If --warm-only is given, no test runs are initiated. Instead the
+build cache server downloads the builds in the background so that
+they are ready when test runs are triggered for them.'''
     parser = OptionParser(usage=usage)
     parser.add_option('-i', '--ip', action='store', type='string', dest='ip',
                       default='127.0.0.1',
@@ -178,6 +248,36 @@ If "latest" is given, test runs are initiated for the most recent build.'''
                       help='revision of second build; must match a build;'
                       ' first revision must also be specified;'
                       ' can not be used with date arguments.')
+    parser.add_option('--crawl-threads', action='store', type='int',
+                      dest='crawl_threads',
+                      default=builds.BuildLocation.CRAWL_THREADS,
+                      help='Maximum number of directory listings to fetch '
+                      'concurrently while searching for builds; defaults '
+                      'to %d.' % builds.BuildLocation.CRAWL_THREADS)
+    parser.add_option('--search-strategy', action='store', type='choice',
+                      dest='search_strategy',
+                      choices=builds.BuildLocation.SEARCH_STRATEGIES,
+                      default=builds.BuildLocation.SEARCH_STRATEGY,
+                      help='Strategy used to find the builds between the '
+                      'first and last revisions: linear scans every build '
+                      'in the time range, bisect uses binary search to find '
+                      'the first and last builds; defaults to %s.' %
+                      builds.BuildLocation.SEARCH_STRATEGY)
+    parser.add_option('--warm-only', action='store_true', dest='warm_only',
+                      default=False,
+                      help='Only download the builds into the build cache '
+                      'of the autophone controller; do not trigger test runs. '
+                      'Requires a revision or date range; can not be used '
+                      'with "latest".')
+    parser.add_option('--build-cache-port', action='store', type='int',
+                      dest='build_cache_port',
+                      default=buildserver.DEFAULT_PORT,
+                      help='port of the build cache server used by '
+                      '--warm-only; defaults to %d.' % buildserver.DEFAULT_PORT)
+    parser.add_option('--enable-unittests', action='store_true',
+                      dest='enable_unittests', default=False,
+                      help='With --warm-only, also download the tests '
+                      'packages of the builds.')
     parser.add_option('--device',
                       dest='devices',
                       action='append',
@@ -187,7 +287,9 @@ If "latest" is given, test runs are initiated for the most recent build.'''
     if (len(args) > 2 or
         (options.first_revision and not options.last_revision) or
         (not options.first_revision and options.last_revision) or
-        (options.first_revision and len(args) > 0)):
+        (options.first_revision and len(args) > 0) or
+        (options.warm_only and args and args[0] == 'latest') or
+        (options.warm_only and not args and not options.first_revision)):
         parser.print_help()
         sys.exit(errno.EINVAL)
 
@@ -364,8 +364,13 @@ the "enable" command.
         self.loggerdeco.error('Got empty device root!')
         return False
 
-    def run_tests(self, build_metadata):
-        if not self.has_error():
+    def log_fetch_progress(self, event):
+        if 'artifact' in event and event['bytes'] == event['total']:
+            self.loggerdeco.debug('Fetched %s (%d bytes).' %
+                                  (event['artifact'], event['bytes']))
+
+    def run_tests(self, build_metadata, reboot=True):
+        if reboot and not self.has_error():
             self.loggerdeco.info('Rebooting...')
             self.reboot()
 
@@ -500,15 +505,31 @@ the "enable" command.
         self.loggerdeco.info('Checking job %s.' % build_url)
         client = buildserver.BuildCacheClient(port=self.build_cache_port)
         self.loggerdeco.info('Fetching build...')
-        cache_response = client.get(build_url, enable_unittests=enable_unittests)
+        response = client.submit(build_url, enable_unittests=enable_unittests)
+        if not response or not response['success']:
+            client.close()
+            self.loggerdeco.warning('Errors occured submitting build %s: %s' %
+                                    (build_url, response and response['error']))
+            return
+        # Reboot the phone while the build is being fetched unless the
+        # fetch has already failed.
+        status = client.poll(response['request_id'])
+        fetch_failed = (not status or not status['success'] or
+                        (status['done'] and not status['result']['success']))
+        if not fetch_failed and not self.has_error():
+            self.loggerdeco.info('Rebooting...')
+            self.reboot()
+        cache_response = client.subscribe(response['request_id'],
+                                          self.log_fetch_progress)
         client.close()
-        if not cache_response['success']:
+        if not cache_response or not cache_response['success']:
             self.loggerdeco.warning('Errors occured getting build %s: %s' %
-                                    (build_url, cache_response['error']))
+                                    (build_url, cache_response and
+                                     cache_response['error']))
             return
         self.loggerdeco.info('Starting job %s.' % build_url)
         starttime = datetime.datetime.now()
-        if self.run_tests(cache_response['metadata']):
+        if self.run_tests(cache_response['metadata'], reboot=False):
             self.loggerdeco.info('Job completed.')
             self.jobs.job_completed(job['id'])
             self.status_update(phonetest.PhoneTestMessage(